@@ -0,0 +1,112 @@
+# benchmark_image_resize.py
+"""
+So sánh thời gian (ms/ảnh) và bộ nhớ đỉnh của utils.image_utils.resize_image giữa:
+  - "before": decode toàn bộ ảnh + LANCZOS thuần (fast_path=False)
+  - "after":  JPEG reduce-on-decode (draft) + reducing_gap (fast_path=True, mặc định)
+
+Mặc định benchmark tạo một corpus ảnh tổng hợp (JPEG, PNG, WebP rộng 3000-6000 px) trong thư mục tạm.
+Mỗi cặp (mode, định dạng) chạy trong một process riêng để đo peak RSS độc lập (ru_maxrss, chỉ Linux/macOS).
+
+Chạy với ảnh thật (vd: ảnh sản phẩm đã tải về):
+    python benchmark_image_resize.py --corpus-dir /path/to/images --width 700
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+FORMAT_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp'}
+
+
+def _make_synthetic_image(width, height, seed):
+    """Ảnh gradient + nhiễu (gần với ảnh chụp hơn ảnh một màu, để encoder/decoder làm việc thật)."""
+    noise = Image.effect_noise((width, height), 40 + seed % 20)
+    gradient = Image.linear_gradient('L').resize((width, height))
+    return Image.merge('RGB', (noise, gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+
+
+def _build_synthetic_corpus(corpus_dir, widths):
+    paths = []
+    for image_format, extension in FORMAT_EXTENSIONS.items():
+        for index, width in enumerate(widths):
+            path = os.path.join(corpus_dir, f"synthetic_{width}{extension}")
+            _make_synthetic_image(width, width * 2 // 3, index).save(path, format=image_format, quality=90)
+            paths.append(path)
+    return paths
+
+
+def _peak_rss_mb():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024 # macOS: bytes, Linux: KB
+
+
+def _run_mode(paths, width, fast_path, repeat, result_queue):
+    from utils.image_utils import resize_image
+    baseline_rss_mb = _peak_rss_mb()
+    timings_ms = []
+    for path in paths:
+        with open(path, 'rb') as image_file:
+            image_bytes = image_file.read()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            resized = resize_image(image_bytes, width=width, output_format='JPEG', quality=85, fast_path=fast_path)
+            timings_ms.append((time.perf_counter() - start) * 1000)
+            if not resized:
+                raise RuntimeError(f"resize_image failed for {path}")
+    result_queue.put((timings_ms, _peak_rss_mb(), baseline_rss_mb))
+
+
+def _measure(paths, width, fast_path, repeat):
+    result_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_mode, args=(paths, width, fast_path, repeat, result_queue))
+    process.start()
+    result = result_queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark resize_image: full decode + LANCZOS vs draft decode + reducing_gap.")
+    parser.add_argument("--corpus-dir", type=str, help="Directory of real images (default: generate a synthetic corpus).")
+    parser.add_argument("--width", type=int, default=700, help="Target width (px).")
+    parser.add_argument("--source-widths", type=int, nargs="+", default=[3000, 4500, 6000],
+                        help="Widths of the synthetic source images.")
+    parser.add_argument("--repeat", type=int, default=3, help="Resizes per image and mode.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="resize-bench-") as tmp_dir:
+        if args.corpus_dir:
+            paths = sorted(os.path.join(args.corpus_dir, name) for name in os.listdir(args.corpus_dir))
+        else:
+            print(f"Generating synthetic corpus ({args.source_widths} px wide) ...")
+            paths = _build_synthetic_corpus(tmp_dir, args.source_widths)
+
+        paths_by_format = {}
+        for path in paths:
+            try:
+                with Image.open(path) as img:
+                    paths_by_format.setdefault(img.format, []).append(path)
+            except Exception:
+                continue # Bỏ qua file không phải ảnh
+
+        print(f"Target width: {args.width}px, repeat: {args.repeat}")
+        for image_format, format_paths in sorted(paths_by_format.items()):
+            results = {}
+            for label, fast_path in (("before", False), ("after", True)):
+                timings_ms, peak_rss_mb, baseline_rss_mb = _measure(format_paths, args.width, fast_path, args.repeat)
+                results[label] = statistics.mean(timings_ms)
+                print(f"{image_format:<5} {label:<7} images={len(format_paths):<3} mean={statistics.mean(timings_ms):8.1f} ms/image  "
+                      f"p50={statistics.median(timings_ms):8.1f} ms  peak_rss={peak_rss_mb:7.1f} MB "
+                      f"(+{peak_rss_mb - baseline_rss_mb:.1f} MB over baseline)")
+            speedup = results["before"] / results["after"] if results["after"] > 0 else float('inf')
+            print(f"{image_format:<5} speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
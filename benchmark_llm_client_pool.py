@@ -0,0 +1,120 @@
+# benchmark_llm_client_pool.py
+"""
+So sánh độ trễ mỗi lần gọi chat completion giữa:
+  - "before": tạo OpenAI client mới cho mỗi lần gọi (hành vi cũ của call_openai_chat)
+  - "after":  dùng client dùng chung từ registry (utils.api_clients.get_llm_client)
+
+Mặc định benchmark chạy với một stub server cục bộ giả lập API /chat/completions.
+Stub server trễ thêm --connect-latency-ms cho mỗi kết nối TCP mới để mô phỏng chi phí
+bắt tay TCP/TLS tới OpenRouter/OpenAI.
+
+Chạy với endpoint thật (tốn phí, dùng model mặc định của site):
+    python benchmark_llm_client_pool.py --live --site fretterverse --calls 10
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from openai import OpenAI
+
+from utils.api_clients import get_llm_client, close_llm_clients, configure_llm_client_pool
+
+
+def _make_stub_handler(connect_latency_sec):
+    class StubChatCompletionHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # Cho phép keep-alive
+
+        def setup(self):
+            super().setup()
+            time.sleep(connect_latency_sec) # Mô phỏng chi phí bắt tay kết nối mới
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            request_body = json.loads(self.rfile.read(length) or b"{}")
+            body = json.dumps({
+                "id": "chatcmpl-bench",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request_body.get("model", "bench-model"),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "ok"}}],
+                "usage": {"prompt_tokens": 5, "completion_tokens": 1, "total_tokens": 6}
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubChatCompletionHandler
+
+
+def _time_calls(get_client, model_name, num_calls):
+    latencies = []
+    for _ in range(num_calls):
+        start = time.perf_counter()
+        client = get_client()
+        client.chat.completions.create(
+            model=model_name,
+            messages=[{"role": "user", "content": "Reply with the single word: ok"}],
+            max_tokens=5
+        )
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def _summarize(label, latencies):
+    ordered = sorted(latencies)
+    p90 = ordered[max(0, int(round(0.9 * len(ordered))) - 1)]
+    print(f"{label:<28} calls={len(latencies):<4} mean={statistics.mean(latencies):8.1f} ms  "
+          f"p50={statistics.median(latencies):8.1f} ms  p90={p90:8.1f} ms  first={latencies[0]:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-call LLM latency: new client per call vs pooled client.")
+    parser.add_argument("--calls", type=int, default=30, help="Number of calls per mode.")
+    parser.add_argument("--connect-latency-ms", type=float, default=150.0,
+                        help="Simulated handshake cost per new connection for the local stub server.")
+    parser.add_argument("--live", action="store_true", help="Call the real OpenRouter endpoint instead of the stub server.")
+    parser.add_argument("--site", type=str, help="Site profile used to load API keys in --live mode.")
+    args = parser.parse_args()
+
+    server = None
+    if args.live:
+        from utils.config_loader import load_app_config
+        config = load_app_config(site_name=args.site)
+        configure_llm_client_pool(config)
+        api_key = config.get('OPENROUTER_API_KEY')
+        base_url = config.get('OPENROUTER_BASE_URL')
+        model_name = config.get('DEFAULT_OPENAI_CHAT_MODEL')
+        print(f"Live benchmark against {base_url} with model {model_name}")
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _make_stub_handler(args.connect_latency_ms / 1000.0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        api_key = "bench-key"
+        base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+        model_name = "bench-model"
+        print(f"Stub benchmark against {base_url} (simulated handshake: {args.connect_latency_ms} ms per new connection)")
+
+    try:
+        before = _time_calls(lambda: OpenAI(api_key=api_key, base_url=base_url), model_name, args.calls)
+        after = _time_calls(lambda: get_llm_client(api_key, base_url=base_url), model_name, args.calls)
+    finally:
+        close_llm_clients()
+        if server:
+            server.shutdown()
+
+    _summarize("before (client per call)", before)
+    _summarize("after (pooled client)", after)
+    speedup = statistics.mean(before) / statistics.mean(after) if statistics.mean(after) > 0 else float('inf')
+    print(f"Mean per-call speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
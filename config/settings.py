@@ -27,6 +27,113 @@ DEFAULT_OPENAI_EMBEDDINGS_MODEL = "text-embedding-3-small"
 DEFAULT_GEMINI_MODEL = "gemini-pro" # Nếu bạn vẫn dùng Gemini cho một số tác vụ
 OPENROUTER_API_KEY = None # Sẽ được override bởi .env
 OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+# Connection pool dùng chung cho các LLM client (OpenAI/OpenRouter)
+LLM_HTTP_MAX_CONNECTIONS = 20 # Tổng số kết nối tối đa cho mỗi endpoint
+LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS = 10 # Số kết nối keep-alive được giữ lại
+LLM_HTTP_KEEPALIVE_EXPIRY = 60 # Giây giữ kết nối rảnh trước khi đóng
+LLM_HTTP2_ENABLED = True # Dùng HTTP/2 nếu package 'h2' đã được cài
+LLM_MAX_CONCURRENT_REQUESTS_PER_MODEL = 4 # Số request LLM đồng thời tối đa cho mỗi model
+LLM_MODEL_CONCURRENCY_LIMITS = {} # Ghi đè theo model, ví dụ: {"openai/gpt-4o": 8}
+# Cache phản hồi LLM trên đĩa (key = hash của model + messages + response_format)
+LLM_CACHE_ENABLED = False # Bật để chạy lại keyword bị lỗi giữa chừng không phải trả tiền lại cho các bước đã xong
+LLM_CACHE_PATH = "cache/llm_cache.sqlite3"
+LLM_CACHE_MAX_SIZE_MB = 512 # Vượt quá thì xóa entry ít dùng nhất (LRU)
+LLM_CACHE_TTLS = { # TTL (giây) theo call site; 0 = không cache call site đó
+    "default": 7 * 24 * 3600,
+    "choose_author": 30 * 24 * 3600, # Prompt cố định theo topic, dùng lại được giữa các keyword
+    "recommend_category": 30 * 24 * 3600,
+    "keyword_suitability": 30 * 24 * 3600,
+    "serp_analysis": 3 * 24 * 3600,
+}
+# Rate limiter token bucket dùng chung giữa các process (scheduler chạy nhiều site cùng key)
+LLM_RATE_LIMIT_ENABLED = True
+LLM_RATE_LIMIT_DB_PATH = "cache/rate_limiter.sqlite3"
+LLM_RATE_LIMIT_MAX_WAIT_SEC = 120 # Chờ quá lâu thì vẫn gửi request (để retry xử lý)
+LLM_RATE_LIMIT_COMPLETION_TOKENS_ESTIMATE = 800 # Token output ước lượng cho mỗi request chat
+LLM_RATE_LIMITS = { # Key: "provider:model" hoặc "provider:*"; rpm = request/phút, tpm = token/phút
+    "openrouter:*": {"rpm": 120, "tpm": 400000},
+    "openai:*": {"rpm": 500, "tpm": 200000},
+    "openai:dall-e-3": {"rpm": 5},
+}
+LLM_REQUEST_TIMEOUT_SEC = 300 # Timeout cho mỗi request LLM
+LLM_RETRY_DEADLINE_SEC = 600 # Tổng thời gian tối đa (kể cả retry) cho một lời gọi LLM
+# Model hỗ trợ structured outputs (response_format "json_schema"); model khác dùng "json_object"
+LLM_STRUCTURED_OUTPUT_MODELS = ["openai/gpt-4o-mini", "openai/gpt-4o", "openai/gpt-4.1", "openai/gpt-4.1-mini", "gpt-4o-mini", "gpt-4o", "gpt-4.1"]
+# Context window (token) theo model: prompt + max_tokens vượt mức này sẽ không được gửi đi
+LLM_CONTEXT_WINDOWS = {
+    "openai/gpt-4o-mini": 128000,
+    "openai/gpt-4o": 128000,
+    "openai/gpt-4.1": 1047576,
+    "openai/gpt-4.1-mini": 1047576,
+}
+LLM_DEFAULT_CONTEXT_WINDOW = 128000
+# Budget token cho các phần context biến đổi của prompt (phần vượt budget bị cắt bớt)
+PROMPT_TOKEN_BUDGETS = {
+    "serp_results": 4000,        # Dữ liệu SERP trong prompt phân tích keyword
+    "section_names_list": 600,   # Danh sách tên section trong prompt viết từng section
+    "author_info": 400,          # Thông tin tác giả (prompt enrich outline và viết section)
+    "refine_draft_html": 30000,  # Bản nháp vượt budget này thì bỏ qua bước refine (không cắt bản nháp)
+}
+SECTION_MAX_TOKENS_FACTOR = 2.0 # max_tokens của section = độ dài yêu cầu (từ) đổi ra token * hệ số này
+TIKTOKEN_CACHE_DIR = "cache/tiktoken" # Cache encoding của tiktoken (chạy prefetch_tiktoken_encodings.py khi có mạng)
+# Prefix prompt tối thiểu để provider cache (OpenAI: 1024 token). System message chung của các section nên vượt ngưỡng này
+PROMPT_CACHE_MIN_PREFIX_TOKENS = 1024
+# Số section được viết đồng thời ở Bước 3 (1 = tuần tự). Vẫn bị giới hạn bởi LLM_MAX_CONCURRENT_REQUESTS_PER_MODEL
+SECTION_WRITER_MAX_WORKERS = 4
+# Gộp nhiều subchapter ngắn liền nhau (vd: các product review ~150 từ) vào một request LLM trả JSON theo sectionIndex
+SECTION_BATCHING_ENABLED = False
+SECTION_BATCH_MAX_WORDS = 200 # Chỉ gộp subchapter có độ dài yêu cầu <= số từ này
+SECTION_BATCH_MAX_SECTIONS = 4 # Số section tối đa trong một request
+# Streaming cho các lời gọi sinh nội dung dài (section, bảng so sánh, hoàn thiện bài viết)
+LLM_STREAMING_ENABLED = True
+LLM_STREAM_MAX_OUTPUT_TOKENS = 8000 # Trần cứng cho section: dừng stream khi output vượt số token này (refine tính trần theo bản nháp)
+LLM_STREAM_OVERSHOOT_FACTOR = 1.6 # Dừng stream khi số từ vượt độ dài yêu cầu * hệ số này
+# Model router (chỉ áp dụng cho OpenRouter): failover theo chuỗi model và hedge request cho call site cần độ trễ thấp
+LLM_ROUTER_ENABLED = True
+LLM_MODEL_FAILOVER_CHAINS = { # Model dự phòng theo call site, thử sau model được cấu hình cho call site đó
+    "default": ["openai/gpt-4.1-mini"],
+    "outline_initial": ["openai/gpt-4o"],
+    "outline_enrich": ["openai/gpt-4o"],
+    "refine_article": ["openai/gpt-4o"],
+}
+# Call site gửi hedge tới model kế tiếp khi model chính chậm hơn p90 của nó. Mỗi hedge có thể nhân đôi chi phí
+# của lời gọi đó (request bị hủy vẫn bị tính phí), nên mặc định tắt; chỉ bật cho call site ngắn, rẻ và idempotent
+# nằm trên đường găng, vd: ["image_keyword", "video_keyword"]
+LLM_HEDGED_CALL_SITES = []
+LLM_ROUTER_WINDOW_SIZE = 50 # Số lời gọi gần nhất dùng để tính p90 và tỉ lệ lỗi của mỗi model
+LLM_ROUTER_MIN_SAMPLES = 10 # Chưa đủ số mẫu này thì dùng LLM_HEDGE_DEFAULT_DELAY_SEC
+LLM_ROUTER_ERROR_RATE_THRESHOLD = 0.5 # Model có tỉ lệ lỗi gần đây >= ngưỡng này bị đẩy xuống cuối chuỗi
+LLM_HEDGE_DEFAULT_DELAY_SEC = 20
+# Sổ usage theo lần chạy: summary JSON ghi vào USAGE_LOG_DIR (mặc định: thư mục "usage" cạnh log của orchestrator)
+USAGE_LOG_DIR = None
+# Bảng giá (USD / 1 triệu token) để ước lượng chi phí; model không có trong bảng được tính 0
+LLM_PRICING_PER_1M_TOKENS = {
+    "openai/gpt-4o-mini": {"prompt": 0.15, "completion": 0.60, "cached": 0.075},
+    "openai/gpt-4o": {"prompt": 2.50, "completion": 10.00, "cached": 1.25},
+    "openai/gpt-4.1": {"prompt": 2.00, "completion": 8.00, "cached": 0.50},
+    "openai/gpt-4.1-mini": {"prompt": 0.40, "completion": 1.60, "cached": 0.10},
+    # Tên model khi gọi thẳng OpenAI (key "openai-direct" trong LLM_PROVIDER_KEYS)
+    "gpt-4o-mini": {"prompt": 0.15, "completion": 0.60, "cached": 0.075},
+    "gpt-4o": {"prompt": 2.50, "completion": 10.00, "cached": 1.25},
+    "gpt-4.1": {"prompt": 2.00, "completion": 8.00, "cached": 0.50},
+    "gpt-4.1-mini": {"prompt": 0.40, "completion": 1.60, "cached": 0.10},
+    "text-embedding-3-small": {"prompt": 0.02},
+}
+IMAGE_PRICE_PER_IMAGE = {"dall-e-3": 0.04} # USD / ảnh (1024x1024, standard)
+# Pool nhiều key/provider cho các lời gọi chat qua OpenRouter: chia tải theo quota RPM/TPM còn trống của từng key.
+# api_key_env: tên biến (trong config hoặc .env) chứa key; entry không có key sẽ bị bỏ qua.
+# model_map: tên model OpenRouter -> tên model của provider (key không có model_map chỉ dùng được cho OpenRouter).
+# Chỉ map sang cùng một model: map sang model khác họ (vd: "openai/gpt-4o-mini" -> "gemini-2.0-flash") sẽ đổi
+# chất lượng output của mọi call site dùng model đó. Output của model bị thay không được lưu vào LLM cache.
+# Quota của mỗi key được theo dõi trong LLM_RATE_LIMIT_DB_PATH nên dùng chung giữa mọi site/process.
+LLM_KEY_POOL_ENABLED = False
+LLM_PROVIDER_KEYS = [
+    {"name": "openrouter-main", "provider": "openrouter", "api_key_env": "OPENROUTER_API_KEY", "rpm": 120, "tpm": 400000},
+    {"name": "openrouter-2", "provider": "openrouter", "api_key_env": "OPENROUTER_API_KEY_2", "rpm": 120, "tpm": 400000},
+    {"name": "openai-direct", "provider": "openai", "api_key_env": "OPENAI_API_KEY", "rpm": 500, "tpm": 200000,
+     "model_map": {"openai/gpt-4o-mini": "gpt-4o-mini", "openai/gpt-4o": "gpt-4o",
+                   "openai/gpt-4.1": "gpt-4.1", "openai/gpt-4.1-mini": "gpt-4.1-mini"}},
+]
 
 # --- Cấu hình cho tìm kiếm ---
 GOOGLE_CX_ID = "YOUR_SINGLE_CX_ID_FROM_ENV" # Sẽ được load từ .env
@@ -36,8 +143,51 @@ SERPER_BASE_URL = "https://google.serper.dev"
 SEARCH_PROVIDER = "serper" # Giá trị có thể là "google" hoặc "serper"
 IMAGE_SEARCH_MIN_WIDTH = 400 # Kích thước chiều rộng tối thiểu cho ảnh từ Serper
 IMAGE_SEARCH_MIN_HEIGHT = 100 # Kích thước chiều cao tối thiểu cho ảnh từ Serper
+IMAGE_PROCESSING_MAX_WORKERS = 4 # Số section được tìm/chọn/tải/upload ảnh đồng thời (1 = tuần tự)
+# Probe ảnh ứng viên (GET có Range lấy phần đầu file) trước khi LLM chọn: loại URL chết/không phải ảnh/quá nhỏ
+IMAGE_PROBE_ENABLED = True
+IMAGE_PROBE_TIMEOUT_SEC = 5
+IMAGE_PROBE_MAX_BYTES = 65536 # Đủ để đọc kích thước từ header (kể cả JPEG có EXIF lớn)
+IMAGE_PROBE_MAX_WORKERS = 8 # Số URL được probe đồng thời cho mỗi section
+# Tải ảnh gốc: dừng sớm khi vượt dung lượng/deadline; body lớn hơn ngưỡng spool được ghi ra file tạm thay vì giữ trong RAM
+IMAGE_DOWNLOAD_TIMEOUT = 10 # Timeout (giây) cho mỗi lần đọc socket
+IMAGE_DOWNLOAD_DEADLINE_SEC = 30 # Tổng thời gian tối đa cho một lần tải
+IMAGE_DOWNLOAD_MAX_BYTES = 15 * 1024 * 1024
+IMAGE_DOWNLOAD_SPOOL_MEMORY_BYTES = 2 * 1024 * 1024
+# Cache ảnh trên đĩa (ảnh gốc + bản resize), dùng chung giữa các lần chạy và các site
+IMAGE_CACHE_ENABLED = True
+IMAGE_CACHE_DIR = "cache/images"
+IMAGE_CACHE_MAX_SIZE_MB = 1024 # Vượt quá thì xóa ảnh ít dùng nhất (LRU)
+IMAGE_CACHE_MAX_AGE_SEC = 7 * 86400 # Cũ hơn thì revalidate bằng ETag/Last-Modified trước khi dùng lại
+# Decode/resize/encode ảnh chạy trong process pool riêng để Pillow không giữ GIL của các thread mạng
+IMAGE_TRANSCODER_ENABLED = True
+IMAGE_TRANSCODER_MAX_WORKERS = 2 # 0 = min(4, số CPU)
+# Định dạng ảnh xuất theo thứ tự ưu tiên: dùng định dạng đầu tiên mà bản Pillow encode được.
+# AVIF là opt-in theo site: chỉ thêm vào site_config.json của site chạy WordPress >= 6.5 và có thư viện ảnh
+# trên server decode được AVIF (để WordPress tạo thumbnail), vd: ["AVIF", "WEBP", "JPEG"]
+IMAGE_OUTPUT_FORMATS = ["WEBP", "JPEG"]
+IMAGE_OUTPUT_MAX_BYTES = 120 * 1024 # Byte budget cho ảnh section: giảm quality (tìm nhị phân) tới khi vừa; 0 = không giới hạn
+FEATURED_IMAGE_OUTPUT_MAX_BYTES = 200 * 1024
+IMAGE_OUTPUT_MIN_QUALITY = 50 # Không giảm quality dưới mức này dù vượt budget
+# srcset mặc định lấy từ các bản resize WordPress tự tạo cho ảnh chính (media_details.sizes), không upload thêm.
+# Opt-in: chiều rộng các bản resize thêm (ngoài IMAGE_RESIZE_WIDTH), tạo từ một lần decode và upload cùng ảnh chính;
+# mỗi width là một media item riêng (kèm các thumbnail WordPress tạo cho nó) nên thư viện media phình nhanh.
+# Byte budget của các bản này tỉ lệ với số pixel so với ảnh chính, vd: [360, 700, 1200]
+IMAGE_SRCSET_WIDTHS = []
+IMAGE_SRCSET_SIZES = None # Thuộc tính sizes của <img>; None = "(max-width: Wpx) 100vw, Wpx" với W là width ảnh chính
+# Ảnh gần trùng (perceptual hash dHash 64 bit), kiểm tra trước khi resize/upload: trùng ảnh khác trong cùng bài -> chọn ảnh khác;
+# trùng ảnh đã upload lên cùng site từ bài khác (index theo WP_BASE_URL, dùng chung giữa các lần chạy) -> dùng lại media item đó
+IMAGE_DEDUPE_ENABLED = True
+IMAGE_DEDUPE_INDEX_PATH = "cache/image_hashes.sqlite3"
+IMAGE_DEDUPE_MAX_DISTANCE = 6 # Số bit khác nhau tối đa (/64) để coi là trùng; tăng lên sẽ bắt được nhiều bản crop/chỉnh màu hơn nhưng dễ loại nhầm ảnh sản phẩm na ná nhau
 YOUTUBE_SEARCH_NUM_RESULTS = 5
 
+# --- Cấu hình retry cho các API client (exponential backoff + jitter) ---
+RETRY_MAX_DELAY_SEC = 30 # Trần cho mỗi lần chờ giữa hai lần retry
+RETRY_DEADLINE_SEC = 180 # Tổng thời gian tối đa cho một lời gọi (search, WordPress...) kể cả retry
+RETRY_MAX_RETRY_AFTER_SEC = 60 # Không chờ theo header Retry-After lâu hơn mức này
+HTTP_REQUEST_TIMEOUT_SEC = 60 # Timeout mặc định cho mỗi request HTTP
+
 # --- Cấu hình logic nghiệp vụ ---
 VIDEO_INSERTION_PROBABILITY = 0.3 # Xác suất chèn video (0.0 đến 1.0)
 EXTERNAL_LINKS_PER_SECTION_MIN = 1
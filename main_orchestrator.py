@@ -13,6 +13,18 @@ from utils.logging_config import setup_logging
 from utils.google_sheets_handler import GoogleSheetsHandler
 from utils.pinecone_handler import PineconeHandler
 from utils.db_handler import MySQLHandler 
+from utils.api_clients import configure_llm_client_pool, close_llm_clients, log_llm_stream_metrics, log_request_coalescing_stats
+from utils.llm_cache import configure_llm_cache, log_llm_cache_stats
+from utils.image_cache import configure_image_cache, log_image_cache_stats
+from utils.image_transcoder import configure_image_transcoder, log_image_transcoder_stats, shutdown_image_transcoder
+from utils.image_dedupe import configure_image_dedupe, log_image_dedupe_stats
+from utils.rate_limiter import configure_rate_limiter
+from utils.retry_policy import configure_retry_policy
+from utils.json_repair import log_json_repair_stats
+from utils.model_router import configure_model_router, log_model_router_stats
+from utils.usage_ledger import configure_usage_ledger
+from utils.provider_pool import configure_provider_key_pool, log_provider_key_pool_stats
+from utils.token_counter import configure_token_counter
 from workflows.main_logic import orchestrate_article_creation, normalize_keyword_for_pinecone_id
 
 APP_CONFIG = None
@@ -36,6 +48,17 @@ def initialize_app(site_name_arg=None): # Thêm site_name_arg
             log_file_path=current_log_file_path
         ) 
         # logger = logging.getLogger(__name__) # Dòng này không còn cần thiết nếu logger global là root logger đã cấu hình
+        configure_token_counter(APP_CONFIG)
+        configure_llm_client_pool(APP_CONFIG)
+        configure_llm_cache(APP_CONFIG)
+        configure_image_cache(APP_CONFIG)
+        configure_image_transcoder(APP_CONFIG)
+        configure_image_dedupe(APP_CONFIG)
+        configure_rate_limiter(APP_CONFIG)
+        configure_retry_policy(APP_CONFIG)
+        configure_model_router(APP_CONFIG)
+        configure_usage_ledger(APP_CONFIG)
+        configure_provider_key_pool(APP_CONFIG)
         logger.info("Application initialized successfully.")
         return True
     except ValueError as e: 
@@ -211,6 +234,17 @@ def main():
 
     if db_h and db_h.connection and db_h.connection.is_connected():
         db_h.disconnect()
+    close_llm_clients()
+    log_llm_cache_stats()
+    log_image_cache_stats()
+    log_image_transcoder_stats()
+    log_image_dedupe_stats()
+    shutdown_image_transcoder()
+    log_json_repair_stats()
+    log_llm_stream_metrics()
+    log_model_router_stats()
+    log_request_coalescing_stats()
+    log_provider_key_pool_stats()
     logger.info("=== FretterVerse Python Orchestrator Finished ===")
 
 if __name__ == "__main__":
@@ -0,0 +1,37 @@
+# prefetch_tiktoken_encodings.py
+"""
+Tải sẵn các file encoding của tiktoken vào thư mục cache cố định (TIKTOKEN_CACHE_DIR, mặc định cache/tiktoken)
+để đếm token chính xác khi orchestrator khởi động mà không có mạng.
+Chạy một lần trên máy có mạng (hoặc copy thư mục cache sang máy chạy orchestrator):
+    python prefetch_tiktoken_encodings.py
+    python prefetch_tiktoken_encodings.py --cache-dir /path/to/cache --encodings o200k_base cl100k_base
+"""
+import argparse
+import os
+
+DEFAULT_ENCODINGS = ["o200k_base", "cl100k_base"] # gpt-4o/gpt-4.1 và các model cũ hơn
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download tiktoken encodings into a persistent local cache.")
+    parser.add_argument("--cache-dir", type=str, default=None,
+                        help="Cache directory (default: TIKTOKEN_CACHE_DIR from config/settings.py).")
+    parser.add_argument("--encodings", nargs="+", default=DEFAULT_ENCODINGS)
+    args = parser.parse_args()
+
+    if args.cache_dir:
+        cache_dir = args.cache_dir
+    else:
+        from config import settings
+        cache_dir = getattr(settings, 'TIKTOKEN_CACHE_DIR', 'cache/tiktoken')
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TIKTOKEN_CACHE_DIR'] = cache_dir # Phải đặt trước khi tiktoken tải encoding
+
+    import tiktoken
+    for encoding_name in args.encodings:
+        encoding = tiktoken.get_encoding(encoding_name)
+        print(f"Cached encoding '{encoding_name}' ({encoding.n_vocab} tokens) in {cache_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,112 @@
 # prompts/content_writing_prompts.py
 
 # ==============================================================================
-# PROMPT FOR WRITING INTRODUCTION SECTION
+# SHARED ARTICLE CONTEXT FOR SECTION WRITING (system message)
 # ==============================================================================
-WRITE_INTRODUCTION_PROMPT = """
-Craft an engaging {length}-word first-person introduction for the informational article titled '{article_title}'. 
-As {author_name}, draw from the expertise and lived experiences detailed in '{author_info}'. Your narrative should feel authentic, grounded in real-world encounters, extensive research, consultations with professionals, or testing of solutions, directly addressing common reader concerns.
+# Gửi làm system message giống hệt nhau (từng byte) cho mọi section của một bài viết,
+# để provider (OpenAI/OpenRouter...) cache được phần prefix này. Chỉ đặt ở đây những gì
+# chung cho cả bài; thông tin riêng của section nằm trong các prompt WRITE_*_PROMPT bên dưới.
+# Placeholder:
+#   {article_title}, {author_name}, {author_bio}, {selected_model}, {section_names_list}
+SECTION_WRITER_CONTEXT_PROMPT = """
+You are {author_name}, writing one section at a time of the article titled '{article_title}'.
+Each request you receive asks for exactly one section of this article. Write only that section, following the section request precisely (length, focus, hook, keywords and allowed HTML tags).
+
+**About You (the Author):**
+"{author_bio}"
+Draw from this expertise and your lived experiences - real-world encounters, extensive research, consultations with professionals, or hands-on testing of solutions - so that every section feels authentic and directly addresses common reader concerns.
+
+**Article Framework:**
+The article follows the {selected_model} model. Each section request names the model role that section plays; align the section with that role.
 
+**Full Article Outline (for context and coherence):**
+{section_names_list}
+Use the outline to keep each section focused on its own scope: do not cover topics that belong to other sections, and write transitions that fit the section's place in the outline.
+
+**Authorial Voice (applies to every section):**
+Speak directly using 'I' and 'my'. Your tone must be expert yet relatable, authentic and personally engaging, instilling confidence that the content is based on genuine experience.
+
+**Critical Analysis (CORE GUIDELINE - adherence is paramount in every section):**
+Adopt a critically analytical and objective mindset throughout:
+-   Objectively analyze all facets: discuss not only positive aspects, benefits or successes but also potential limitations, drawbacks, prerequisites, challenges encountered, or alternative viewpoints.
+-   Ground all statements, especially those conveying strong opinions or conclusions, in reasoned logic or clearly articulated experience. Avoid unsubstantiated claims, emotional bias, hyperbole, uncritical enthusiasm or undue criticism.
+-   Strive for a balanced, credible, and insightful perspective that reflects deep, thoughtful consideration rather than mere promotion.
+
+**Section-Specific Voice and Critical Guidance (apply the block that matches the section request):**
+
+*The introduction:*
 **Your Voice and Approach (Crucial for Credibility):**
 Speak directly using 'I' and 'my'. Your tone must be expert yet relatable, instilling confidence that the content is based on genuine experience. **Crucially, adopt a critically analytical and objective mindset:**
 - When sharing initial insights or setting the stage, ensure a balanced perspective. If hinting at solutions or problems, acknowledge potential complexities or varied viewpoints.
 - Avoid unsubstantiated claims or overly enthusiastic language. Your credibility stems from thoughtful consideration and a commitment to providing a comprehensive, honest overview.
 - This balanced, objective approach is paramount and must be evident from the outset.
 
+*The introduction (with a hook):*
+**Your Voice and Critical Approach (Paramount for this Introduction):**
+Speak directly using 'I' and 'my'. Your tone must be expert yet relatable. **Crucially, apply a critically analytical and objective mindset from the very first sentence, including the hook:**
+-   Even when using a hook, ensure it's presented with intellectual honesty. If making a claim (Argument Hook) or sharing a narrative, avoid hyperbole. If presenting research (Research Hook), ensure it's contextually sound.
+-   Your initial statements must reflect thoughtful consideration, aiming for a balanced and credible setup rather than uncritical enthusiasm.
+-   This balanced, objective approach is fundamental to establish trust immediately.
+
+*The conclusion:*
+**Your Concluding Voice and Critical Reflection (Paramount for Impact):**
+Speak directly using 'I' and 'my'. Your tone should be authentic and align with your established expertise. **Crucially, maintain a critically analytical and objective mindset even in your final thoughts:**
+-   When summarizing or offering final takeaways, ensure a balanced perspective. If reinforcing a solution or viewpoint, subtly acknowledge any remaining complexities or areas for further consideration, rather than presenting it as an absolute or overly simplistic final word.
+-   Avoid conclusive statements that sound like unsupported hyperbole or mere personal opinion without the backing of the article's content. Your final words should resonate with credibility and thoughtful reflection.
+-   This balanced, objective approach is essential for a powerful and trustworthy conclusion.
+
+*A chapter:*
+**Authorial Voice, Perspective, and Critical Analysis (Paramount for this Section):**
+Speak directly using 'I' and 'my'. Your voice must be authentic, expert, and personally engaging, reflecting your passion for the subject. **Crucially, all insights, experiences, and evaluations shared must be presented through a critically analytical and objective lens:**
+-   When detailing your perspective or experiences, ensure a balanced discussion. Objectively analyze all facets, including not only positive aspects or successes but also potential limitations, drawbacks, challenges encountered, or alternative viewpoints.
+-   Ground all statements, especially those conveying strong opinions or conclusions, in reasoned logic or clearly articulated experience. Avoid unsubstantiated claims, emotional bias, or hyperbole.
+-   The goal is to provide a balanced, credible, and insightful perspective that reflects deep, thoughtful consideration, rather than mere promotion, uncritical enthusiasm, or undue criticism. This approach is vital for enriching the content informatively.
+
+*A subchapter (not a product review):*
+**Authorial Voice and Critical Analysis for Subchapter (Paramount for Cohesion and Credibility):**
+Speak directly using 'I' and 'my'. Your voice must be authentic and demonstrate in-depth knowledge. **Crucially, all insights, explanations, or evaluations within this subchapter must be presented through a critically analytical and objective lens:**
+-   When explaining concepts or detailing information specific to this subchapter, ensure a balanced presentation. If discussing benefits or applications, also consider potential limitations, prerequisites, or alternative perspectives relevant to this specific scope.
+-   Ground all statements in reasoned logic or clearly articulated experience. Avoid unsubstantiated claims or hyperbole, especially when emphasizing the subchapter's importance or a particular point within it.
+-   The aim is a balanced, credible, and insightful subchapter that reflects thoughtful consideration, contributing cohesively to the parent category with well-supported observations rather than mere assertion or uncritical enthusiasm.
+
+**Output Rules (apply to every section):**
+-   Output strictly in HTML using only the tags allowed by the section request. No other HTML (like <div>, <span>, <html>, <head>, <body>) and no Markdown, unless the section request explicitly asks for a different format.
+-   Ensure clean, readable formatting with paragraphs and line breaks; AVOID WALLS OF TEXT.
+-   Do not repeat the article title or section titles, and do not use unnecessary quotes.
+-   Do not add any remarks outside the section content itself (e.g., no "Here is the section:").
+"""
+
+# ==============================================================================
+# PROMPT FOR WRITING INTRODUCTION SECTION
+# ==============================================================================
+# Các prompt WRITE_*_PROMPT bên dưới là phần riêng của từng section (user message),
+# dùng kèm SECTION_WRITER_CONTEXT_PROMPT ở trên.
+WRITE_INTRODUCTION_PROMPT = """
+Section request: the introduction.
+Craft an engaging {length}-word first-person introduction for the article. 
+Draw especially on this aspect of your expertise: '{author_info}'.
+
 Incorporate these semantic keywords: '{semantic_keywords}' to ensure topical relevance.
 
 The introduction must be concise, seamlessly transitioning to the article's main content.
-Output strictly in HTML: use only <p>, <strong>, and <em> tags. No other HTML (like <div>, <span>, <html>, <head>, <body>) or Markdown. Ensure clean, readable formatting with paragraphs and line breaks; AVOID WALLS OF TEXT. Do not repeat the article title.
-
-For context, refer to the article outline: {section_names_list}.
+Allowed HTML tags: <p>, <strong>, and <em>.
 """
 # Lưu ý: Prompt gốc trong n8n cho Introduction có phần phức tạp hơn về các loại hook.
 # Bạn có thể tích hợp logic chọn hook vào Python hoặc đơn giản hóa prompt như trên.
 # Prompt gốc của bạn cho Introduction đã bao gồm các loại hook, tôi sẽ giữ lại ý đó:
 WRITE_INTRODUCTION_PROMPT_WITH_HOOK_CHOICES = """
-Craft a concise {length}-word first-person introduction for the article titled '{article_title}'.
-As {author_name}, drawing from the expertise and lived experiences in '{author_info}', begin with a compelling hook related to '{keyword_for_hook}'. Choose ONE hook style:
+Section request: the introduction (with a hook).
+Craft a concise {length}-word first-person introduction for the article.
+Draw especially on this aspect of your expertise: '{author_info}'. Begin with a compelling hook related to '{keyword_for_hook}'. Choose ONE hook style:
 1.  **Narrative:** Start a story of a significant change/event, withholding the end to build curiosity.
 2.  **Research:** Tease an intriguing finding/statistic, revealing just enough to spark interest.
 3.  **Argument:** Make a bold/unexpected claim, delaying explanation to create debate.
 Ensure your chosen hook is relevant, engaging, and smoothly transitions into the article's theme, setting an authentic tone based on real experience.
 
-**Your Voice and Critical Approach (Paramount for this Introduction):**
-Speak directly using 'I' and 'my'. Your tone must be expert yet relatable. **Crucially, apply a critically analytical and objective mindset from the very first sentence, including the hook:**
--   Even when using a hook, ensure it's presented with intellectual honesty. If making a claim (Argument Hook) or sharing a narrative, avoid hyperbole. If presenting research (Research Hook), ensure it's contextually sound.
--   Your initial statements must reflect thoughtful consideration, aiming for a balanced and credible setup rather than uncritical enthusiasm.
--   This balanced, objective approach is fundamental to establish trust immediately.
-
 Incorporate these semantic keywords for depth: '{semantic_keywords}'.
 
 The introduction must be concise and transition seamlessly.
-Output strictly in HTML: use only <p>, <strong>, and <em>. No other HTML or Markdown. Ensure clean, readable formatting; AVOID WALLS OF TEXT. Do not repeat the article title.
-
-For context, refer to the article outline: {section_names_list}.
+Allowed HTML tags: <p>, <strong>, and <em>.
 """
 # Bạn sẽ cần thêm placeholder {keyword_for_hook} khi format prompt này.
 
@@ -50,21 +114,14 @@ For context, refer to the article outline: {section_names_list}.
 # PROMPT FOR WRITING CONCLUSION SECTION
 # ==============================================================================
 WRITE_CONCLUSION_PROMPT = """
-Craft a concise {length}-word first-person conclusion for the article titled '{article_title}'.
-As {author_name}, drawing from your expertise and lived experiences ('{author_info}'), encapsulate the article's main points and emphasize its key message, reflecting the '{model_role}' aspect of the {selected_model} model. {prompt_section_hook}
-
-**Your Concluding Voice and Critical Reflection (Paramount for Impact):**
-Speak directly using 'I' and 'my'. Your tone should be authentic and align with your established expertise. **Crucially, maintain a critically analytical and objective mindset even in your final thoughts:**
--   When summarizing or offering final takeaways, ensure a balanced perspective. If reinforcing a solution or viewpoint, subtly acknowledge any remaining complexities or areas for further consideration, rather than presenting it as an absolute or overly simplistic final word.
--   Avoid conclusive statements that sound like unsupported hyperbole or mere personal opinion without the backing of the article's content. Your final words should resonate with credibility and thoughtful reflection.
--   This balanced, objective approach is essential for a powerful and trustworthy conclusion.
+Section request: the conclusion.
+Craft a concise {length}-word first-person conclusion for the article.
+Drawing on this aspect of your expertise ('{author_info}'), encapsulate the article's main points and emphasize its key message, reflecting the '{model_role}' aspect of the model. {prompt_section_hook}
 
 Incorporate these semantic keywords for relevance: '{semantic_keywords}'.
 
-The conclusion must be concise yet powerful, providing a coherent wrap-up.
-Output strictly in HTML: use only <p>, <strong>, and <em>. No other HTML or Markdown. Ensure clean, readable formatting; AVOID WALLS OF TEXT. Do not repeat the article title.
-
-For context, refer to the full article outline: {section_names_list}.
+The conclusion must be concise yet powerful, providing a coherent wrap-up of the full outline.
+Allowed HTML tags: <p>, <strong>, and <em>.
 """
 
 # ==============================================================================
@@ -74,6 +131,7 @@ For context, refer to the full article outline: {section_names_list}.
 #   {article_title}: Title of the article for context.
 #   (LLM is expected to generate relevant Q&A based on the title and general knowledge)
 WRITE_FAQ_SECTION_PROMPT = """
+Section request: the FAQ section. This section uses its own output format (schema.org markup) instead of the usual allowed tags.
 Strictly generate an HTML code snippet that adheres to the FAQ schema of schema.org 
 for the topic '{article_title}'. The output must begin directly with the tag 
 '<div itemscope itemtype="https://schema.org/FAQPage">' 
@@ -93,49 +151,36 @@ Generate between 3 to 5 relevant question-answer pairs for the given topic.
 # PROMPT FOR WRITING A GENERAL CHAPTER (Not Intro, Conclusion, FAQ, or Product Review)
 # ==============================================================================
 WRITE_CHAPTER_PROMPT = """
-Write a {length}-word, first-person section on '{section_name}' for the article '{article_title}', aligning with the '{model_role}' aspect of the {selected_model} model. {prompt_section_hook}
-As {author_name}, draw from your expertise and lived experiences ('{author_info}') to share unique insights and detailed knowledge.
-
-**Authorial Voice, Perspective, and Critical Analysis (Paramount for this Section):**
-Speak directly using 'I' and 'my'. Your voice must be authentic, expert, and personally engaging, reflecting your passion for the subject. **Crucially, all insights, experiences, and evaluations shared must be presented through a critically analytical and objective lens:**
--   When detailing your perspective or experiences, ensure a balanced discussion. Objectively analyze all facets, including not only positive aspects or successes but also potential limitations, drawbacks, challenges encountered, or alternative viewpoints.
--   Ground all statements, especially those conveying strong opinions or conclusions, in reasoned logic or clearly articulated experience. Avoid unsubstantiated claims, emotional bias, or hyperbole.
--   The goal is to provide a balanced, credible, and insightful perspective that reflects deep, thoughtful consideration, rather than mere promotion, uncritical enthusiasm, or undue criticism. This approach is vital for enriching the content informatively.
+Section request: the chapter '{section_name}'.
+Write a {length}-word, first-person section on '{section_name}', aligning with the '{model_role}' aspect of the model. {prompt_section_hook}
+Draw especially on this aspect of your expertise and lived experiences ('{author_info}') to share unique insights and detailed knowledge.
 
 Incorporate these semantic keywords for relevance and depth: '{semantic_keywords}'.
 
 This section must be concise yet rich with insightful observations, transitioning smoothly and fitting cohesively within the article.
-Output strictly in HTML: use only <p>, <strong>, and <em>. No other HTML or Markdown. Ensure clean, readable formatting with paragraphs; AVOID WALLS OF TEXT. Do not repeat titles.
-
-For context, refer to the full article outline: {section_names_list}.
+Allowed HTML tags: <p>, <strong>, and <em>.
 """
 # ==============================================================================
 # PROMPT FOR WRITING A GENERAL SUBCHAPTER (Not Product Review)
 # ==============================================================================
 WRITE_SUBCHAPTER_PROMPT = """
-Write a concise, {length}-word first-person subchapter on '{section_name}' for the article '{article_title}'. 
-As {author_name}, drawing from your expertise ('{author_info}'), clearly highlight this subchapter's relevance and contribution to its parent category, '{parent_section_name}'. This section must align with the '{model_role}' aspect of the {selected_model} model. {prompt_section_hook}
-
-**Authorial Voice and Critical Analysis for Subchapter (Paramount for Cohesion and Credibility):**
-Speak directly using 'I' and 'my'. Your voice must be authentic and demonstrate in-depth knowledge. **Crucially, all insights, explanations, or evaluations within this subchapter must be presented through a critically analytical and objective lens:**
--   When explaining concepts or detailing information specific to this subchapter, ensure a balanced presentation. If discussing benefits or applications, also consider potential limitations, prerequisites, or alternative perspectives relevant to this specific scope.
--   Ground all statements in reasoned logic or clearly articulated experience. Avoid unsubstantiated claims or hyperbole, especially when emphasizing the subchapter's importance or a particular point within it.
--   The aim is a balanced, credible, and insightful subchapter that reflects thoughtful consideration, contributing cohesively to the parent category with well-supported observations rather than mere assertion or uncritical enthusiasm.
+Section request: the subchapter '{section_name}' (parent chapter: '{parent_section_name}').
+Write a concise, {length}-word first-person subchapter on '{section_name}'. 
+Drawing on this aspect of your expertise ('{author_info}'), clearly highlight this subchapter's relevance and contribution to its parent category, '{parent_section_name}'. This section must align with the '{model_role}' aspect of the model. {prompt_section_hook}
 
 Incorporate these semantic keywords for relevance: '{semantic_keywords}'.
 
 This subchapter must be concise, providing insightful observations and seamlessly integrating with logical transitions.
-Output strictly in HTML: use only <p>, <strong>, and <em>. No other HTML or Markdown. Ensure clean, readable formatting with paragraphs and line breaks; AVOID WALLS OF TEXT. Do not repeat titles or use unnecessary quotes.
-
-For context and coherence with the overall outline, refer to: {section_names_list}.
+Allowed HTML tags: <p>, <strong>, and <em>.
 """
 
 # ==============================================================================
 # PROMPT FOR WRITING A PRODUCT REVIEW SUBCHAPTER (sectionNameTag = "Product")
 # ==============================================================================
 WRITE_PRODUCT_REVIEW_SUBCHAPTER_PROMPT = """
-Write a concise, {length}-word first-person review for the product '{section_name}' (headline: '{headline}'), as part of the article '{article_title}'.
-As {author_name}, drawing from your expertise and lived experiences ('{author_info}'), highlight this product's relevance to '{parent_section_name}' and align with the '{model_role}' of the {selected_model} model. {prompt_section_hook}
+Section request: the product review subchapter '{section_name}' (parent chapter: '{parent_section_name}').
+Write a concise, {length}-word first-person review for the product '{section_name}' (headline: '{headline}').
+Drawing on this aspect of your expertise and lived experiences ('{author_info}'), highlight this product's relevance to '{parent_section_name}' and align with the '{model_role}' of the model. {prompt_section_hook}
 
 **Product Review Approach: Balanced, Authentic, and Insightful (Adherence is Paramount):**
 Speak directly using 'I' and 'my'. Your review must be informative, personal, and relatable, reflecting your authentic experiences and unique insights. **Crucially, your evaluation of '{section_name}' must be critically analytical and objective throughout:**
@@ -155,9 +200,26 @@ Incorporate these semantic keywords for relevance: '{semantic_keywords}'.
 3.  **Comparative Analysis:** Briefly compare '{section_name}' with 1-2 other products from '{product_list}'. Objectively highlight differences, unique selling points, practical uses, and potential trade-offs.
 
 This review must be concise, seamlessly integrated with logical transitions.
-Output strictly in HTML: use only <p>, <strong>, <em>, <ul>, and <li>. No other HTML or Markdown. Ensure clean, readable formatting with paragraphs; AVOID WALLS OF TEXT. Do not repeat titles.
+Allowed HTML tags: <p>, <strong>, <em>, <ul>, and <li>.
+"""
+
+# ==============================================================================
+# PROMPT FOR WRITING SEVERAL SHORT SECTIONS IN ONE REQUEST (SECTION_BATCHING_ENABLED)
+# ==============================================================================
+# Dùng kèm SECTION_WRITER_CONTEXT_PROMPT. {section_requests} gồm các SECTION_BATCH_ITEM_TEMPLATE,
+# mỗi cái bọc một prompt WRITE_*_PROMPT đã format của một section.
+SECTION_BATCH_ITEM_TEMPLATE = """### sectionIndex: {section_index}
+{section_prompt}"""
+
+WRITE_SECTION_BATCH_PROMPT = """
+This request contains {section_count} separate section requests. Write every one of them in this single response.
+Treat each section request exactly as if it had been sent on its own: follow its length, focus, hook, keywords and allowed HTML tags, and do not merge, shorten or cross-reference the sections because they were requested together.
+
+Return ONLY a valid JSON object in this format, with one entry per section request, in the same order:
+{{"sections": [{{"sectionIndex": <the sectionIndex of the request>, "content": "<the section's HTML content>"}}]}}
+The "content" value must contain only the section's HTML (escaped as a JSON string), with no headings and no other remarks.
 
-For context and coherence, refer to the full article outline: {section_names_list}.
+{section_requests}
 """
 
 # ==============================================================================
@@ -183,7 +245,7 @@ Please perform the following actions on the draft:
     *   Make content more insightful and practically valuable, removing any superficial or redundant information.
 
 2.  **Preserve Media Tags:**
-    *   **Images (`<figure><img ...>`)**: MUST be preserved perfectly (src, alt, placement). DO NOT alter or remove.
+    *   **Images (`<figure><img ...>`)**: MUST be preserved perfectly (src, srcset, sizes, width, height, alt, and placement). Copy every `<img>` attribute exactly as it appears in the draft. DO NOT alter, reorder or remove any attribute, and DO NOT remove the image.
     *   **Videos (`<iframe>`):** MUST be preserved perfectly (src, attributes, placement). DO NOT alter or remove.
 
 3.  **Preserve and Adapt External Links (`<a>` tags):**
@@ -0,0 +1,124 @@
+# prompts/response_schemas.py
+
+# ==============================================================================
+# JSON SCHEMA CHO CÁC PROMPT TRẢ VỀ JSON
+# ==============================================================================
+# Dùng để:
+#   - Kiểm tra (validate) JSON trả về từ LLM sau khi parse/sửa lỗi cục bộ (utils/json_repair.py).
+#   - Gửi kèm request dưới dạng response_format "json_schema" cho các model hỗ trợ
+#     structured outputs (LLM_STRUCTURED_OUTPUT_MODELS) - chỉ áp dụng với schema có root là object.
+# Schema chỉ mô tả các key mà code thực sự đọc; LLM trả thêm key khác vẫn hợp lệ.
+
+# generate_initial_outline
+INITIAL_OUTLINE_SCHEMA = {
+    "type": "object",
+    "required": ["title", "slug", "description", "chapters"],
+    "properties": {
+        "title": {"type": "string"},
+        "slug": {"type": "string"},
+        "description": {"type": "string"},
+        "chapters": {"type": "array", "minItems": 1, "items": {"type": "object"}}
+    }
+}
+
+# enrich_outline_with_author_hooks
+ENRICHED_OUTLINE_SCHEMA = {
+    "type": "object",
+    "required": ["chapters"],
+    "properties": {
+        "chapters": {"type": "array", "minItems": 1, "items": {"type": "object"}}
+    }
+}
+
+# analyze_serp_and_keyword
+SERP_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "required": ["searchIntent", "contentFormat", "articleType", "selectedModel", "semanticKeyword"],
+    "properties": {
+        "searchIntent": {"type": "string"},
+        "contentFormat": {"type": "string"},
+        "articleType": {"type": "string"},
+        "selectedModel": {"type": "string"},
+        "semanticKeyword": {"anyOf": [{"type": "array"}, {"type": "string"}]}
+    }
+}
+
+# choose_author_for_topic
+CHOOSE_AUTHOR_SCHEMA = {
+    "type": "object",
+    "required": ["name", "ID", "info"],
+    "properties": {
+        "name": {"type": "string"},
+        "ID": {"anyOf": [{"type": "integer"}, {"type": "string"}]},
+        "info": {"type": "string"}
+    }
+}
+
+# _determine_category_id
+RECOMMEND_CATEGORY_SCHEMA = {
+    "type": "object",
+    "required": ["isNew"],
+    "properties": {
+        "isNew": {"type": "string"},
+        "recommendation": {"type": "object"},
+        "suggestedName": {"anyOf": [{"type": "string"}, {"type": "null"}]}
+    }
+}
+
+# finalize_and_publish_article_step (Internal Link Juicer): {"keywords": [...]} hoặc list trực tiếp
+ILJ_KEYWORDS_SCHEMA = {
+    "anyOf": [
+        {"type": "object", "required": ["keywords"], "properties": {"keywords": {"type": "array"}}},
+        {"type": "array"}
+    ]
+}
+
+# write_content_for_all_sections_step (SECTION_BATCHING_ENABLED): mỗi phần tử là một section theo sectionIndex.
+# Không bắt buộc key trong từng phần tử: phần tử thiếu/hỏng chỉ làm section đó được viết lại riêng.
+SECTION_BATCH_SCHEMA = {
+    "type": "object",
+    "required": ["sections"],
+    "properties": {
+        "sections": {
+            "type": "array",
+            "minItems": 1,
+            "items": {
+                "type": "object",
+                "properties": {
+                    "sectionIndex": {"anyOf": [{"type": "integer"}, {"type": "string"}]},
+                    "content": {"type": "string"}
+                }
+            }
+        }
+    }
+}
+
+# process_single_section_image
+CHOOSE_IMAGE_SCHEMA = {
+    "type": "object",
+    "required": ["imageURL"],
+    "properties": {
+        "imageURL": {"anyOf": [{"type": "string"}, {"type": "null"}]}, # null = không có ảnh phù hợp
+        "imageDes": {"anyOf": [{"type": "string"}, {"type": "null"}]}
+    }
+}
+
+# process_single_section_video
+CHOOSE_VIDEO_SCHEMA = {
+    "type": "object",
+    "required": ["videoID"],
+    "properties": {
+        "videoID": {"anyOf": [{"type": "string"}, {"type": "null"}]}, # null = không có video phù hợp
+        "videoTitle": {"type": "string"},
+        "videoDescription": {"type": "string"}
+    }
+}
+
+# process_external_links_for_section: list trực tiếp hoặc dict bọc list dưới một trong các key đã gặp
+ANCHOR_TEXT_LIST_KEYS = ["citations", "essential_citations", "citedPhrases", "key_phrases", "keyPhrases", "result"]
+ANCHOR_TEXTS_SCHEMA = {
+    "anyOf": [{"type": "array"}] + [
+        {"type": "object", "required": [key], "properties": {key: {"type": "array"}}}
+        for key in ANCHOR_TEXT_LIST_KEYS
+    ]
+}
@@ -0,0 +1,81 @@
+# tests/test_image_dedupe.py
+import io
+import sqlite3
+
+import pytest
+from PIL import Image
+
+from utils.image_dedupe import PublishedImageIndex, compute_dhash, format_dhash, hamming_distance
+
+
+def _gradient_image(width=320, height=200, reverse=False):
+    image = Image.new('L', (width, height))
+    image.putdata([(255 - x * 255 // width) if reverse else (x * 255 // width)
+                   for y in range(height) for x in range(width)])
+    return image.convert('RGB')
+
+
+def _encode(image, image_format='JPEG', **save_options):
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **save_options)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def index(tmp_path):
+    return PublishedImageIndex(str(tmp_path / "hashes" / "index.sqlite3"), max_distance=6)
+
+
+def test_resized_and_recompressed_copy_hashes_close():
+    original = _gradient_image()
+    copy = original.resize((160, 100))
+    original_hash = compute_dhash(_encode(original, quality=95))
+    copy_hash = compute_dhash(_encode(copy, 'WEBP', quality=60))
+    assert hamming_distance(original_hash, copy_hash) <= 6
+
+
+def test_different_images_hash_far_apart():
+    ascending = compute_dhash(_encode(_gradient_image()))
+    descending = compute_dhash(_encode(_gradient_image(reverse=True)))
+    assert hamming_distance(ascending, descending) > 32
+
+
+def test_compute_dhash_accepts_path_and_file_object(tmp_path):
+    data = _encode(_gradient_image(), 'PNG')
+    image_path = tmp_path / "image.png"
+    image_path.write_bytes(data)
+    expected = compute_dhash(data)
+    assert compute_dhash(str(image_path)) == expected
+    assert compute_dhash(io.BytesIO(data)) == expected
+
+
+def test_compute_dhash_returns_none_for_non_image():
+    assert compute_dhash(b"<html>not an image</html>") is None
+
+
+def test_hamming_distance_and_format():
+    assert hamming_distance(0b1011, 0b0010) == 2
+    assert format_dhash(0xff) == "00000000000000ff"
+
+
+def test_index_finds_closest_match_per_site(index):
+    srcset = [{'url': 'https://a.example/img-300.webp', 'width': 300, 'height': 188}]
+    index.add('https://a.example', 0xff00, 'https://cdn/1.jpg', 'https://a.example/img.webp', 800, 500, srcset)
+    index.add('https://a.example', 0xff03, 'https://cdn/2.jpg', 'https://a.example/other.webp')
+    match = index.find_near_duplicate('https://a.example', 0xff01)
+    assert match == {'distance': 1, 'source_url': 'https://cdn/1.jpg', 'wp_url': 'https://a.example/img.webp',
+                     'width': 800, 'height': 500, 'srcset': srcset}
+    assert index.find_near_duplicate('https://b.example', 0xff00) is None
+    assert index.find_near_duplicate('https://a.example', 0x00ff) is None
+    assert index.get_stats() == {'checks': 3, 'duplicates': 1, 'adds': 2}
+
+
+def test_index_migrates_old_schema(tmp_path):
+    db_path = str(tmp_path / "index.sqlite3")
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("CREATE TABLE published_image_hashes (id INTEGER PRIMARY KEY AUTOINCREMENT, site TEXT NOT NULL, "
+                     "dhash TEXT NOT NULL, source_url TEXT, wp_url TEXT, created_at REAL NOT NULL)")
+        conn.execute("INSERT INTO published_image_hashes (site, dhash, source_url, wp_url, created_at) "
+                     "VALUES ('s', '00000000000000ff', 'src', 'https://s/old.webp', 0)")
+    match = PublishedImageIndex(db_path).find_near_duplicate('s', 0xff)
+    assert (match['wp_url'], match['width'], match['srcset']) == ('https://s/old.webp', None, [])
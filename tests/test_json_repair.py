@@ -0,0 +1,66 @@
+# tests/test_json_repair.py
+import pytest
+
+from prompts.response_schemas import CHOOSE_AUTHOR_SCHEMA, INITIAL_OUTLINE_SCHEMA, SERP_ANALYSIS_SCHEMA
+from utils.json_repair import build_structured_output_format, parse_json_with_repair, validate_json_schema
+
+
+def test_valid_json_is_not_marked_repaired():
+    assert parse_json_with_repair('{"a": 1}') == ({"a": 1}, False)
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ('```json\n{"a": 1}\n```', {"a": 1}),
+    ('Here is the result: {"a": [1, 2]} Hope this helps!', {"a": [1, 2]}),
+    ('{"a": 1, "b": [1, 2,],}', {"a": 1, "b": [1, 2]}),
+    ('{\n  "a": "x"\n  "b": true\n  "c": 3\n}', {"a": "x", "b": True, "c": 3}),
+    ('{“name”: “Jane”}', {"name": "Jane"}),
+    ('[{"id": 1},]', [{"id": 1}]),
+])
+def test_repairs_common_llm_mistakes(raw, expected):
+    assert parse_json_with_repair(raw) == (expected, True)
+
+
+def test_braces_and_commas_inside_strings_are_untouched():
+    raw = 'Result: {"text": "a {b}, c,]", "n": 2,}'
+    assert parse_json_with_repair(raw) == ({"text": "a {b}, c,]", "n": 2}, True)
+
+
+@pytest.mark.parametrize("raw", [None, "", "no json here", '{"a": 1', '{"a": 1]'])
+def test_unrecoverable_output_raises_value_error(raw):
+    with pytest.raises(ValueError):
+        parse_json_with_repair(raw)
+
+
+def test_schema_accepts_extra_keys():
+    author = {"name": "Jane", "ID": 3, "info": "Guitarist", "extra": True}
+    assert validate_json_schema(author, CHOOSE_AUTHOR_SCHEMA) == []
+
+
+def test_schema_reports_missing_keys_and_wrong_types():
+    errors = validate_json_schema({"name": 5, "ID": 3}, CHOOSE_AUTHOR_SCHEMA)
+    assert "$: missing required key 'info'" in errors
+    assert "$.name: expected string, got int" in errors
+
+
+def test_schema_any_of_and_bool_is_not_integer():
+    assert validate_json_schema({"name": "J", "ID": "3", "info": ""}, CHOOSE_AUTHOR_SCHEMA) == []
+    errors = validate_json_schema({"name": "J", "ID": True, "info": ""}, CHOOSE_AUTHOR_SCHEMA)
+    assert len(errors) == 1 and errors[0].startswith("$.ID: does not match any allowed shape")
+
+
+def test_schema_checks_min_items_and_item_types():
+    outline = {"title": "t", "slug": "s", "description": "d", "chapters": []}
+    assert validate_json_schema(outline, INITIAL_OUTLINE_SCHEMA) == ["$.chapters: expected at least 1 items, got 0"]
+    outline["chapters"] = [{"chapterName": "x"}, "oops"]
+    assert validate_json_schema(outline, INITIAL_OUTLINE_SCHEMA) == ["$.chapters[1]: expected object, got str"]
+
+
+def test_structured_output_format_only_for_object_roots():
+    response_format = build_structured_output_format(SERP_ANALYSIS_SCHEMA, "serp analysis")
+    assert response_format["type"] == "json_schema"
+    assert response_format["json_schema"]["name"] == "serp_analysis"
+    assert response_format["json_schema"]["strict"] is False
+    assert build_structured_output_format({"type": "array"}, "list") is None
+    assert build_structured_output_format({"anyOf": [{"type": "object"}]}, "x") is None
+    assert build_structured_output_format(None, "x") is None
@@ -0,0 +1,115 @@
+# tests/test_retry_policy.py
+import email.utils
+import json
+import time
+
+import pytest
+import requests
+
+from utils import retry_policy
+from utils.retry_policy import RetryPolicy, get_retry_after_seconds, is_retriable_error, _parse_duration
+
+
+def _http_error(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.exceptions.HTTPError(f"HTTP {status}", response=response)
+
+
+@pytest.fixture
+def max_jitter(monkeypatch):
+    """random.uniform(a, b) -> b: delay luôn bằng trần của khoảng jitter."""
+    monkeypatch.setattr(retry_policy.random, 'uniform', lambda a, b: b)
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("1.5", 1.5), ("1s", 1.0), ("250ms", 0.25), ("6m0s", 360.0), ("1h2m", 3720.0), ("soon", None), (None, None),
+])
+def test_parse_duration(value, expected):
+    assert _parse_duration(value) == expected
+
+
+def test_retry_after_ms_takes_precedence():
+    error = _http_error(429, {'retry-after-ms': '1500', 'retry-after': '30'})
+    assert get_retry_after_seconds(error) == 1.5
+
+
+def test_retry_after_seconds_and_http_date():
+    assert get_retry_after_seconds(_http_error(503, {'retry-after': '7'})) == 7.0
+    retry_at = email.utils.formatdate(time.time() + 20, usegmt=True)
+    assert 15 <= get_retry_after_seconds(_http_error(503, {'retry-after': retry_at})) <= 20
+
+
+def test_openai_reset_headers_use_longest_wait():
+    error = _http_error(429, {'x-ratelimit-reset-requests': '2s', 'x-ratelimit-reset-tokens': '6m0s'})
+    assert get_retry_after_seconds(error) == 360.0
+
+
+def test_openrouter_reset_epoch_in_milliseconds():
+    reset_ms = str(int((time.time() + 10) * 1000))
+    assert 8 <= get_retry_after_seconds(_http_error(429, {'x-ratelimit-reset': reset_ms})) <= 10
+
+
+def test_no_retry_after_without_response():
+    assert get_retry_after_seconds(requests.exceptions.ConnectionError("reset")) is None
+    assert get_retry_after_seconds(_http_error(500)) is None
+
+
+@pytest.mark.parametrize("error, expected", [
+    (_http_error(429), True),
+    (_http_error(503), True),
+    (_http_error(400), False),
+    (_http_error(401), False),
+    (requests.exceptions.ConnectionError("reset"), True),
+    (requests.exceptions.Timeout("slow"), True),
+    (requests.exceptions.MissingSchema("no scheme"), False),
+    (json.JSONDecodeError("bad", "{", 0), True),
+])
+def test_is_retriable_error(error, expected):
+    assert is_retriable_error(error) is expected
+
+
+def test_backoff_is_capped_exponential(max_jitter):
+    policy = RetryPolicy(max_attempts=10, base_delay=2, max_delay=10, deadline=1000)
+    delays = [policy.next_delay(requests.exceptions.ConnectionError("reset")) for _ in range(5)]
+    assert delays == [2, 4, 8, 10, 10]
+
+
+def test_full_jitter_stays_within_cap():
+    policy = RetryPolicy(max_attempts=100, base_delay=1, max_delay=5, deadline=1000)
+    for _ in range(50):
+        assert 0 <= policy.next_delay() <= 5
+
+
+def test_retry_after_overrides_backoff_and_is_capped(max_jitter):
+    policy = RetryPolicy(max_attempts=5, base_delay=0.5, max_delay=10, deadline=1000, max_retry_after=60)
+    assert policy.next_delay(_http_error(429, {'retry-after': '12'})) == 12.5
+    assert policy.next_delay(_http_error(429, {'retry-after': '600'})) == 60.5
+
+
+def test_stops_after_max_attempts():
+    policy = RetryPolicy(max_attempts=3, base_delay=0, deadline=1000)
+    assert policy.next_delay() is not None
+    assert policy.next_delay() is not None
+    assert policy.next_delay() is None
+
+
+def test_non_retriable_error_stops_immediately():
+    policy = RetryPolicy(max_attempts=5, base_delay=0, deadline=1000)
+    assert policy.next_delay(_http_error(404)) is None
+    assert policy.attempt == 1
+
+
+def test_gives_up_when_delay_exceeds_deadline(max_jitter):
+    policy = RetryPolicy(max_attempts=5, base_delay=1, deadline=1000)
+    assert policy.next_delay(_http_error(429, {'retry-after': '5'})) is not None
+    policy.deadline = 3
+    assert policy.next_delay(_http_error(429, {'retry-after': '5'})) is None
+
+
+def test_request_timeout_is_bounded_by_remaining_time():
+    policy = RetryPolicy(deadline=1000)
+    assert policy.request_timeout(30) == 30
+    policy.deadline = 0
+    assert policy.request_timeout(30) == 1.0
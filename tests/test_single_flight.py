@@ -0,0 +1,116 @@
+# tests/test_single_flight.py
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from utils.single_flight import AsyncSingleFlight, SingleFlight, make_request_key
+
+
+def test_request_key_ignores_dict_order():
+    assert make_request_key("m", {"a": 1, "b": 2}) == make_request_key("m", {"b": 2, "a": 1})
+    assert make_request_key("m", [1, 2]) != make_request_key("m", [2, 1])
+
+
+def _run_concurrently(single_flight, fn, callers):
+    """Chạy `callers` lời gọi cùng key song song; fn chỉ trả về khi mọi caller đã vào do()."""
+    with ThreadPoolExecutor(max_workers=callers) as pool:
+        futures = [pool.submit(single_flight.do, "key", fn) for _ in range(callers)]
+    return [future.exception() or future.result() for future in futures]
+
+
+def _wait_for_waiters(single_flight, count):
+    for _ in range(500):
+        with single_flight._lock:
+            calls = list(single_flight._calls.values())
+        if calls and calls[0].waiters == count:
+            return
+        threading.Event().wait(0.01)
+
+
+def test_concurrent_identical_calls_execute_once_and_get_copies():
+    single_flight = SingleFlight("test")
+    executions = []
+
+    def fn():
+        executions.append(1)
+        _wait_for_waiters(single_flight, 3)
+        return {"items": [1, 2]}
+
+    results = _run_concurrently(single_flight, fn, 4)
+    assert len(executions) == 1
+    assert (single_flight.executed, single_flight.coalesced) == (1, 3)
+    assert all(result == {"items": [1, 2]} for result in results)
+    results[0]["items"].append(3)
+    assert sum(result["items"] == [1, 2] for result in results) == 3 # Mỗi follower nhận một bản copy riêng
+
+
+def test_error_is_raised_to_every_caller():
+    single_flight = SingleFlight("test")
+
+    def fn():
+        _wait_for_waiters(single_flight, 2)
+        raise RuntimeError("boom")
+
+    results = _run_concurrently(single_flight, fn, 3)
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_sequential_calls_are_not_cached():
+    single_flight = SingleFlight("test")
+    assert single_flight.do("key", lambda: 1) == 1
+    assert single_flight.do("key", lambda: 2) == 2
+    assert (single_flight.executed, single_flight.coalesced) == (2, 0)
+
+
+def test_async_callers_share_one_execution():
+    single_flight = AsyncSingleFlight("test")
+    executions = []
+
+    async def fetch():
+        executions.append(1)
+        await asyncio.sleep(0.05)
+        return ["result"]
+
+    async def main():
+        return await asyncio.gather(*(single_flight.do("key", fetch) for _ in range(3)))
+
+    results = asyncio.run(main())
+    assert results == [["result"]] * 3
+    assert len(executions) == 1
+    assert (single_flight.executed, single_flight.coalesced) == (1, 2)
+    assert single_flight._tasks == {}
+
+
+def test_cancelled_async_caller_does_not_cancel_shared_call():
+    single_flight = AsyncSingleFlight("test")
+
+    async def fetch():
+        await asyncio.sleep(0.1)
+        return "done"
+
+    async def main():
+        first = asyncio.ensure_future(single_flight.do("key", fetch))
+        second = asyncio.ensure_future(single_flight.do("key", fetch))
+        await asyncio.sleep(0.01)
+        first.cancel() # vd: caller là request hedge bị thua
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == "done"
+
+
+def test_async_error_propagates_to_followers():
+    single_flight = AsyncSingleFlight("test")
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise ValueError("bad response")
+
+    async def main():
+        return await asyncio.gather(*(single_flight.do("key", fetch) for _ in range(2)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
@@ -0,0 +1,72 @@
+# tests/test_task_graph.py
+import threading
+
+import pytest
+
+from utils.task_graph import GraphTask, run_task_graph
+
+
+def test_task_receives_results_of_its_dependencies():
+    tasks = [
+        GraphTask("outline", lambda deps: ["intro", "body"]),
+        GraphTask("keywords", lambda deps: {"kw": 1}),
+        GraphTask("sections", lambda deps: (deps["outline"], deps["keywords"]), deps=["outline", "keywords"]),
+    ]
+    results, timings = run_task_graph(tasks)
+    assert results["sections"] == (["intro", "body"], {"kw": 1})
+    assert set(timings) == {"outline", "keywords", "sections"}
+
+
+def test_dependent_task_starts_only_after_its_dependencies_finish():
+    order = []
+    lock = threading.Lock()
+
+    def record(name):
+        def fn(deps):
+            with lock:
+                order.append(name)
+            return name
+        return fn
+
+    tasks = [
+        GraphTask("c", record("c"), deps=["b"]),
+        GraphTask("b", record("b"), deps=["a"]),
+        GraphTask("a", record("a")),
+    ]
+    run_task_graph(tasks)
+    assert order == ["a", "b", "c"]
+
+
+def test_independent_tasks_run_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+
+    def wait_for_sibling(deps):
+        barrier.wait() # Chỉ qua được khi cả hai task chạy cùng lúc
+        return True
+
+    tasks = [GraphTask("images", wait_for_sibling), GraphTask("videos", wait_for_sibling)]
+    results, _ = run_task_graph(tasks, max_workers=2)
+    assert results == {"images": True, "videos": True}
+
+
+def test_failed_task_yields_none_and_dependents_still_run():
+    def fail(deps):
+        raise RuntimeError("serp down")
+
+    tasks = [
+        GraphTask("serp", fail),
+        GraphTask("outline", lambda deps: deps["serp"] is None, deps=["serp"]),
+    ]
+    results, _ = run_task_graph(tasks)
+    assert results == {"serp": None, "outline": True}
+
+
+def test_unknown_dependency_is_rejected():
+    with pytest.raises(ValueError, match="unknown task"):
+        run_task_graph([GraphTask("a", lambda deps: 1, deps=["missing"])])
+
+
+def test_cycle_is_rejected():
+    tasks = [GraphTask("a", lambda deps: 1, deps=["b"]), GraphTask("b", lambda deps: 2, deps=["a"])]
+    with pytest.raises(ValueError, match="cycle"):
+        run_task_graph(tasks)
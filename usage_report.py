@@ -0,0 +1,95 @@
+# usage_report.py
+"""
+Tổng hợp usage LLM/embedding/DALL-E qua nhiều lần chạy từ các file summary JSON
+do utils/usage_ledger.py ghi (mặc định: logs/usage/<run_id>.json).
+
+Xếp hạng call site (hoặc model) theo tổng token, tổng thời gian hoặc chi phí ước lượng,
+kèm tỉ lệ token prompt được provider cache (cache%) để kiểm tra hiệu quả prompt caching:
+    python usage_report.py
+    python usage_report.py --sort seconds --last 20
+    python usage_report.py --group-by model --dir logs/usage
+"""
+import argparse
+import glob
+import json
+import os
+
+SORT_KEYS = {'tokens': 'total_tokens', 'seconds': 'wall_sec', 'cost': 'cost_usd', 'calls': 'calls'}
+SUMMED_FIELDS = ['calls', 'errors', 'cancelled', 'cache_hits', 'prompt_tokens', 'completion_tokens', 'cached_tokens',
+                 'total_tokens', 'images', 'wall_sec', 'cost_usd']
+
+
+def load_run_summaries(usage_dir, last_n=None):
+    """Đọc các file summary, sắp theo thời gian sửa đổi (cũ -> mới). last_n: chỉ lấy N lần chạy gần nhất."""
+    paths = sorted(glob.glob(os.path.join(usage_dir, "*.json")), key=os.path.getmtime)
+    if last_n:
+        paths = paths[-last_n:]
+    summaries = []
+    for path in paths:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                summaries.append(json.load(f))
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Skipping unreadable usage summary {path}: {e}")
+    return summaries
+
+
+def aggregate(summaries, group_by='call_site'):
+    """Cộng dồn totals theo call site hoặc model qua các lần chạy."""
+    group_field = 'by_call_site' if group_by == 'call_site' else 'by_model'
+    groups = {}
+    for summary in summaries:
+        for name, totals in summary.get(group_field, {}).items():
+            group = groups.setdefault(name, {field: 0 for field in SUMMED_FIELDS})
+            group.setdefault('runs', 0)
+            group['runs'] += 1
+            for field in SUMMED_FIELDS:
+                group[field] += totals.get(field, 0)
+    return groups
+
+
+def print_report(groups, num_runs, sort_by='tokens', group_by='call_site'):
+    sort_key = SORT_KEYS[sort_by]
+    ranked = sorted(groups.items(), key=lambda item: item[1][sort_key], reverse=True)
+    total_tokens = sum(group['total_tokens'] for group in groups.values())
+    total_seconds = sum(group['wall_sec'] for group in groups.values())
+    total_cost = sum(group['cost_usd'] for group in groups.values())
+    grand_tokens = total_tokens or 1 # Tránh chia cho 0 khi tính phần trăm
+    grand_seconds = total_seconds or 1.0
+
+    print(f"LLM usage across {num_runs} run(s), grouped by {group_by}, sorted by {sort_by}:")
+    header = f"{'#':>3}  {group_by:<24} {'calls':>7} {'err':>5} {'hits':>5} {'tokens':>11} {'tok%':>6} {'cached':>9} {'cache%':>6} {'seconds':>9} {'sec%':>6} {'cost $':>9} {'s/call':>7}"
+    print(header)
+    print("-" * len(header))
+    for rank, (name, group) in enumerate(ranked, start=1):
+        sec_per_call = group['wall_sec'] / group['calls'] if group['calls'] else 0.0
+        cached_pct = 100.0 * group['cached_tokens'] / group['prompt_tokens'] if group['prompt_tokens'] else 0.0
+        print(f"{rank:>3}  {name[:24]:<24} {group['calls']:>7} {group['errors']:>5} {group['cache_hits']:>5} "
+              f"{group['total_tokens']:>11} {100.0 * group['total_tokens'] / grand_tokens:>5.1f}% "
+              f"{group['cached_tokens']:>9} {cached_pct:>5.1f}% {group['wall_sec']:>9.1f} {100.0 * group['wall_sec'] / grand_seconds:>5.1f}% "
+              f"{group['cost_usd']:>9.4f} {sec_per_call:>7.2f}")
+    print("-" * len(header))
+    total_prompt = sum(group['prompt_tokens'] for group in groups.values())
+    total_cached = sum(group['cached_tokens'] for group in groups.values())
+    print(f"Total: {total_tokens} tokens, {total_seconds:.1f}s, ~${total_cost:.4f} (~${total_cost / max(1, num_runs):.4f} per run)")
+    print(f"Prompt cache: {total_cached}/{total_prompt} prompt tokens served from provider cache "
+          f"({100.0 * total_cached / (total_prompt or 1):.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rank LLM call sites by tokens, time and cost across runs.")
+    parser.add_argument("--dir", type=str, default="logs/usage", help="Directory with per-run usage summaries.")
+    parser.add_argument("--sort", choices=sorted(SORT_KEYS), default="tokens", help="Ranking metric.")
+    parser.add_argument("--group-by", choices=["call_site", "model"], default="call_site")
+    parser.add_argument("--last", type=int, default=None, help="Only include the N most recent runs.")
+    args = parser.parse_args()
+
+    summaries = load_run_summaries(args.dir, args.last)
+    if not summaries:
+        print(f"No usage summaries found in '{args.dir}'.")
+        return
+    print_report(aggregate(summaries, args.group_by), len(summaries), args.sort, args.group_by)
+
+
+if __name__ == "__main__":
+    main()
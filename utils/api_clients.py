@@ -4,8 +4,21 @@ import time
 import json
 import logging
 import re # Thêm thư viện regex để trích xuất YouTube ID
-from openai import OpenAI # Thư viện OpenAI chính thức
+import threading
+import asyncio
+import importlib.util
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient, BadRequestError # Thư viện OpenAI chính thức
 from googleapiclient.discovery import build # Thư viện Google API
+from utils.llm_cache import get_llm_cache, make_llm_cache_key
+from utils.rate_limiter import get_rate_limiter
+from utils.token_counter import count_tokens, count_chat_tokens, CHARS_PER_TOKEN_FALLBACK
+from utils.retry_policy import RetryPolicy
+from utils.model_router import get_model_router
+from utils.usage_ledger import record_usage, extract_usage_tokens
+from utils.provider_pool import get_provider_key_pool
+from utils.single_flight import SingleFlight, AsyncSingleFlight, make_request_key, log_single_flight_stats
+from utils.json_repair import parse_json_with_repair, validate_json_schema, build_structured_output_format, record_json_outcome
 # Giả sử APP_CONFIG được load từ một module config_loader
 # from utils.config_loader import APP_CONFIG
 # Hoặc bạn có thể truyền config vào từng hàm/class
@@ -15,139 +28,807 @@ logger = logging.getLogger(__name__)
 
 # --- OpenAI Client Functions ---
 
-# Nên khởi tạo OpenAI client một lần và tái sử dụng nếu có thể
-# Tuy nhiên, để đơn giản, chúng ta có thể khởi tạo trong hàm hoặc truyền vào
-# openai_client = OpenAI(api_key=APP_CONFIG.get('OPENAI_API_KEY'))
+# Registry client dùng chung cho toàn process, key là (base_url, api_key).
+# Mỗi client giữ một httpx connection pool riêng, nhờ đó các lần gọi LLM liên tiếp
+# tái sử dụng kết nối keep-alive thay vì bắt tay TLS lại từ đầu.
+_llm_client_registry = {}
+_llm_async_client_registry = {} # Chỉ được truy cập từ event loop LLM
+_llm_client_registry_lock = threading.Lock()
+_llm_client_pool_settings = {
+    'max_connections': 20,
+    'max_keepalive_connections': 10,
+    'keepalive_expiry': 60.0,
+    'http2': True,
+}
+_http2_unavailable_warned = False
+
+# Giới hạn số request đồng thời cho mỗi model (semaphore theo model)
+_llm_concurrency_settings = {
+    'default': 4,
+    'per_model': {},
+}
+_llm_model_semaphores = {} # Chỉ được truy cập từ event loop LLM
+
+# Timeout cho mỗi request LLM và tổng thời gian tối đa (kể cả retry) cho một lời gọi
+_llm_request_settings = {
+    'timeout': 300.0,
+    'retry_deadline': 600.0,
+    'structured_output_models': set(), # Model hỗ trợ response_format "json_schema"
+    'context_windows': {}, # Context window (token) theo model
+    'default_context_window': 128000,
+}
+# Token output ước lượng cho request bị hủy giữa chừng khi không có max_tokens hay rate limiter
+_CANCELLED_COMPLETION_TOKENS_ESTIMATE = 800
+# Model đã từ chối response_format "json_schema" trong process này: các lời gọi sau dùng thẳng "json_object"
+_structured_output_rejected_models = set() # Chỉ được truy cập từ event loop LLM
+
+# Gộp các request giống hệt nhau đang chạy đồng thời (LLM: trên event loop LLM; search: giữa các thread)
+_llm_single_flight = AsyncSingleFlight("llm_chat")
+_search_single_flight = SingleFlight("search")
+
+# Event loop nền dùng chung cho mọi lời gọi LLM (sync lẫn async).
+# Các AsyncOpenAI client và semaphore đều gắn với loop này.
+_llm_event_loop = None
+_llm_event_loop_thread = None
+_llm_event_loop_lock = threading.Lock()
+
+def configure_llm_client_pool(config):
+    """
+    Cập nhật cấu hình connection pool và giới hạn đồng thời cho các LLM client từ config.
+    Các client đã tạo trước đó sẽ được đóng để lần gọi sau dùng cấu hình mới.
+    """
+    _llm_client_pool_settings['max_connections'] = int(config.get('LLM_HTTP_MAX_CONNECTIONS', _llm_client_pool_settings['max_connections']))
+    _llm_client_pool_settings['max_keepalive_connections'] = int(config.get('LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS', _llm_client_pool_settings['max_keepalive_connections']))
+    _llm_client_pool_settings['keepalive_expiry'] = float(config.get('LLM_HTTP_KEEPALIVE_EXPIRY', _llm_client_pool_settings['keepalive_expiry']))
+    _llm_client_pool_settings['http2'] = bool(config.get('LLM_HTTP2_ENABLED', _llm_client_pool_settings['http2']))
+    _llm_concurrency_settings['default'] = max(1, int(config.get('LLM_MAX_CONCURRENT_REQUESTS_PER_MODEL', _llm_concurrency_settings['default'])))
+    _llm_concurrency_settings['per_model'] = dict(config.get('LLM_MODEL_CONCURRENCY_LIMITS') or {})
+    _llm_request_settings['timeout'] = float(config.get('LLM_REQUEST_TIMEOUT_SEC', _llm_request_settings['timeout']))
+    _llm_request_settings['retry_deadline'] = float(config.get('LLM_RETRY_DEADLINE_SEC', _llm_request_settings['retry_deadline']))
+    _llm_request_settings['structured_output_models'] = set(config.get('LLM_STRUCTURED_OUTPUT_MODELS') or [])
+    _llm_request_settings['context_windows'] = dict(config.get('LLM_CONTEXT_WINDOWS') or {})
+    _llm_request_settings['default_context_window'] = int(config.get('LLM_DEFAULT_CONTEXT_WINDOW', _llm_request_settings['default_context_window']))
+    close_llm_clients()
+    logger.info(f"LLM client pool configured: {_llm_client_pool_settings}. Concurrency per model: {_llm_concurrency_settings}")
+
+def _resolve_http2_setting():
+    """HTTP/2 chỉ bật được khi có package 'h2'."""
+    global _http2_unavailable_warned
+    use_http2 = _llm_client_pool_settings['http2']
+    if use_http2 and importlib.util.find_spec('h2') is None:
+        if not _http2_unavailable_warned:
+            logger.warning("HTTP/2 is enabled for LLM clients but the 'h2' package is not installed. Falling back to HTTP/1.1.")
+            _http2_unavailable_warned = True
+        use_http2 = False
+    return use_http2
+
+def _build_llm_http_limits():
+    return httpx.Limits(
+        max_connections=_llm_client_pool_settings['max_connections'],
+        max_keepalive_connections=_llm_client_pool_settings['max_keepalive_connections'],
+        keepalive_expiry=_llm_client_pool_settings['keepalive_expiry']
+    )
+
+def _build_llm_http_client():
+    """Tạo httpx client với giới hạn keep-alive và HTTP/2 (nếu có package 'h2')."""
+    return DefaultHttpxClient(limits=_build_llm_http_limits(), http2=_resolve_http2_setting())
+
+def get_llm_client(api_key, base_url=None):
+    """
+    Trả về OpenAI client dùng chung cho cặp (base_url, api_key), tạo mới nếu chưa có.
+    base_url=None nghĩa là gọi trực tiếp OpenAI.
+    """
+    if not api_key:
+        logger.error(f"API key is not configured for LLM endpoint: {base_url or 'openai'}.")
+        raise ValueError("LLM API key is missing.")
+    registry_key = (base_url, api_key)
+    with _llm_client_registry_lock:
+        client = _llm_client_registry.get(registry_key)
+        if client is None:
+            # max_retries=0: việc retry do RetryPolicy đảm nhiệm, tránh SDK retry chồng lên
+            client = OpenAI(api_key=api_key, base_url=base_url, max_retries=0, http_client=_build_llm_http_client())
+            _llm_client_registry[registry_key] = client
+            logger.info(f"Created pooled LLM client for endpoint: {base_url or 'openai'} (registry size: {len(_llm_client_registry)})")
+    return client
+
+def get_async_llm_client(api_key, base_url=None):
+    """
+    Phiên bản AsyncOpenAI của get_llm_client. Phải được gọi từ event loop LLM
+    (client async gắn với loop đã tạo ra nó).
+    """
+    if not api_key:
+        logger.error(f"API key is not configured for LLM endpoint: {base_url or 'openai'}.")
+        raise ValueError("LLM API key is missing.")
+    registry_key = (base_url, api_key)
+    with _llm_client_registry_lock:
+        client = _llm_async_client_registry.get(registry_key)
+        if client is None:
+            client = AsyncOpenAI(
+                api_key=api_key, base_url=base_url, max_retries=0,
+                http_client=DefaultAsyncHttpxClient(limits=_build_llm_http_limits(), http2=_resolve_http2_setting())
+            )
+            _llm_async_client_registry[registry_key] = client
+            logger.info(f"Created pooled async LLM client for endpoint: {base_url or 'openai'} (registry size: {len(_llm_async_client_registry)})")
+    return client
+
+def close_llm_clients():
+    """Đóng toàn bộ client trong registry (giải phóng connection pool)."""
+    with _llm_client_registry_lock:
+        clients = list(_llm_client_registry.values())
+        async_clients = list(_llm_async_client_registry.values())
+        _llm_client_registry.clear()
+        _llm_async_client_registry.clear()
+    for client in clients:
+        try:
+            client.close()
+        except Exception as e:
+            logger.debug(f"Error closing pooled LLM client: {e}")
+    if _llm_event_loop is not None and _llm_event_loop.is_running():
+        # Semaphore thuộc event loop LLM: reset trên chính loop đó để không chạy song song với acquire đang dở
+        async def _close_async_clients():
+            _llm_model_semaphores.clear()
+            for async_client in async_clients:
+                try:
+                    await async_client.close()
+                except Exception as e:
+                    logger.debug(f"Error closing pooled async LLM client: {e}")
+        try:
+            asyncio.run_coroutine_threadsafe(_close_async_clients(), _llm_event_loop).result(timeout=10)
+        except Exception as e:
+            logger.debug(f"Error closing async LLM clients: {e}")
+    else:
+        _llm_model_semaphores.clear() # Loop chưa chạy: không có coroutine nào đang dùng semaphore
 
 def get_openai_client(api_key):
-    """Helper function to get an OpenAI client instance."""
+    """Helper function to get an OpenAI client instance (dùng chung qua registry)."""
     if not api_key:
         logger.error("OpenAI API key is not configured.")
         raise ValueError("OpenAI API key is missing.")
-    return OpenAI(api_key=api_key)
+    return get_llm_client(api_key)
 
-def call_openai_chat(prompt_messages, 
-                     model_name, 
-                     api_key, # Đây là OpenAI API key gốc, dùng khi target_api="openai"
-                     is_json_output=False, 
-                     max_retries=3, 
-                     retry_delay=5,
-                     target_api="openai", # "openai" hoặc "openrouter"
-                     openrouter_api_key=None,
-                     openrouter_base_url=None):
+def _get_llm_event_loop():
+    """Khởi động (một lần) event loop nền chạy trên daemon thread riêng."""
+    global _llm_event_loop, _llm_event_loop_thread
+    with _llm_event_loop_lock:
+        if _llm_event_loop is None or not _llm_event_loop_thread.is_alive():
+            _llm_event_loop = asyncio.new_event_loop()
+            _llm_event_loop_thread = threading.Thread(
+                target=_llm_event_loop.run_forever, name="llm-event-loop", daemon=True
+            )
+            _llm_event_loop_thread.start()
+            logger.debug("Started background event loop for LLM calls.")
+    return _llm_event_loop
+
+def run_llm_coroutine(coro):
     """
-    Gửi request đến API chat của OpenAI hoặc OpenRouter.
-    prompt_messages: list of message objects, e.g., [{"role": "user", "content": "Hello"}]
-    is_json_output: Nếu True, yêu cầu OpenAI trả về JSON và cố gắng parse.
-    target_api: "openai" để gọi trực tiếp OpenAI, "openrouter" để gọi qua OpenRouter.
-    openrouter_api_key: API key cho OpenRouter (chỉ dùng khi target_api="openrouter").
-    openrouter_base_url: Base URL cho OpenRouter (chỉ dùng khi target_api="openrouter").
+    Chạy một coroutine LLM trên event loop nền và chờ kết quả (dùng từ code sync).
+    Không được gọi từ bên trong event loop LLM (sẽ bị deadlock) - khi đó hãy await trực tiếp.
+    """
+    loop = _get_llm_event_loop()
+    if threading.current_thread() is _llm_event_loop_thread:
+        coro.close()
+        raise RuntimeError("run_llm_coroutine() cannot be called from the LLM event loop. Await the coroutine instead.")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+def _get_model_semaphore(model_name):
+    semaphore = _llm_model_semaphores.get(model_name)
+    if semaphore is None:
+        limit = int(_llm_concurrency_settings['per_model'].get(model_name, _llm_concurrency_settings['default']))
+        semaphore = asyncio.Semaphore(max(1, limit))
+        _llm_model_semaphores[model_name] = semaphore
+    return semaphore
+
+# Thống kê streaming theo model: time-to-first-token và tốc độ sinh token
+_llm_stream_metrics = {}
+_llm_stream_metrics_lock = threading.Lock()
+
+# Điểm cắt an toàn khi dừng stream sớm: sau thẻ đóng block HTML hoặc đoạn Markdown
+_BLOCK_BOUNDARY_RE = re.compile(r'(</(?:p|ul|ol|li|table|div|h[1-6]|blockquote|section)>|\n\s*\n)', re.IGNORECASE)
+
+def _truncate_to_last_block(text):
+    """Cắt text tại ranh giới block cuối cùng để không trả về HTML/Markdown bị đứt giữa chừng."""
+    last_end = None
+    for match in _BLOCK_BOUNDARY_RE.finditer(text):
+        last_end = match.end()
+    return text[:last_end].rstrip() if last_end else text
+
+def _record_stream_metrics(model_name, ttft_sec, completion_tokens, generation_sec, aborted):
+    with _llm_stream_metrics_lock:
+        metrics = _llm_stream_metrics.setdefault(model_name, {
+            'calls': 0, 'aborted': 0, 'ttft_total_sec': 0.0, 'ttft_max_sec': 0.0,
+            'completion_tokens': 0, 'generation_sec': 0.0
+        })
+        metrics['calls'] += 1
+        metrics['aborted'] += 1 if aborted else 0
+        metrics['ttft_total_sec'] += ttft_sec
+        metrics['ttft_max_sec'] = max(metrics['ttft_max_sec'], ttft_sec)
+        metrics['completion_tokens'] += completion_tokens
+        metrics['generation_sec'] += generation_sec
+
+def get_llm_stream_metrics():
+    """Trả về thống kê streaming theo model (TTFT trung bình/lớn nhất, tokens/sec, số lần bị dừng sớm)."""
+    with _llm_stream_metrics_lock:
+        summary = {}
+        for model_name, metrics in _llm_stream_metrics.items():
+            summary[model_name] = {
+                'calls': metrics['calls'],
+                'aborted': metrics['aborted'],
+                'avg_ttft_sec': metrics['ttft_total_sec'] / metrics['calls'] if metrics['calls'] else 0.0,
+                'max_ttft_sec': metrics['ttft_max_sec'],
+                'tokens_per_sec': metrics['completion_tokens'] / metrics['generation_sec'] if metrics['generation_sec'] > 0 else 0.0,
+            }
+        return summary
+
+def log_llm_stream_metrics():
+    """Ghi log thống kê streaming theo model (gọi ở cuối mỗi lần chạy)."""
+    summary = get_llm_stream_metrics()
+    for model_name, metrics in sorted(summary.items()):
+        logger.info(f"LLM stream stats [{model_name}]: calls={metrics['calls']}, aborted={metrics['aborted']}, "
+                    f"avg TTFT={metrics['avg_ttft_sec']:.2f}s, max TTFT={metrics['max_ttft_sec']:.2f}s, "
+                    f"{metrics['tokens_per_sec']:.1f} tokens/s")
+    return summary
+
+async def _consume_chat_stream(client, request_params, model_name, max_output_words=None, max_output_tokens=None):
+    """
+    Gọi chat completion ở chế độ stream và đọc từng chunk.
+    Dừng stream sớm khi số từ vượt max_output_words hoặc số token (ước lượng) vượt max_output_tokens.
+    Trả về (content, aborted, usage) - usage là None nếu stream bị dừng trước chunk usage cuối cùng.
+    """
+    started_at = time.perf_counter()
+    first_token_at = None
+    parts = []
+    total_chars = 0
+    word_count = 0
+    previous_was_space = True
+    usage = None
+    aborted = False
+    completed = False
+
+    stream = await client.chat.completions.create(**request_params, stream=True, stream_options={"include_usage": True})
+    try:
+        async for chunk in stream:
+            if getattr(chunk, 'usage', None):
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            if chunk.choices[0].finish_reason == "length":
+                aborted = True # Provider đã dừng ở max_tokens -> output bị cắt giống như khi dừng sớm
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            parts.append(delta)
+            total_chars += len(delta)
+            # Đếm số từ tăng dần (từ bị cắt giữa hai chunk chỉ được đếm một lần)
+            for char in delta:
+                is_space = char.isspace()
+                if previous_was_space and not is_space:
+                    word_count += 1
+                previous_was_space = is_space
+
+            if max_output_words and word_count > max_output_words:
+                logger.warning(f"Aborting LLM stream ({model_name}): {word_count} words exceeds limit of {max_output_words}.")
+                aborted = True
+                break
+            if max_output_tokens and total_chars // CHARS_PER_TOKEN_FALLBACK > max_output_tokens:
+                logger.warning(f"Aborting LLM stream ({model_name}): ~{total_chars // CHARS_PER_TOKEN_FALLBACK} tokens exceeds hard cap of {max_output_tokens}.")
+                aborted = True
+                break
+        else:
+            completed = True
+    finally:
+        if not completed:
+            # Dừng sớm, lỗi đọc stream hoặc task bị hủy (hedge thua): đóng kết nối để provider ngừng sinh
+            # (và ngừng tính phí) token
+            try:
+                await stream.close()
+            except Exception as e:
+                logger.debug(f"Error closing LLM stream ({model_name}): {e}")
+
+    content = "".join(parts)
+    finished_at = time.perf_counter()
+    ttft_sec = (first_token_at or finished_at) - started_at
+    generation_sec = finished_at - (first_token_at or finished_at)
+    completion_tokens = usage.completion_tokens if usage and usage.completion_tokens else count_tokens(content, model_name)
+    _record_stream_metrics(model_name, ttft_sec, completion_tokens, generation_sec, aborted)
+    tokens_per_sec = completion_tokens / generation_sec if generation_sec > 0 else 0.0
+    logger.info(f"LLM stream finished ({model_name}): TTFT {ttft_sec:.2f}s, {completion_tokens} tokens in {generation_sec:.2f}s "
+                f"({tokens_per_sec:.1f} tokens/s){' [aborted]' if aborted else ''}.")
+    return content, aborted, usage
+
+def _record_chat_usage(model_name, call_site, started_at, usage=None, prompt_messages=None, content=None, success=True,
+                       cancelled=False, completion_tokens_estimate=0, provider=None):
+    """
+    Ghi usage của một request chat vào ledger của lần chạy (ước lượng token nếu provider không trả usage).
+    model_name/provider: model và provider thực sự nhận request (sau khi key pool thay model), để tính đúng giá.
+    cancelled: request bị hủy giữa chừng - provider vẫn tính phí prompt và phần output đã sinh, nên ghi
+    số token prompt đếm được + completion_tokens_estimate.
+    Trả về tổng số token (prompt + completion) đã ghi.
+    """
+    prompt_tokens, completion_tokens, cached_tokens = extract_usage_tokens(usage)
+    if usage is None and success: # Stream bị dừng sớm -> không có chunk usage
+        prompt_tokens = count_chat_tokens(prompt_messages, model_name)
+        completion_tokens = count_tokens(content, model_name)
+    elif usage is None and cancelled:
+        prompt_tokens = count_chat_tokens(prompt_messages, model_name)
+        completion_tokens = int(completion_tokens_estimate or 0)
+    record_usage('chat', model_name, call_site=call_site, wall_sec=time.perf_counter() - started_at,
+                 prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, cached_tokens=cached_tokens,
+                 success=success, cancelled=cancelled, provider=provider)
+    return prompt_tokens + completion_tokens
+
+async def _call_openai_chat_single_async(prompt_messages, 
+                                 model_name, 
+                                 api_key, # Đây là OpenAI API key gốc, dùng khi target_api="openai"
+                                 is_json_output=False, 
+                                 max_retries=3, 
+                                 retry_delay=5,
+                                 target_api="openai", # "openai" hoặc "openrouter"
+                                 openrouter_api_key=None,
+                                 openrouter_base_url=None,
+                                 call_site=None, # Tên điểm gọi (vd: "section_content"), dùng cho TTL cache
+                                 json_schema=None, # Schema (prompts/response_schemas.py) để validate JSON trả về
+                                 stream=False, # Stream output (chỉ dùng cho text, không dùng cho JSON)
+                                 max_output_words=None, # Dừng stream khi output vượt số từ này
+                                 max_output_tokens=None, # Trần cứng số token output khi stream
+                                 stream_abort_action="truncate", # "truncate": cắt tại block cuối; "discard": trả về None
+                                 max_tokens=None): # Giới hạn token output gửi kèm request (max_tokens)
+    """
+    Gọi chat completion tới đúng một model (có retry). Xem call_openai_chat_async.
     """
-    attempt = 0
     client = None
 
     if target_api == "openrouter":
         if not openrouter_api_key or not openrouter_base_url:
             logger.error("OpenRouter API key or base URL is missing for target_api='openrouter'.")
             return None
-        client = OpenAI(api_key=openrouter_api_key, base_url=openrouter_base_url)
+        client = get_async_llm_client(openrouter_api_key, base_url=openrouter_base_url)
     else: # Mặc định hoặc target_api == "openai"
-        client = get_openai_client(api_key) # Sử dụng OpenAI API key gốc
+        if not api_key:
+            logger.error("OpenAI API key is not configured.")
+            raise ValueError("OpenAI API key is missing.")
+        client = get_async_llm_client(api_key) # Sử dụng OpenAI API key gốc
 
     if not client: # Nếu client vẫn là None (ví dụ do thiếu key cho OpenRouter)
         return None
 
-    while attempt < max_retries:
+    response_format = None
+    if is_json_output:
+        response_format = {"type": "json_object"}
+        if (json_schema and model_name in _llm_request_settings['structured_output_models']
+                and model_name not in _structured_output_rejected_models):
+            response_format = build_structured_output_format(json_schema, call_site) or response_format
+    llm_cache = get_llm_cache()
+    cache_key = None
+    if llm_cache is not None:
+        cache_key = make_llm_cache_key(model_name, prompt_messages, response_format)
+        # SQLite (timeout 30s khi process khác giữ khóa) không được chạy thẳng trên event loop LLM
+        is_hit, cached_value = await asyncio.to_thread(llm_cache.get, cache_key, call_site=call_site)
+        if is_hit:
+            logger.info(f"LLM cache hit ({call_site or 'default'}). Model: {model_name}.")
+            record_usage('chat', model_name, call_site=call_site, cache_hit=True)
+            return cached_value
+
+    semaphore = _get_model_semaphore(model_name)
+    rate_limiter = get_rate_limiter()
+    # Pool nhiều key/provider chỉ thay thế cho key OpenRouter mặc định
+    key_pool = get_provider_key_pool() if target_api == "openrouter" else None
+    default_client = client
+    # Kiểm tra prompt có vừa context window của model trước khi gửi (tránh trả tiền cho request chắc chắn lỗi)
+    prompt_tokens = count_chat_tokens(prompt_messages, model_name)
+    context_window = _llm_request_settings['context_windows'].get(model_name, _llm_request_settings['default_context_window'])
+    if prompt_tokens + (max_tokens or 0) > context_window:
+        logger.error(f"Prompt for '{call_site or 'default'}' is ~{prompt_tokens} tokens (+{max_tokens or 0} output), "
+                     f"exceeding the {context_window}-token context window of {model_name}. Not sending request.")
+        return None
+    estimated_tokens = 0
+    if rate_limiter is not None:
+        estimated_tokens = prompt_tokens + (max_tokens or rate_limiter.completion_tokens_estimate)
+
+    retry_policy = RetryPolicy(max_attempts=max_retries, base_delay=retry_delay, deadline=_llm_request_settings['retry_deadline'])
+    while True:
+        last_error = None
+        request_started_at = None
+        provider_key = None
+        request_model = model_name
+        usage_provider = target_api
+        rotate_key = False
         try:
-            logger.info(f"Calling LLM API ({target_api}). Model: {model_name}. JSON output: {is_json_output}. Attempt: {attempt + 1}")
+            client = default_client
+            if key_pool is not None:
+                provider_key = await key_pool.choose_async(model_name, estimated_tokens)
+            if provider_key is not None:
+                client = get_async_llm_client(provider_key.api_key, base_url=provider_key.base_url)
+                request_model = provider_key.resolve_model(model_name)
+                usage_provider = provider_key.provider
+            key_label = f" Key: {provider_key.name}." if provider_key is not None else ""
+            logger.info(f"Calling LLM API ({target_api}). Model: {request_model}.{key_label} JSON output: {is_json_output}. Attempt: {retry_policy.attempt + 1}")
             # logger.debug(f"Prompt messages: {prompt_messages}") # Có thể quá dài để log
 
             request_params = {
-                "model": model_name,
-                "messages": prompt_messages
+                "model": request_model,
+                "messages": prompt_messages,
+                "timeout": retry_policy.request_timeout(_llm_request_settings['timeout'])
             }
-            if is_json_output:
-                request_params["response_format"] = {"type": "json_object"}
+            if response_format:
+                request_params["response_format"] = response_format
+            if max_tokens:
+                request_params["max_tokens"] = int(max_tokens)
             
-            response = client.chat.completions.create(**request_params)
-
-            content = response.choices[0].message.content
+            if provider_key is not None: # Quota riêng của key được chọn
+                await key_pool.acquire_async(provider_key, estimated_tokens)
+            elif rate_limiter is not None: # Chờ slot RPM/TPM dùng chung giữa các process thay vì ăn lỗi 429
+                await rate_limiter.acquire_async(target_api, model_name, estimated_tokens)
+            output_truncated = False
+            async with semaphore: # Chỉ giữ slot trong lúc request đang chạy, không giữ khi chờ retry
+                request_started_at = time.perf_counter()
+                if stream and not is_json_output:
+                    content, output_truncated, usage = await _consume_chat_stream(
+                        client, request_params, model_name,
+                        max_output_words=max_output_words, max_output_tokens=max_output_tokens
+                    )
+                else:
+                    response = await client.chat.completions.create(**request_params)
+                    content = response.choices[0].message.content
+                    usage = response.usage
+                    output_truncated = response.choices[0].finish_reason == "length" and not is_json_output
+            actual_tokens = _record_chat_usage(request_model, call_site, request_started_at, usage, prompt_messages, content,
+                                               provider=usage_provider)
+            request_started_at = None # Đã ghi usage cho request này
+            # Bucket đã bị trừ theo ước lượng (prompt + max_tokens hoặc LLM_RATE_LIMIT_COMPLETION_TOKENS_ESTIMATE): trả lại/trừ thêm theo usage thật
+            if provider_key is not None:
+                await key_pool.settle_async(provider_key, estimated_tokens, actual_tokens)
+            elif rate_limiter is not None:
+                await rate_limiter.settle_async(target_api, model_name, estimated_tokens, actual_tokens)
+            if provider_key is not None:
+                key_pool.report_success(provider_key)
             logger.info(f"LLM API ({target_api}) call successful.")
 
+            if output_truncated:
+                # Output bị cắt (dừng stream sớm hoặc chạm max_tokens). Không retry: cùng prompt nhiều khả năng
+                # lại sinh quá dài, tốn thêm thời gian và tiền
+                if stream_abort_action == "discard":
+                    logger.warning(f"LLM output for '{call_site or 'default'}' overshot its limit. Discarding it.")
+                    return None
+                return _truncate_to_last_block(content)
+
             if is_json_output:
+                # Sửa lỗi JSON cục bộ trước, chỉ gọi lại LLM khi output thực sự không khôi phục được
                 try:
-                    parsed_json = json.loads(content)
-                    logger.debug("Successfully parsed JSON response from LLM.")
-                    return parsed_json
-                except json.JSONDecodeError as e:
+                    parsed_json, was_repaired = parse_json_with_repair(content)
+                except ValueError as e:
                     logger.error(f"Failed to parse JSON response from LLM ({target_api}): {e}. Raw content: {content}")
-                    if attempt + 1 >= max_retries:
+                    if retry_policy.next_delay(json.JSONDecodeError(str(e), content or "", 0), description=f"LLM API ({target_api}) JSON parsing") is None:
+                        record_json_outcome(call_site, 'failed')
                         logger.warning("Max retries reached for JSON parsing. Returning error dict.")
-                        return {"error": "JSONDecodeError", "raw_content": content, "message": f"Failed to parse JSON after {max_retries} attempts."}
-                    # Fall through to retry logic
+                        return {"error": "JSONDecodeError", "raw_content": content, "message": f"Failed to parse JSON after {retry_policy.attempt} attempts."}
+                    record_json_outcome(call_site, 'recalled')
+                    # Gọi lại ngay: response hợp lệ về mặt HTTP, chỉ là model trả JSON lỗi
+                    continue
+
+                schema_errors = validate_json_schema(parsed_json, json_schema) if json_schema else []
+                if schema_errors:
+                    logger.error(f"LLM JSON response ({call_site}) does not match expected schema: {schema_errors}")
+                    if retry_policy.next_delay(json.JSONDecodeError("schema mismatch", content or "", 0), description=f"LLM API ({target_api}) JSON schema validation") is not None:
+                        record_json_outcome(call_site, 'recalled')
+                        continue
+                    # Hết lượt: trả về JSON đã parse như trước đây, caller tự kiểm tra và fallback
+                    record_json_outcome(call_site, 'failed')
+                    logger.warning("Max retries reached for JSON schema validation. Returning last parsed JSON.")
+                    return parsed_json
+
+                if was_repaired:
+                    logger.info(f"Repaired malformed JSON response from LLM locally ({call_site or 'default'}).")
+                else:
+                    logger.debug("Successfully parsed JSON response from LLM.")
+                record_json_outcome(call_site, 'repaired' if was_repaired else 'parsed')
+                if cache_key and request_model == model_name:
+                    await asyncio.to_thread(llm_cache.set, cache_key, parsed_json, call_site=call_site, model_name=model_name)
+                return parsed_json
             else:
+                # Key cache theo model được yêu cầu: không lưu output của model khác (key pool đã thay model)
+                if cache_key and content and request_model == model_name:
+                    await asyncio.to_thread(llm_cache.set, cache_key, content, call_site=call_site, model_name=model_name)
                 return content # Trả về string nếu không yêu cầu JSON
 
+        except asyncio.CancelledError:
+            if request_started_at is not None:
+                # Bị hủy khi request đang chạy (vd: hedge thua): vẫn ghi usage ước lượng để báo cáo chi phí không bị thiếu
+                completion_estimate = max_tokens or (rate_limiter.completion_tokens_estimate if rate_limiter is not None
+                                                     else _CANCELLED_COMPLETION_TOKENS_ESTIMATE)
+                _record_chat_usage(request_model, call_site, request_started_at, prompt_messages=prompt_messages,
+                                   success=False, cancelled=True, completion_tokens_estimate=completion_estimate,
+                                   provider=usage_provider)
+            raise
         except Exception as e:
-            logger.error(f"Error calling LLM API ({target_api}) (attempt {attempt + 1}/{max_retries}): {e}")
-            attempt += 1
-            if attempt >= max_retries:
-                logger.error(f"Max retries reached for LLM API ({target_api}) call. Returning None.")
-                return None 
-            logger.info(f"Retrying in {retry_delay} seconds...")
-            time.sleep(retry_delay)
-    return None
-
-def call_openai_dalle(prompt, size, api_key, model="dall-e-3", n=1, max_retries=3, retry_delay=5):
+            logger.error(f"Error calling LLM API ({target_api}) (attempt {retry_policy.attempt + 1}/{max_retries}): {e}")
+            last_error = e
+            if request_started_at is not None:
+                _record_chat_usage(request_model, call_site, request_started_at, success=False, provider=usage_provider)
+            if provider_key is not None and key_pool.report_failure(provider_key, e):
+                # Lỗi do key (429/401/402/403...): chuyển sang key khác ngay nếu còn
+                rotate_key = key_pool.has_available_key(model_name, exclude=provider_key)
+            if isinstance(e, BadRequestError) and response_format and response_format.get("type") == "json_schema":
+                # Model/provider không nhận structured outputs -> quay về json_object và gọi lại ngay
+                logger.warning(f"Model {model_name} rejected json_schema response_format. Falling back to json_object "
+                               f"for this and later calls.")
+                _structured_output_rejected_models.add(model_name)
+                response_format = {"type": "json_object"}
+                if cache_key:
+                    # Key cache gồm response_format: lưu kết quả dưới key của định dạng thực sự được dùng
+                    cache_key = make_llm_cache_key(model_name, prompt_messages, response_format)
+                continue
+
+        if rotate_key:
+            # Không chờ Retry-After của key cũ và không bỏ cuộc vì lỗi 401/403 của riêng key đó
+            delay = retry_policy.next_delay(None, description=f"LLM API ({target_api}) call on another key")
+            delay = min(delay, 1.0) if delay is not None else None
+        else:
+            delay = retry_policy.next_delay(last_error, description=f"LLM API ({target_api}) call")
+        if delay is None:
+            logger.error(f"Giving up on LLM API ({target_api}) call. Returning None.")
+            return None
+        await asyncio.sleep(delay)
+
+def _is_failed_chat_result(result):
+    """None hoặc dict lỗi JSON -> coi như model này thất bại, có thể chuyển sang model khác."""
+    return result is None or (isinstance(result, dict) and result.get("error") == "JSONDecodeError")
+
+async def _call_chat_with_profile(router, model_name, call_kwargs):
+    """Gọi một model và ghi độ trễ/kết quả vào profile của router."""
+    started_at = time.perf_counter()
+    result = await _call_openai_chat_single_async(model_name=model_name, **call_kwargs)
+    router.record_result(model_name, time.perf_counter() - started_at, not _is_failed_chat_result(result))
+    return result
+
+async def _call_chat_hedged(router, primary_model, hedge_model, call_kwargs):
+    """
+    Gửi request tới primary_model; nếu sau p90 độ trễ của nó vẫn chưa có kết quả thì gửi thêm
+    request tới hedge_model. Kết quả hợp lệ về trước được dùng, request còn lại bị hủy.
+    Trả về (result, hedge_sent).
+    """
+    started_at = time.perf_counter()
+    primary_task = asyncio.ensure_future(_call_chat_with_profile(router, primary_model, call_kwargs))
+    hedge_delay = router.get_hedge_delay(primary_model)
+    done, _ = await asyncio.wait({primary_task}, timeout=hedge_delay)
+    if done:
+        return primary_task.result(), False
+
+    logger.info(f"Model router: {primary_model} slower than {hedge_delay:.1f}s for '{call_kwargs.get('call_site')}'. Sending hedge request to {hedge_model}.")
+    router.count('hedges_sent')
+    hedge_task = asyncio.ensure_future(_call_chat_with_profile(router, hedge_model, call_kwargs))
+    task_models = {primary_task: primary_model, hedge_task: hedge_model}
+    pending = set(task_models)
+    result = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = task.result()
+                if not _is_failed_chat_result(result):
+                    if task is hedge_task:
+                        router.count('hedges_won')
+                    logger.info(f"Model router: using response from {task_models[task]} for '{call_kwargs.get('call_site')}'.")
+                    return result, True
+        return result, True # Cả hai đều thất bại
+    finally:
+        for task in pending:
+            task.cancel()
+            router.record_cancelled(task_models[task], time.perf_counter() - started_at)
+
+async def call_openai_chat_async(prompt_messages,
+                                 model_name,
+                                 api_key,
+                                 is_json_output=False,
+                                 max_retries=3,
+                                 retry_delay=5,
+                                 target_api="openai",
+                                 openrouter_api_key=None,
+                                 openrouter_base_url=None,
+                                 call_site=None,
+                                 json_schema=None,
+                                 stream=False,
+                                 max_output_words=None,
+                                 max_output_tokens=None,
+                                 stream_abort_action="truncate",
+                                 max_tokens=None):
+    """
+    Phiên bản asyncio của call_openai_chat (dựa trên AsyncOpenAI).
+    Cùng tham số, cùng cơ chế retry và cùng giá trị trả về: string, dict JSON,
+    dict lỗi {"error": "JSONDecodeError", ...} hoặc None.
+    Số request đồng thời tới cùng một model bị giới hạn bởi semaphore theo model.
+    Khi model router được bật (chỉ áp dụng cho OpenRouter), model thất bại sẽ được thay bằng model
+    kế tiếp trong chuỗi failover của call site, và các call site trong LLM_HEDGED_CALL_SITES được hedge.
+    Các lời gọi giống hệt nhau đang chạy đồng thời được gộp thành một request (single-flight).
+    """
+    call_kwargs = dict(
+        prompt_messages=prompt_messages,
+        api_key=api_key,
+        is_json_output=is_json_output,
+        max_retries=max_retries,
+        retry_delay=retry_delay,
+        target_api=target_api,
+        openrouter_api_key=openrouter_api_key,
+        openrouter_base_url=openrouter_base_url,
+        call_site=call_site,
+        json_schema=json_schema,
+        stream=stream,
+        max_output_words=max_output_words,
+        max_output_tokens=max_output_tokens,
+        stream_abort_action=stream_abort_action,
+        max_tokens=max_tokens
+    )
+    # Các lời gọi giống hệt nhau (cùng model/messages/định dạng output) đang chạy đồng thời chỉ gửi một request
+    request_key = make_request_key(
+        target_api, model_name, prompt_messages, is_json_output, json_schema,
+        stream, max_output_words, max_output_tokens, stream_abort_action, max_tokens
+    )
+    return await _llm_single_flight.do(request_key, lambda: _call_openai_chat_routed_async(model_name, call_kwargs))
+
+async def _call_openai_chat_routed_async(model_name, call_kwargs):
+    """Gọi qua model router (failover/hedge) nếu được bật, ngược lại gọi thẳng model được yêu cầu."""
+    router = get_model_router()
+    call_site = call_kwargs.get('call_site')
+    if router is None or call_kwargs.get('target_api') != "openrouter": # Tên model trong chuỗi failover là tên model OpenRouter
+        return await _call_openai_chat_single_async(model_name=model_name, **call_kwargs)
+
+    chain = router.get_chain(call_site, model_name)
+    result = None
+    idx = 0
+    while idx < len(chain):
+        if idx > 0:
+            router.count('failovers')
+            logger.warning(f"Model router: failing over to {chain[idx]} for '{call_site or 'default'}'.")
+        if router.should_hedge(call_site) and idx + 1 < len(chain):
+            result, hedge_sent = await _call_chat_hedged(router, chain[idx], chain[idx + 1], call_kwargs)
+            idx += 2 if hedge_sent else 1 # Model hedge đã được thử thì bỏ qua trong failover
+        else:
+            result = await _call_chat_with_profile(router, chain[idx], call_kwargs)
+            idx += 1
+        if not _is_failed_chat_result(result):
+            return result
+    return result
+
+def call_openai_chat(prompt_messages, 
+                     model_name, 
+                     api_key, # Đây là OpenAI API key gốc, dùng khi target_api="openai"
+                     is_json_output=False, 
+                     max_retries=3, 
+                     retry_delay=5,
+                     target_api="openai", # "openai" hoặc "openrouter"
+                     openrouter_api_key=None,
+                     openrouter_base_url=None,
+                     call_site=None,
+                     json_schema=None,
+                     stream=False,
+                     max_output_words=None,
+                     max_output_tokens=None,
+                     stream_abort_action="truncate",
+                     max_tokens=None):
+    """
+    Gửi request đến API chat của OpenAI hoặc OpenRouter.
+    prompt_messages: list of message objects, e.g., [{"role": "user", "content": "Hello"}]
+    is_json_output: Nếu True, yêu cầu OpenAI trả về JSON và cố gắng parse.
+    target_api: "openai" để gọi trực tiếp OpenAI, "openrouter" để gọi qua OpenRouter.
+    openrouter_api_key: API key cho OpenRouter (chỉ dùng khi target_api="openrouter").
+    openrouter_base_url: Base URL cho OpenRouter (chỉ dùng khi target_api="openrouter").
+    call_site: Tên điểm gọi trong workflow, dùng để chọn TTL cache (LLM_CACHE_TTLS).
+    json_schema: Nếu có (khi is_json_output=True), JSON trả về phải khớp schema; model trong
+                 LLM_STRUCTURED_OUTPUT_MODELS sẽ nhận schema qua response_format "json_schema".
+    stream: Nếu True (và không phải JSON), đọc output dạng stream, ghi nhận TTFT/tokens per sec và
+            dừng sớm khi vượt max_output_words/max_output_tokens (xử lý theo stream_abort_action).
+    max_tokens: Giới hạn token output phía provider. Output bị cắt ở max_tokens (finish_reason "length")
+                được xử lý như khi dừng stream sớm (theo stream_abort_action).
+    Prompt vượt context window của model (LLM_CONTEXT_WINDOWS) sẽ không được gửi đi (trả về None).
+    Wrapper sync mỏng quanh call_openai_chat_async, chạy trên event loop LLM dùng chung.
+    """
+    return run_llm_coroutine(call_openai_chat_async(
+        prompt_messages, model_name, api_key,
+        is_json_output=is_json_output,
+        max_retries=max_retries,
+        retry_delay=retry_delay,
+        target_api=target_api,
+        openrouter_api_key=openrouter_api_key,
+        openrouter_base_url=openrouter_base_url,
+        call_site=call_site,
+        json_schema=json_schema,
+        stream=stream,
+        max_output_words=max_output_words,
+        max_output_tokens=max_output_tokens,
+        stream_abort_action=stream_abort_action,
+        max_tokens=max_tokens
+    ))
+
+def call_openai_chats_concurrently(call_kwargs_list):
+    """
+    Chạy nhiều lời gọi call_openai_chat song song (giới hạn bởi semaphore theo model)
+    và trả về list kết quả theo đúng thứ tự đầu vào.
+    call_kwargs_list: list các dict tham số giống hệt tham số của call_openai_chat.
+    Một lời gọi lỗi (exception) sẽ cho kết quả None ở vị trí tương ứng.
+    """
+    if not call_kwargs_list:
+        return []
+
+    async def _gather_calls():
+        return await asyncio.gather(
+            *(call_openai_chat_async(**call_kwargs) for call_kwargs in call_kwargs_list),
+            return_exceptions=True
+        )
+
+    results = run_llm_coroutine(_gather_calls())
+    final_results = []
+    for idx, result in enumerate(results):
+        if isinstance(result, BaseException):
+            logger.error(f"Concurrent LLM call #{idx} raised an exception: {result}")
+            final_results.append(None)
+        else:
+            final_results.append(result)
+    return final_results
+
+def call_openai_dalle(prompt, size, api_key, model="dall-e-3", n=1, max_retries=3, retry_delay=5, call_site="dalle_image"):
     """Tạo ảnh với DALL-E."""
     client = get_openai_client(api_key)
-    attempt = 0
-    while attempt < max_retries:
+    retry_policy = RetryPolicy(max_attempts=max_retries, base_delay=retry_delay, deadline=_llm_request_settings['retry_deadline'])
+    while True:
+        request_started_at = None
         try:
-            logger.info(f"Calling OpenAI DALL-E API. Model: {model}. Prompt: '{prompt[:50]}...'. Attempt: {attempt + 1}")
+            logger.info(f"Calling OpenAI DALL-E API. Model: {model}. Prompt: '{prompt[:50]}...'. Attempt: {retry_policy.attempt + 1}")
+            rate_limiter = get_rate_limiter()
+            if rate_limiter is not None:
+                rate_limiter.acquire("openai", model)
+            request_started_at = time.perf_counter()
             response = client.images.generate(
                 model=model,
                 prompt=prompt,
                 size=size,
                 n=n,
-                response_format="url" # Hoặc "b64_json" nếu muốn lấy base64
+                response_format="url", # Hoặc "b64_json" nếu muốn lấy base64
+                timeout=retry_policy.request_timeout(_llm_request_settings['timeout'])
             )
+            record_usage('image', model, call_site=call_site, wall_sec=time.perf_counter() - request_started_at, images=len(response.data))
             image_url = response.data[0].url # Giả sử n=1
             logger.info(f"OpenAI DALL-E API call successful. Image URL: {image_url}")
             return image_url
         except Exception as e:
-            logger.error(f"Error calling OpenAI DALL-E API (attempt {attempt + 1}/{max_retries}): {e}")
-            attempt += 1
-            if attempt >= max_retries:
-                logger.error("Max retries reached for DALL-E API call.")
+            logger.error(f"Error calling OpenAI DALL-E API (attempt {retry_policy.attempt + 1}/{max_retries}): {e}")
+            if request_started_at is not None:
+                record_usage('image', model, call_site=call_site, wall_sec=time.perf_counter() - request_started_at, success=False)
+            delay = retry_policy.next_delay(e, description="DALL-E API call")
+            if delay is None:
                 return None
-            logger.info(f"Retrying in {retry_delay} seconds...")
-            time.sleep(retry_delay)
-    return None
+            time.sleep(delay)
 
-def call_openai_embeddings(text_input, model_name, api_key, max_retries=3, retry_delay=5):
+def call_openai_embeddings(text_input, model_name, api_key, max_retries=3, retry_delay=5, call_site="embeddings"):
     """Lấy embeddings từ OpenAI."""
     client = get_openai_client(api_key)
-    attempt = 0
-    while attempt < max_retries:
+    retry_policy = RetryPolicy(max_attempts=max_retries, base_delay=retry_delay)
+    while True:
+        request_started_at = None
         try:
-            logger.info(f"Calling OpenAI Embeddings API. Model: {model_name}. Input text length: {len(text_input)}. Attempt: {attempt + 1}")
+            logger.info(f"Calling OpenAI Embeddings API. Model: {model_name}. Input text length: {len(text_input)}. Attempt: {retry_policy.attempt + 1}")
+            rate_limiter = get_rate_limiter()
+            if rate_limiter is not None:
+                rate_limiter.acquire("openai", model_name, count_tokens(text_input, model_name))
+            request_started_at = time.perf_counter()
             response = client.embeddings.create(
                 input=text_input,
-                model=model_name
+                model=model_name,
+                timeout=retry_policy.request_timeout()
             )
+            prompt_tokens, _, _ = extract_usage_tokens(response.usage)
+            record_usage('embedding', model_name, call_site=call_site, wall_sec=time.perf_counter() - request_started_at, prompt_tokens=prompt_tokens)
             embedding = response.data[0].embedding
             logger.info("OpenAI Embeddings API call successful.")
             return embedding
         except Exception as e:
-            logger.error(f"Error calling OpenAI Embeddings API (attempt {attempt + 1}/{max_retries}): {e}")
-            attempt += 1
-            if attempt >= max_retries:
-                logger.error("Max retries reached for Embeddings API call.")
+            logger.error(f"Error calling OpenAI Embeddings API (attempt {retry_policy.attempt + 1}/{max_retries}): {e}")
+            if request_started_at is not None:
+                record_usage('embedding', model_name, call_site=call_site, wall_sec=time.perf_counter() - request_started_at, success=False)
+            delay = retry_policy.next_delay(e, description="Embeddings API call")
+            if delay is None:
                 return None
-            logger.info(f"Retrying in {retry_delay} seconds...")
-            time.sleep(retry_delay)
-    return None
+            time.sleep(delay)
 
 # --- Google API Client Functions (Legacy and YouTube) ---
 
@@ -172,11 +853,12 @@ def google_search(query, api_key, cx_id, search_type='web', num_results=10, max_
     **kwargs: Các tham số bổ sung như imgSize, gl, hl.
     Trả về list các dict theo định dạng chuẩn.
     """
-    attempt = 0
     standardized_results = []
-    while attempt < max_retries:
+    retry_policy = RetryPolicy(max_attempts=max_retries, base_delay=retry_delay)
+    while True:
+        last_error = None
         try:
-            logger.info(f"Performing Google Custom Search. Query: '{query}'. Type: {search_type}. CX_ID: {cx_id}. Attempt: {attempt + 1}")
+            logger.info(f"Performing Google Custom Search. Query: '{query}'. Type: {search_type}. CX_ID: {cx_id}. Attempt: {retry_policy.attempt + 1}")
             
             params = {
                 'key': api_key,
@@ -191,7 +873,7 @@ def google_search(query, api_key, cx_id, search_type='web', num_results=10, max_
             
             params.update(kwargs) # Thêm các tham số tùy chọn khác (gl, hl, etc.)
 
-            response = requests.get("https://www.googleapis.com/customsearch/v1", params=params)
+            response = requests.get("https://www.googleapis.com/customsearch/v1", params=params, timeout=retry_policy.request_timeout())
             response.raise_for_status() 
             
             results_json = response.json()
@@ -220,26 +902,27 @@ def google_search(query, api_key, cx_id, search_type='web', num_results=10, max_
             return standardized_results # Trả về ngay khi thành công
         
         except requests.exceptions.HTTPError as e:
-            logger.error(f"HTTP error during Google Custom Search (attempt {attempt + 1}/{max_retries}): {e.response.status_code} - {e.response.text}")
+            logger.error(f"HTTP error during Google Custom Search (attempt {retry_policy.attempt + 1}/{max_retries}): {e.response.status_code} - {e.response.text}")
+            last_error = e
         except requests.exceptions.RequestException as e:
-            logger.error(f"Request error during Google Custom Search (attempt {attempt + 1}/{max_retries}): {e}")
+            logger.error(f"Request error during Google Custom Search (attempt {retry_policy.attempt + 1}/{max_retries}): {e}")
+            last_error = e
         except Exception as e:
-            logger.error(f"Unexpected error during Google Custom Search (attempt {attempt + 1}/{max_retries}): {e}")
+            logger.error(f"Unexpected error during Google Custom Search (attempt {retry_policy.attempt + 1}/{max_retries}): {e}")
+            last_error = e
 
-        attempt += 1
-        if attempt >= max_retries:
-            logger.error("Max retries reached for Google Custom Search.")
-            return [] 
-        logger.info(f"Retrying Google Custom Search in {retry_delay} seconds...")
-        time.sleep(retry_delay)
-    return []
+        delay = retry_policy.next_delay(last_error, description="Google Custom Search")
+        if delay is None:
+            return []
+        time.sleep(delay)
 
 def youtube_search(query, api_key, part='snippet', type='video', num_results=5, max_retries=3, retry_delay=5):
     """Thực hiện tìm kiếm YouTube. (Hàm này giữ nguyên, không cần chuẩn hóa đặc biệt vì nó dùng cho mục đích khác)"""
-    attempt = 0
-    while attempt < max_retries:
+    retry_policy = RetryPolicy(max_attempts=max_retries, base_delay=retry_delay)
+    while True:
+        last_error = None
         try:
-            logger.info(f"Performing YouTube Search. Query: '{query}'. Attempt: {attempt + 1}")
+            logger.info(f"Performing YouTube Search. Query: '{query}'. Attempt: {retry_policy.attempt + 1}")
             params = {
                 'key': api_key,
                 'part': part,
@@ -247,26 +930,26 @@ def youtube_search(query, api_key, part='snippet', type='video', num_results=5,
                 'type': type,
                 'maxResults': num_results
             }
-            response = requests.get("https://www.googleapis.com/youtube/v3/search", params=params)
+            response = requests.get("https://www.googleapis.com/youtube/v3/search", params=params, timeout=retry_policy.request_timeout())
             response.raise_for_status()
             results = response.json()
             logger.info(f"YouTube Search successful. Found {len(results.get('items', []))} items.")
             return results.get('items', [])
 
         except requests.exceptions.HTTPError as e:
-            logger.error(f"HTTP error during YouTube Search (attempt {attempt + 1}/{max_retries}): {e.response.status_code} - {e.response.text}")
+            logger.error(f"HTTP error during YouTube Search (attempt {retry_policy.attempt + 1}/{max_retries}): {e.response.status_code} - {e.response.text}")
+            last_error = e
         except requests.exceptions.RequestException as e:
-            logger.error(f"Request error during YouTube Search (attempt {attempt + 1}/{max_retries}): {e}")
+            logger.error(f"Request error during YouTube Search (attempt {retry_policy.attempt + 1}/{max_retries}): {e}")
+            last_error = e
         except Exception as e: 
-            logger.error(f"Error during YouTube Search (attempt {attempt + 1}/{max_retries}): {e}")
+            logger.error(f"Error during YouTube Search (attempt {retry_policy.attempt + 1}/{max_retries}): {e}")
+            last_error = e
 
-        attempt += 1
-        if attempt >= max_retries:
-            logger.error("Max retries reached for YouTube Search.")
+        delay = retry_policy.next_delay(last_error, description="YouTube Search")
+        if delay is None:
             return []
-        logger.info(f"Retrying YouTube Search in {retry_delay} seconds...")
-        time.sleep(retry_delay)
-    return []
+        time.sleep(delay)
 
 # --- Serper API Client Function ---
 def call_serper_search(query, api_key, serper_base_url, num_results=10, search_type='search', max_retries=3, retry_delay=5, **kwargs):
@@ -276,7 +959,6 @@ def call_serper_search(query, api_key, serper_base_url, num_results=10, search_t
     **kwargs: Các tham số bổ sung như gl, hl.
     Trả về list các dict theo định dạng chuẩn.
     """
-    attempt = 0
     standardized_results = []
     
     # Serper API endpoint là /search cho web, /images cho ảnh, etc.
@@ -311,10 +993,12 @@ def call_serper_search(query, api_key, serper_base_url, num_results=10, search_t
     #     logger.warning("Serper image search does not directly support 'imgSize' like Google. This parameter will be ignored for Serper.")
 
 
-    while attempt < max_retries:
+    retry_policy = RetryPolicy(max_attempts=max_retries, base_delay=retry_delay)
+    while True:
+        last_error = None
         try:
-            logger.info(f"Performing Serper Search. Query: '{query}'. Type: {search_type} (Endpoint: {endpoint}). URL: {url}. Attempt: {attempt + 1}")
-            response = requests.post(url, headers=headers, json=payload)
+            logger.info(f"Performing Serper Search. Query: '{query}'. Type: {search_type} (Endpoint: {endpoint}). URL: {url}. Attempt: {retry_policy.attempt + 1}")
+            response = requests.post(url, headers=headers, json=payload, timeout=retry_policy.request_timeout())
             response.raise_for_status()
             
             results_json = response.json()
@@ -378,19 +1062,19 @@ def call_serper_search(query, api_key, serper_base_url, num_results=10, search_t
             return standardized_results # Trả về ngay khi thành công
 
         except requests.exceptions.HTTPError as e:
-            logger.error(f"HTTP error during Serper Search (attempt {attempt + 1}/{max_retries}): {e.response.status_code} - {e.response.text}")
+            logger.error(f"HTTP error during Serper Search (attempt {retry_policy.attempt + 1}/{max_retries}): {e.response.status_code} - {e.response.text}")
+            last_error = e
         except requests.exceptions.RequestException as e:
-            logger.error(f"Request error during Serper Search (attempt {attempt + 1}/{max_retries}): {e}")
+            logger.error(f"Request error during Serper Search (attempt {retry_policy.attempt + 1}/{max_retries}): {e}")
+            last_error = e
         except Exception as e:
-            logger.error(f"Unexpected error during Serper Search (attempt {attempt + 1}/{max_retries}): {e}")
+            logger.error(f"Unexpected error during Serper Search (attempt {retry_policy.attempt + 1}/{max_retries}): {e}")
+            last_error = e
 
-        attempt += 1
-        if attempt >= max_retries:
-            logger.error("Max retries reached for Serper Search.")
+        delay = retry_policy.next_delay(last_error, description="Serper Search")
+        if delay is None:
             return []
-        logger.info(f"Retrying Serper Search in {retry_delay} seconds...")
-        time.sleep(retry_delay)
-    return []
+        time.sleep(delay)
 
 # --- Unified Search Function ---
 def perform_search(query, search_type, config, num_results=10, **kwargs):
@@ -399,8 +1083,20 @@ def perform_search(query, search_type, config, num_results=10, **kwargs):
     search_type: 'web' hoặc 'image'.
     config: Đối tượng config chứa SEARCH_PROVIDER và các API keys.
     **kwargs: Các tham số bổ sung như gl, hl, imgSize.
+    Các tìm kiếm giống hệt nhau (cùng provider/type/query/tham số) đang chạy đồng thời chỉ gửi một request.
     """
     provider = config.get('SEARCH_PROVIDER', 'google').lower()
+    normalized_query = " ".join(str(query).split()).lower()
+    request_key = make_request_key(provider, search_type, normalized_query, num_results, kwargs)
+    return _search_single_flight.do(
+        request_key, lambda: _perform_search_uncoalesced(query, search_type, config, provider, num_results, **kwargs)
+    )
+
+def log_request_coalescing_stats():
+    """Ghi log số request LLM/search đã được gộp (gọi ở cuối mỗi lần chạy)."""
+    log_single_flight_stats(_llm_single_flight, _search_single_flight)
+
+def _perform_search_uncoalesced(query, search_type, config, provider, num_results=10, **kwargs):
     logger.info(f"Performing search via provider: '{provider}' for type: '{search_type}'")
 
     if provider == 'serper':
@@ -458,7 +1154,6 @@ def perform_search(query, search_type, config, num_results=10, **kwargs):
 
 def _wp_request(method, endpoint_url, auth_tuple, json_data=None, params=None, files=None, headers=None, max_retries=3, retry_delay=5):
     """Hàm helper chung cho các request tới WordPress API."""
-    attempt = 0
     full_url = endpoint_url # endpoint_url đã bao gồm base_url
     
     # Headers mặc định
@@ -468,15 +1163,17 @@ def _wp_request(method, endpoint_url, auth_tuple, json_data=None, params=None, f
     if headers:
         default_headers.update(headers)
 
-    while attempt < max_retries:
+    retry_policy = RetryPolicy(max_attempts=max_retries, base_delay=retry_delay)
+    while True:
+        last_error = None
         try:
-            logger.debug(f"WordPress API Request ({method}). URL: {full_url}. Attempt: {attempt + 1}")
+            logger.debug(f"WordPress API Request ({method}). URL: {full_url}. Attempt: {retry_policy.attempt + 1}")
             if method.upper() == 'GET':
-                response = requests.get(full_url, auth=auth_tuple, params=params, headers=default_headers)
+                response = requests.get(full_url, auth=auth_tuple, params=params, headers=default_headers, timeout=retry_policy.request_timeout())
             elif method.upper() == 'POST':
-                response = requests.post(full_url, auth=auth_tuple, json=json_data, params=params, files=files, headers=default_headers)
+                response = requests.post(full_url, auth=auth_tuple, json=json_data, params=params, files=files, headers=default_headers, timeout=retry_policy.request_timeout())
             elif method.upper() == 'PUT':
-                response = requests.put(full_url, auth=auth_tuple, json=json_data, params=params, headers=default_headers)
+                response = requests.put(full_url, auth=auth_tuple, json=json_data, params=params, headers=default_headers, timeout=retry_policy.request_timeout())
             else:
                 logger.error(f"Unsupported HTTP method: {method}")
                 return None
@@ -498,19 +1195,19 @@ def _wp_request(method, endpoint_url, auth_tuple, json_data=None, params=None, f
                 return response.text 
 
         except requests.exceptions.HTTPError as e:
-            logger.error(f"HTTP error during WordPress API call ({method} {full_url}, attempt {attempt + 1}/{max_retries}): {e.response.status_code} - {e.response.text}")
+            logger.error(f"HTTP error during WordPress API call ({method} {full_url}, attempt {retry_policy.attempt + 1}/{max_retries}): {e.response.status_code} - {e.response.text}")
+            last_error = e
         except requests.exceptions.RequestException as e:
-            logger.error(f"Request error during WordPress API call ({method} {full_url}, attempt {attempt + 1}/{max_retries}): {e}")
+            logger.error(f"Request error during WordPress API call ({method} {full_url}, attempt {retry_policy.attempt + 1}/{max_retries}): {e}")
+            last_error = e
         except Exception as e:
-            logger.error(f"Unexpected error during WordPress API call ({method} {full_url}, attempt {attempt + 1}/{max_retries}): {e}")
+            logger.error(f"Unexpected error during WordPress API call ({method} {full_url}, attempt {retry_policy.attempt + 1}/{max_retries}): {e}")
+            last_error = e
         
-        attempt += 1
-        if attempt >= max_retries:
-            logger.error(f"Max retries reached for WordPress API call: {method} {full_url}")
+        delay = retry_policy.next_delay(last_error, description=f"WordPress API call {method} {full_url}")
+        if delay is None:
             return None
-        logger.info(f"Retrying WordPress API call in {retry_delay} seconds...")
-        time.sleep(retry_delay)
-    return None
+        time.sleep(delay)
 
 
 def get_wp_categories(base_url, auth_user, auth_pass, params=None):
@@ -20,6 +20,32 @@ ENV_CONFIG_MAPPING = [
     {'env_var': 'GOOGLE_API_KEY'},
     {'env_var': 'YOUTUBE_API_KEY'},
     {'env_var': 'GEMINI_API_KEY'},
+
+    # LLM HTTP connection pool
+    {'env_var': 'LLM_HTTP_MAX_CONNECTIONS', 'type': int},
+    {'env_var': 'LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS', 'type': int},
+    {'env_var': 'LLM_HTTP_KEEPALIVE_EXPIRY', 'type': int},
+    {'env_var': 'LLM_HTTP2_ENABLED', 'type': bool},
+    {'env_var': 'LLM_MAX_CONCURRENT_REQUESTS_PER_MODEL', 'type': int},
+    {'env_var': 'LLM_CACHE_ENABLED', 'type': bool},
+    {'env_var': 'LLM_CACHE_PATH'},
+    {'env_var': 'LLM_CACHE_MAX_SIZE_MB', 'type': int},
+    {'env_var': 'LLM_RATE_LIMIT_ENABLED', 'type': bool},
+    {'env_var': 'LLM_RATE_LIMIT_DB_PATH'},
+    {'env_var': 'LLM_RATE_LIMIT_MAX_WAIT_SEC', 'type': int},
+    {'env_var': 'LLM_REQUEST_TIMEOUT_SEC', 'type': int},
+    {'env_var': 'LLM_RETRY_DEADLINE_SEC', 'type': int},
+    {'env_var': 'RETRY_DEADLINE_SEC', 'type': int},
+    {'env_var': 'LLM_STREAMING_ENABLED', 'type': bool},
+    {'env_var': 'LLM_STREAM_MAX_OUTPUT_TOKENS', 'type': int},
+    {'env_var': 'LLM_ROUTER_ENABLED', 'type': bool},
+    {'env_var': 'LLM_HEDGE_DEFAULT_DELAY_SEC', 'type': int},
+    {'env_var': 'USAGE_LOG_DIR'},
+    {'env_var': 'LLM_KEY_POOL_ENABLED', 'type': bool},
+    {'env_var': 'TIKTOKEN_CACHE_DIR'},
+    {'env_var': 'SECTION_WRITER_MAX_WORKERS', 'type': int},
+    {'env_var': 'SECTION_BATCHING_ENABLED', 'type': bool},
+    {'env_var': 'SECTION_BATCH_MAX_SECTIONS', 'type': int},
     
     # Google Custom Search
     {'env_var': 'GOOGLE_CX_ID'},
@@ -66,6 +92,18 @@ ENV_CONFIG_MAPPING = [
     {'env_var': 'SEARCH_PROVIDER'}, # 'google' or 'serper'
     {'env_var': 'IMAGE_SEARCH_MIN_WIDTH', 'type': int},
     {'env_var': 'IMAGE_SEARCH_MIN_HEIGHT', 'type': int},
+    {'env_var': 'IMAGE_PROCESSING_MAX_WORKERS', 'type': int},
+    {'env_var': 'IMAGE_PROBE_ENABLED', 'type': bool},
+    {'env_var': 'IMAGE_DOWNLOAD_MAX_BYTES', 'type': int},
+    {'env_var': 'IMAGE_CACHE_ENABLED', 'type': bool},
+    {'env_var': 'IMAGE_CACHE_DIR'},
+    {'env_var': 'IMAGE_CACHE_MAX_SIZE_MB', 'type': int},
+    {'env_var': 'IMAGE_TRANSCODER_ENABLED', 'type': bool},
+    {'env_var': 'IMAGE_TRANSCODER_MAX_WORKERS', 'type': int},
+    {'env_var': 'IMAGE_OUTPUT_MAX_BYTES', 'type': int},
+    {'env_var': 'FEATURED_IMAGE_OUTPUT_MAX_BYTES', 'type': int},
+    {'env_var': 'IMAGE_DEDUPE_ENABLED', 'type': bool},
+    {'env_var': 'IMAGE_DEDUPE_MAX_DISTANCE', 'type': int},
     {'env_var': 'YOUTUBE_SEARCH_NUM_RESULTS', 'type': int},
     {'env_var': 'LOG_FILE_PATH'},
     {'env_var': 'LOG_TO_CONSOLE', 'type': bool},
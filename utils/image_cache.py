@@ -0,0 +1,387 @@
+# utils/image_cache.py
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import closing
+
+from utils.image_dedupe import compute_image_dhash, format_dhash
+from utils.image_download import download_image
+from utils.image_probe import read_image_dimensions
+from utils.image_transcoder import transcode_image_variants
+
+# Khởi tạo logger
+logger = logging.getLogger(__name__)
+
+# Variant của ảnh gốc đã tải; các bản resize dùng tên do make_image_variant_name tạo
+SOURCE_VARIANT = 'source'
+# Perceptual hash (dHash, hex) của ảnh gốc, lưu như một variant để không phải decode lại ảnh gốc khi bản resize đã có
+DHASH_VARIANT = 'dhash'
+
+_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_cache (
+    cache_key TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    url TEXT,
+    file_name TEXT NOT NULL,
+    image_format TEXT,
+    size_bytes INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL,
+    PRIMARY KEY (cache_key, variant)
+)
+"""
+
+def make_image_cache_key(image_url):
+    """Key của một ảnh nguồn: hash của URL (cùng ảnh stock/nhà sản xuất -> cùng key ở mọi site)."""
+    return hashlib.sha256(image_url.encode('utf-8')).hexdigest()
+
+def make_image_variant_name(width=None, height=None, output_format='JPEG', quality=85, max_bytes=None):
+    """Tên variant của một bản resize, vd: 'w800-hauto-q85.jpeg', 'w700-h700-q85-b122880.webp' (có byte budget)."""
+    budget_suffix = f"-b{max_bytes}" if max_bytes else ""
+    return f"w{width or 'auto'}-h{height or 'auto'}-q{quality}{budget_suffix}.{output_format.lower()}"
+
+class ImageDiskCache:
+    """
+    Cache ảnh trên đĩa: ảnh gốc đã tải (kèm ETag/Last-Modified) và các bản resize theo kích thước đích.
+    - Index trong SQLite (WAL) nên nhiều process/site dùng chung một thư mục cache; file ảnh nằm cạnh index.
+    - Ảnh gốc tải trong vòng max_age_sec được dùng lại không cần mạng; cũ hơn thì revalidate bằng
+      GET có điều kiện (304 -> dùng lại ảnh gốc và các bản resize).
+    - Giới hạn tổng dung lượng (max_size_bytes), vượt quá thì xóa theo LRU từng URL (ảnh gốc cùng mọi bản resize).
+    """
+    def __init__(self, cache_dir, max_size_bytes=1024 * 1024 * 1024, max_age_sec=7 * 86400):
+        self.cache_dir = cache_dir
+        self.db_path = os.path.join(cache_dir, 'index.sqlite3')
+        self.max_size_bytes = int(max_size_bytes)
+        self.max_age_sec = float(max_age_sec)
+        self._lock = threading.Lock()
+        self._stats = {'resized_hits': 0, 'source_hits': 0, 'not_modified': 0, 'downloads': 0, 'stores': 0}
+
+        os.makedirs(cache_dir, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(_CACHE_SCHEMA)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_image_cache_last_access ON image_cache(last_access)")
+
+    def _connect(self):
+        # Dùng `with closing(self._connect()) as conn, conn:` để vừa commit/rollback vừa đóng connection
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _record(self, outcome):
+        with self._lock:
+            self._stats[outcome] += 1
+
+    def _file_path(self, cache_key, variant):
+        return os.path.join(self.cache_dir, cache_key[:2], f"{cache_key}.{variant}")
+
+    def _write_file(self, cache_key, variant, write_fn):
+        """Ghi file qua file tạm + os.replace để process khác không bao giờ đọc phải file ghi dở."""
+        file_path = self._file_path(cache_key, variant)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                write_fn(tmp_file)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return file_path
+
+    def _remove_files(self, cache_key, variants):
+        for variant in variants:
+            try:
+                os.remove(self._file_path(cache_key, variant))
+            except FileNotFoundError:
+                pass
+
+    def get_source_entry(self, image_url):
+        """Thông tin ảnh gốc đã cache (image_format, etag, last_modified, fetched_at, is_fresh) hoặc None."""
+        cache_key = make_image_cache_key(image_url)
+        try:
+            with self._lock, closing(self._connect()) as conn, conn:
+                row = conn.execute(
+                    "SELECT image_format, etag, last_modified, fetched_at FROM image_cache "
+                    "WHERE cache_key = ? AND variant = ?", (cache_key, SOURCE_VARIANT)
+                ).fetchone()
+        except Exception as e:
+            logger.warning(f"Image cache lookup failed for {image_url}: {e}")
+            return None
+        if row is None:
+            return None
+        return {'image_format': row[0], 'etag': row[1], 'last_modified': row[2], 'fetched_at': row[3],
+                'is_fresh': time.time() - row[3] <= self.max_age_sec}
+
+    def _read_variant(self, image_url, variant, reader):
+        """Mở file của variant bằng reader(path) và cập nhật last_access. File bị xóa mất -> xóa entry, trả về None."""
+        cache_key = make_image_cache_key(image_url)
+        try:
+            result = reader(self._file_path(cache_key, variant))
+        except FileNotFoundError:
+            self._delete_entries(cache_key, [variant])
+            return None
+        except Exception as e:
+            logger.warning(f"Image cache read failed for {image_url} ({variant}): {e}")
+            return None
+        try:
+            with self._lock, closing(self._connect()) as conn, conn:
+                conn.execute("UPDATE image_cache SET last_access = ? WHERE cache_key = ?", (time.time(), cache_key))
+        except Exception as e:
+            logger.debug(f"Could not update image cache last_access for {image_url}: {e}")
+        return result
+
+    def open_source(self, image_url):
+        """File object (binary, caller phải đóng) của ảnh gốc đã cache, hoặc None."""
+        return self._read_variant(image_url, SOURCE_VARIANT, lambda path: open(path, 'rb'))
+
+    def get_variant(self, image_url, variant):
+        """Bytes của một bản resize đã cache, hoặc None."""
+        def read_bytes(path):
+            with open(path, 'rb') as variant_file:
+                return variant_file.read()
+        return self._read_variant(image_url, variant, read_bytes)
+
+    def _upsert(self, cache_key, variant, image_url, image_format, size_bytes, etag=None, last_modified=None, fetched_at=None):
+        now = time.time()
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO image_cache "
+                "(cache_key, variant, url, file_name, image_format, size_bytes, etag, last_modified, fetched_at, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (cache_key, variant, image_url, os.path.basename(self._file_path(cache_key, variant)), image_format,
+                 size_bytes, etag, last_modified, fetched_at or now, now, now)
+            )
+            evicted = self._evict_if_needed(conn)
+        for evicted_key, evicted_variants in evicted:
+            self._remove_files(evicted_key, evicted_variants)
+
+    def store_source(self, image_url, image_file, image_format, etag=None, last_modified=None):
+        """
+        Lưu ảnh gốc vừa tải (image_file được đọc từ đầu và seek lại về 0 sau khi lưu).
+        Ảnh gốc thay đổi nên các bản resize cũ của URL này bị xóa.
+        """
+        cache_key = make_image_cache_key(image_url)
+        try:
+            image_file.seek(0)
+            self._write_file(cache_key, SOURCE_VARIANT, lambda tmp_file: shutil.copyfileobj(image_file, tmp_file))
+            size_bytes = image_file.tell()
+            image_file.seek(0)
+            with self._lock, closing(self._connect()) as conn, conn:
+                stale_variants = [row[0] for row in conn.execute(
+                    "SELECT variant FROM image_cache WHERE cache_key = ? AND variant != ?", (cache_key, SOURCE_VARIANT)
+                ).fetchall()]
+                conn.execute("DELETE FROM image_cache WHERE cache_key = ? AND variant != ?", (cache_key, SOURCE_VARIANT))
+            self._remove_files(cache_key, stale_variants)
+            self._upsert(cache_key, SOURCE_VARIANT, image_url, image_format, size_bytes, etag, last_modified)
+        except Exception as e:
+            logger.warning(f"Image cache write failed for {image_url}: {e}")
+            image_file.seek(0)
+            return False
+        self._record('stores')
+        return True
+
+    def store_variant(self, image_url, variant, image_data):
+        """Lưu một bản resize (bytes) của ảnh gốc."""
+        cache_key = make_image_cache_key(image_url)
+        try:
+            self._write_file(cache_key, variant, lambda tmp_file: tmp_file.write(image_data))
+            self._upsert(cache_key, variant, image_url, variant.rsplit('.', 1)[-1], len(image_data))
+        except Exception as e:
+            logger.warning(f"Image cache write failed for {image_url} ({variant}): {e}")
+            return False
+        self._record('stores')
+        return True
+
+    def mark_revalidated(self, image_url):
+        """Server trả 304: ảnh gốc (và các bản resize) còn đúng, tính lại thời hạn từ bây giờ."""
+        try:
+            with self._lock, closing(self._connect()) as conn, conn:
+                conn.execute("UPDATE image_cache SET fetched_at = ? WHERE cache_key = ?",
+                             (time.time(), make_image_cache_key(image_url)))
+        except Exception as e:
+            logger.warning(f"Image cache revalidation update failed for {image_url}: {e}")
+
+    def _delete_entries(self, cache_key, variants):
+        try:
+            with self._lock, closing(self._connect()) as conn, conn:
+                conn.executemany("DELETE FROM image_cache WHERE cache_key = ? AND variant = ?",
+                                 [(cache_key, variant) for variant in variants])
+        except Exception as e:
+            logger.debug(f"Could not delete image cache entries for {cache_key}: {e}")
+        self._remove_files(cache_key, variants)
+
+    def _evict_if_needed(self, conn):
+        """
+        Xóa theo LRU từng URL (ảnh gốc cùng các bản resize) cho đến khi tổng dung lượng <= max_size_bytes.
+        Trả về [(cache_key, [variant, ...])] để caller xóa file ngoài lock.
+        """
+        total_size = conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM image_cache").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return []
+        bytes_to_free = total_size - self.max_size_bytes
+        freed, evicted = 0, []
+        for cache_key, size_bytes in conn.execute(
+            "SELECT cache_key, SUM(size_bytes) FROM image_cache GROUP BY cache_key ORDER BY MAX(last_access) ASC"
+        ).fetchall():
+            if freed >= bytes_to_free:
+                break
+            variants = [row[0] for row in conn.execute(
+                "SELECT variant FROM image_cache WHERE cache_key = ?", (cache_key,)).fetchall()]
+            conn.execute("DELETE FROM image_cache WHERE cache_key = ?", (cache_key,))
+            evicted.append((cache_key, variants))
+            freed += size_bytes
+        logger.info(f"Image cache evicted {len(evicted)} LRU images ({freed} bytes) to stay under {self.max_size_bytes} bytes.")
+        return evicted
+
+    def get_stats(self):
+        """Thống kê của process hiện tại."""
+        with self._lock:
+            return dict(self._stats)
+
+# Cache dùng chung cho process, None khi cache bị tắt
+_active_image_cache = None
+
+def configure_image_cache(config):
+    """Bật/tắt cache theo config (IMAGE_CACHE_ENABLED, IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_SIZE_MB, IMAGE_CACHE_MAX_AGE_SEC)."""
+    global _active_image_cache
+    if not config.get('IMAGE_CACHE_ENABLED', False):
+        _active_image_cache = None
+        logger.info("Image disk cache is disabled.")
+        return None
+    try:
+        _active_image_cache = ImageDiskCache(
+            cache_dir=config.get('IMAGE_CACHE_DIR', 'cache/images'),
+            max_size_bytes=int(config.get('IMAGE_CACHE_MAX_SIZE_MB', 1024)) * 1024 * 1024,
+            max_age_sec=config.get('IMAGE_CACHE_MAX_AGE_SEC', 7 * 86400)
+        )
+        logger.info(f"Image disk cache enabled at {_active_image_cache.cache_dir} (max {config.get('IMAGE_CACHE_MAX_SIZE_MB', 1024)} MB).")
+    except Exception as e:
+        logger.error(f"Could not initialize image disk cache: {e}. Continuing without cache.")
+        _active_image_cache = None
+    return _active_image_cache
+
+def get_image_cache():
+    return _active_image_cache
+
+def log_image_cache_stats():
+    """Ghi log thống kê của cache ảnh (gọi ở cuối mỗi lần chạy)."""
+    if _active_image_cache is None:
+        return None
+    stats = _active_image_cache.get_stats()
+    logger.info(f"Image cache stats: resized_hits={stats['resized_hits']}, source_hits={stats['source_hits']}, "
+                f"not_modified={stats['not_modified']}, downloads={stats['downloads']}, stores={stats['stores']}")
+    return stats
+
+def _open_source_image(image_url, image_cache, download_options):
+    """
+    Ảnh gốc dưới dạng file object (caller phải đóng): từ cache nếu còn hạn hoặc server trả 304, nếu không thì tải
+    và lưu vào cache. Raise ImageDownloadError khi tải thất bại.
+    """
+    entry = image_cache.get_source_entry(image_url) if image_cache else None
+    if entry and entry['is_fresh']:
+        source_file = image_cache.open_source(image_url)
+        if source_file is not None:
+            image_cache._record('source_hits')
+            return source_file
+        entry = None
+
+    validators = {'etag': entry['etag'], 'last_modified': entry['last_modified']} if entry else {}
+    downloaded = download_image(image_url, **download_options, **validators)
+    if downloaded.not_modified:
+        image_cache.mark_revalidated(image_url)
+        source_file = image_cache.open_source(image_url)
+        if source_file is not None:
+            image_cache._record('not_modified')
+            return source_file
+        downloaded = download_image(image_url, **download_options) # File cache vừa bị xóa: tải lại đầy đủ
+
+    logger.info(f"Image downloaded successfully (format: {downloaded.image_format}, size: {downloaded.size_bytes} bytes).")
+    if image_cache:
+        image_cache._record('downloads')
+        if image_cache.store_source(image_url, downloaded.file, downloaded.image_format,
+                                    downloaded.etag, downloaded.last_modified):
+            # Dùng file trong cache (có đường dẫn thật) để process pool xử lý ảnh đọc thẳng từ đĩa
+            source_file = image_cache.open_source(image_url)
+            if source_file is not None:
+                downloaded.file.close()
+                return source_file
+    return downloaded.file
+
+def _get_cached_dhash(image_cache, image_url):
+    cached_hash = image_cache.get_variant(image_url, DHASH_VARIANT) if image_cache else None
+    try:
+        return int(cached_hash.decode('ascii'), 16) if cached_hash else None
+    except ValueError:
+        return None
+
+def fetch_resized_image_variants(image_url, widths, height_ratio=None, output_format='JPEG', quality=85, max_bytes=None,
+                                 budget_width=None, min_quality=50, download_options=None, image_check=None):
+    """
+    Các bản resize cho srcset của ảnh image_url (xem resize_image_variants), qua cache ảnh (nếu bật):
+    đủ mọi bản resize trong cache -> ảnh gốc đã cache/revalidate (304) -> tải mới; các bản resize được tạo
+    từ một lần decode. Raise ImageDownloadError khi tải thất bại; trả về None nếu resize thất bại.
+    image_check: hàm nhận perceptual hash (dHash) của ảnh gốc, được gọi đúng một lần trước khi resize; raise để loại ảnh
+    (vd: DuplicateImageError), exception được truyền ra cho caller.
+    """
+    box_widths = sorted({int(width) for width in widths if width})
+    budget_width = budget_width or box_widths[-1]
+    variant_names = {
+        box_width: f"s{budget_width}-" + make_image_variant_name(
+            box_width, int(box_width * height_ratio) if height_ratio else None, output_format, quality, max_bytes)
+        for box_width in box_widths
+    }
+    image_cache = get_image_cache()
+    if image_cache:
+        entry = image_cache.get_source_entry(image_url)
+        if entry and entry['is_fresh']:
+            cached = {box_width: image_cache.get_variant(image_url, name) for box_width, name in variant_names.items()}
+            cached_hash = _get_cached_dhash(image_cache, image_url) if image_check else None
+            if all(data is not None for data in cached.values()) and (image_check is None or cached_hash is not None):
+                variants = {}
+                for box_width, data in cached.items():
+                    dimensions = read_image_dimensions(data)
+                    if not dimensions:
+                        break
+                    variant = variants.setdefault(dimensions, {'width': dimensions[0], 'height': dimensions[1],
+                                                               'quality': None, 'data': data, 'box_widths': []})
+                    variant['box_widths'].append(box_width)
+                else:
+                    # Gọi image_check sau khi chắc chắn dùng được bản cache: mỗi lần fetch chỉ gọi đúng một lần
+                    # (image_check có thể giữ chỗ hash, gọi lại sẽ thấy ảnh trùng với chính nó)
+                    if image_check:
+                        image_check(cached_hash)
+                    image_cache._record('resized_hits')
+                    logger.info(f"Using {len(variants)} cached resized variant(s) for: {image_url}")
+                    return sorted(variants.values(), key=lambda variant: variant['width'])
+
+    source_file = _open_source_image(image_url, image_cache, download_options or {})
+    try:
+        # Truyền thẳng file object (không đọc hết vào RAM): Pillow chỉ đọc phần cần để decode
+        if image_check:
+            image_hash = _get_cached_dhash(image_cache, image_url)
+            if image_hash is None:
+                image_hash = compute_image_dhash(source_file)
+                source_file.seek(0)
+                if image_hash is not None and image_cache:
+                    image_cache.store_variant(image_url, DHASH_VARIANT, format_dhash(image_hash).encode('ascii'))
+            if image_hash is not None:
+                image_check(image_hash) # Loại ảnh trùng trước khi tốn CPU resize/encode
+        # Decode/resize/encode chạy trong process pool (nếu bật) để không giữ GIL của các thread mạng
+        variants = transcode_image_variants(source_file, widths=box_widths, height_ratio=height_ratio,
+                                            output_format=output_format, quality=quality, max_bytes=max_bytes,
+                                            budget_width=budget_width, min_quality=min_quality)
+    finally:
+        source_file.close() # Xóa file tạm (nếu body đã được spool ra đĩa)
+    if variants and image_cache:
+        for variant in variants:
+            for box_width in variant['box_widths']:
+                image_cache.store_variant(image_url, variant_names[box_width], variant['data'])
+    return variants
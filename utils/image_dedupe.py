@@ -0,0 +1,198 @@
+# utils/image_dedupe.py
+import io
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+from PIL import Image, ImageOps
+
+from utils.image_transcoder import get_image_transcoder
+
+# Khởi tạo logger
+logger = logging.getLogger(__name__)
+
+# dHash 8x8 = 64 bit
+_DHASH_SIZE = 8
+
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS published_image_hashes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    site TEXT NOT NULL,
+    dhash TEXT NOT NULL,
+    source_url TEXT,
+    wp_url TEXT,
+    width INTEGER,
+    height INTEGER,
+    srcset TEXT,
+    created_at REAL NOT NULL
+)
+"""
+# Cột thêm sau lần đầu tạo bảng: index cũ được ALTER TABLE khi mở (giá trị NULL cho các dòng cũ)
+_INDEX_ADDED_COLUMNS = {'width': 'INTEGER', 'height': 'INTEGER', 'srcset': 'TEXT'}
+
+class DuplicateImageError(Exception):
+    """Ảnh ứng viên gần trùng (perceptual hash) với ảnh đã dùng trong bài hoặc đã publish trên site."""
+    def __init__(self, message, matched_url=None, distance=None):
+        super().__init__(message)
+        self.matched_url = matched_url
+        self.distance = distance
+
+class PublishedImageMatch(DuplicateImageError):
+    """
+    Ảnh ứng viên gần trùng với ảnh đã publish trên site từ một bài khác: caller dùng lại media item đã có
+    (published_image: {'wp_url', 'width', 'height', 'srcset', 'distance', 'source_url'}) thay vì upload lại.
+    """
+    def __init__(self, message, published_image):
+        super().__init__(message, published_image.get('wp_url'), published_image.get('distance'))
+        self.published_image = published_image
+
+def compute_dhash(image_source, hash_size=_DHASH_SIZE):
+    """
+    Difference hash của ảnh (bytes, đường dẫn hoặc file object): ảnh xám thu nhỏ về (hash_size+1) x hash_size,
+    mỗi bit = pixel trái sáng hơn pixel phải. Ảnh giống nhau sau khi resize/nén lại/đổi CDN cho hash gần nhau.
+    Trả về int (hash_size^2 bit) hoặc None nếu không đọc được ảnh.
+    """
+    try:
+        img = Image.open(io.BytesIO(image_source) if isinstance(image_source, bytes) else image_source)
+        img.draft('L', (hash_size * 8, hash_size * 8)) # JPEG: decode ở 1/8 kích thước là đủ
+        img = ImageOps.exif_transpose(img).convert('L').resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+        pixels = img.tobytes()
+    except Exception as e:
+        logger.warning(f"Could not compute perceptual hash: {e}")
+        return None
+    image_hash = 0
+    for row in range(hash_size):
+        row_offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            image_hash = (image_hash << 1) | (pixels[row_offset + col] > pixels[row_offset + col + 1])
+    return image_hash
+
+def compute_image_dhash(image_source):
+    """compute_dhash qua process pool xử lý ảnh nếu được bật (decode ảnh PNG/WebP lớn tốn CPU)."""
+    transcoder = get_image_transcoder()
+    if transcoder is None:
+        return compute_dhash(image_source)
+    return transcoder.transcode(image_source, resize_fn=compute_dhash)
+
+def hamming_distance(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count('1')
+
+def format_dhash(image_hash):
+    return f"{image_hash:016x}"
+
+class PublishedImageIndex:
+    """
+    Index (SQLite, dùng chung giữa các lần chạy/process) perceptual hash của các ảnh đã upload theo site,
+    để dùng lại media item đã có cho ảnh gần trùng (cùng ảnh sản phẩm từ CDN khác) thay vì resize/upload lại.
+    """
+    def __init__(self, db_path, max_distance=6):
+        self.db_path = db_path
+        self.max_distance = int(max_distance)
+        self._lock = threading.Lock()
+        self._stats = {'checks': 0, 'duplicates': 0, 'adds': 0}
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(_INDEX_SCHEMA)
+            existing_columns = {row[1] for row in conn.execute("PRAGMA table_info(published_image_hashes)")}
+            for column, column_type in _INDEX_ADDED_COLUMNS.items():
+                if column not in existing_columns:
+                    conn.execute(f"ALTER TABLE published_image_hashes ADD COLUMN {column} {column_type}")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_published_image_hashes_site ON published_image_hashes(site)")
+
+    def _connect(self):
+        # Dùng `with closing(self._connect()) as conn, conn:` để vừa commit/rollback vừa đóng connection
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def find_near_duplicate(self, site, image_hash):
+        """
+        Ảnh đã publish trên site gần nhất với image_hash (khoảng cách Hamming <= max_distance), hoặc None.
+        Trả về {'distance', 'source_url', 'wp_url', 'width', 'height', 'srcset'} (srcset: list {'url', 'width', 'height'}).
+        """
+        try:
+            with self._lock, closing(self._connect()) as conn, conn:
+                rows = conn.execute(
+                    "SELECT dhash, source_url, wp_url, width, height, srcset FROM published_image_hashes "
+                    "WHERE site = ? AND wp_url IS NOT NULL", (site,)
+                ).fetchall()
+        except Exception as e:
+            logger.warning(f"Image hash index lookup failed for site '{site}': {e}")
+            return None
+        best_row, best_distance = None, None
+        for row in rows:
+            distance = hamming_distance(image_hash, int(row[0], 16))
+            if distance <= self.max_distance and (best_distance is None or distance < best_distance):
+                best_row, best_distance = row, distance
+        best_match = None
+        if best_row is not None:
+            try:
+                srcset = json.loads(best_row[5]) if best_row[5] else []
+            except ValueError:
+                srcset = []
+            best_match = {'distance': best_distance, 'source_url': best_row[1], 'wp_url': best_row[2],
+                          'width': best_row[3], 'height': best_row[4], 'srcset': srcset}
+        with self._lock:
+            self._stats['checks'] += 1
+            if best_match:
+                self._stats['duplicates'] += 1
+        return best_match
+
+    def add(self, site, image_hash, source_url=None, wp_url=None, width=None, height=None, srcset=None):
+        """Ghi nhận ảnh vừa upload cho site (kèm kích thước và srcset để bài sau dùng lại được media item này)."""
+        try:
+            with self._lock, closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "INSERT INTO published_image_hashes (site, dhash, source_url, wp_url, width, height, srcset, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (site, format_dhash(image_hash), source_url, wp_url, width, height,
+                     json.dumps(srcset) if srcset else None, time.time())
+                )
+                self._stats['adds'] += 1
+        except Exception as e:
+            logger.warning(f"Could not record image hash for site '{site}': {e}")
+            return False
+        return True
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+# Index dùng chung cho process, None khi bị tắt
+_active_image_index = None
+
+def configure_image_dedupe(config):
+    """Bật/tắt index theo config (IMAGE_DEDUPE_ENABLED, IMAGE_DEDUPE_INDEX_PATH, IMAGE_DEDUPE_MAX_DISTANCE)."""
+    global _active_image_index
+    if not config.get('IMAGE_DEDUPE_ENABLED', False):
+        _active_image_index = None
+        logger.info("Perceptual image dedupe is disabled.")
+        return None
+    try:
+        _active_image_index = PublishedImageIndex(
+            db_path=config.get('IMAGE_DEDUPE_INDEX_PATH', 'cache/image_hashes.sqlite3'),
+            max_distance=config.get('IMAGE_DEDUPE_MAX_DISTANCE', 6)
+        )
+        logger.info(f"Published image hash index enabled at {_active_image_index.db_path} "
+                    f"(max distance {_active_image_index.max_distance}).")
+    except Exception as e:
+        logger.error(f"Could not initialize published image hash index: {e}. Deduping within articles only.")
+        _active_image_index = None
+    return _active_image_index
+
+def get_image_dedupe_index():
+    return _active_image_index
+
+def log_image_dedupe_stats():
+    """Ghi log số lần kiểm tra/ảnh trùng bị loại/ảnh được ghi nhận (gọi ở cuối mỗi lần chạy)."""
+    if _active_image_index is None:
+        return None
+    stats = _active_image_index.get_stats()
+    logger.info(f"Image dedupe stats: checks={stats['checks']}, duplicates={stats['duplicates']}, recorded={stats['adds']}")
+    return stats
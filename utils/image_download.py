@@ -0,0 +1,86 @@
+# utils/image_download.py
+import logging
+import tempfile
+import time
+from collections import namedtuple
+
+import requests
+
+from utils.image_probe import sniff_image_format
+
+# Khởi tạo logger
+logger = logging.getLogger(__name__)
+
+# Số byte đầu tiên cần có để nhận diện định dạng ảnh (đủ cho mọi chữ ký trong sniff_image_format)
+_SNIFF_BYTES = 16
+
+# file: file object đã seek về 0 (None khi not_modified); etag/last_modified: validator để revalidate sau này
+DownloadedImage = namedtuple('DownloadedImage', ['file', 'image_format', 'size_bytes', 'etag', 'last_modified', 'not_modified'])
+
+class ImageDownloadError(Exception):
+    """Tải ảnh thất bại hoặc bị dừng sớm. reason: 'http_error', 'not_an_image', 'too_large', 'deadline', 'request_error'."""
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+def download_image(image_url, timeout=10, max_bytes=15 * 1024 * 1024, deadline_sec=30, spool_max_memory_bytes=2 * 1024 * 1024,
+                   etag=None, last_modified=None):
+    """
+    Tải ảnh theo stream với giới hạn:
+      - Nhận diện định dạng từ magic bytes của chunk đầu tiên; không phải ảnh (vd: trang HTML lỗi) -> dừng ngay.
+      - Content-Length hoặc số byte đã đọc vượt max_bytes -> dừng ngay.
+      - Tổng thời gian tải vượt deadline_sec -> dừng (timeout chỉ giới hạn từng lần đọc socket).
+    Body được ghi vào SpooledTemporaryFile: nằm trong RAM tới spool_max_memory_bytes, lớn hơn thì chuyển ra file tạm.
+    etag/last_modified: validator của bản đã cache -> gửi request có điều kiện; server trả 304 thì
+    kết quả có not_modified=True và file=None.
+    Trả về DownloadedImage; caller phải đóng file. Raise ImageDownloadError khi thất bại.
+    """
+    started_at = time.monotonic()
+    request_headers = {}
+    if etag:
+        request_headers['If-None-Match'] = etag
+    if last_modified:
+        request_headers['If-Modified-Since'] = last_modified
+    try:
+        with requests.get(image_url, timeout=timeout, stream=True, headers=request_headers or None) as response:
+            if response.status_code == 304 and request_headers:
+                return DownloadedImage(None, None, 0, etag, last_modified, True)
+            if response.status_code >= 400:
+                raise ImageDownloadError('http_error', f"HTTP {response.status_code}")
+            content_length = response.headers.get('content-length')
+            if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+                raise ImageDownloadError('too_large', f"Content-Length {content_length} exceeds {max_bytes} bytes")
+
+            spool = tempfile.SpooledTemporaryFile(max_size=spool_max_memory_bytes, prefix="img-download-")
+            try:
+                size_bytes = 0
+                image_format = None
+                head = b''
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    if not chunk:
+                        continue
+                    if image_format is None:
+                        head = (head + chunk)[:_SNIFF_BYTES]
+                        if len(head) >= _SNIFF_BYTES:
+                            image_format = sniff_image_format(head)
+                            if image_format is None:
+                                content_type = response.headers.get('content-type', '')
+                                raise ImageDownloadError('not_an_image', f"Body is not an image (Content-Type: {content_type})")
+                    size_bytes += len(chunk)
+                    if size_bytes > max_bytes:
+                        raise ImageDownloadError('too_large', f"Body exceeds {max_bytes} bytes")
+                    if time.monotonic() - started_at > deadline_sec:
+                        raise ImageDownloadError('deadline', f"Download exceeded {deadline_sec}s deadline")
+                    spool.write(chunk)
+                if image_format is None:
+                    image_format = sniff_image_format(head)
+                    if image_format is None:
+                        raise ImageDownloadError('not_an_image', "Body is empty or not an image")
+                spool.seek(0)
+                return DownloadedImage(spool, image_format, size_bytes, response.headers.get('etag'),
+                                       response.headers.get('last-modified'), False)
+            except BaseException:
+                spool.close()
+                raise
+    except requests.exceptions.RequestException as e:
+        raise ImageDownloadError('request_error', str(e)) from e
@@ -0,0 +1,90 @@
+# utils/image_probe.py
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image, ImageFile
+
+# Khởi tạo logger
+logger = logging.getLogger(__name__)
+
+# Chữ ký đầu file (magic bytes) của các định dạng ảnh mà pipeline xử lý được
+def sniff_image_format(header_bytes):
+    """Nhận diện định dạng ảnh từ các byte đầu tiên. Trả về 'jpeg'/'png'/'gif'/'webp'/'avif'/'bmp' hoặc None."""
+    if not header_bytes:
+        return None
+    if header_bytes.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if header_bytes.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if header_bytes[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if header_bytes[:4] == b'RIFF' and header_bytes[8:12] == b'WEBP':
+        return 'webp'
+    if header_bytes[4:8] == b'ftyp' and header_bytes[8:12] in (b'avif', b'avis'):
+        return 'avif'
+    if header_bytes.startswith(b'BM'):
+        return 'bmp'
+    return None
+
+def read_image_dimensions(header_bytes):
+    """
+    Đọc (width, height) từ phần đầu file ảnh bằng parser tăng dần của Pillow (không cần toàn bộ file).
+    Trả về None nếu phần header chưa đủ để xác định kích thước.
+    """
+    parser = ImageFile.Parser()
+    try:
+        parser.feed(header_bytes)
+    except Exception:
+        pass
+    if parser.image is not None:
+        return parser.image.size
+    # Một số định dạng (vd: WebP/AVIF qua plugin) không hỗ trợ parser tăng dần: thử mở trực tiếp
+    try:
+        with Image.open(io.BytesIO(header_bytes)) as img:
+            return img.size
+    except Exception:
+        return None
+
+def probe_image_url(image_url, timeout=5, max_header_bytes=65536):
+    """
+    Kiểm tra nhanh một URL ảnh bằng GET có Range chỉ lấy phần đầu file (server bỏ qua Range thì đọc tối đa
+    max_header_bytes rồi đóng kết nối). Trả về dict: url, ok, reason, status, format, width, height.
+    ok=False khi URL chết/lỗi HTTP hoặc nội dung không phải ảnh; width/height=None nếu không đọc được header.
+    """
+    result = {'url': image_url, 'ok': False, 'reason': None, 'status': None, 'format': None, 'width': None, 'height': None}
+    try:
+        with requests.get(image_url, timeout=timeout, stream=True,
+                          headers={'Range': f'bytes=0-{max_header_bytes - 1}'}) as response:
+            result['status'] = response.status_code
+            if response.status_code >= 400:
+                result['reason'] = f"http_{response.status_code}"
+                return result
+            header_bytes = b''
+            for chunk in response.iter_content(chunk_size=8192):
+                header_bytes += chunk
+                if len(header_bytes) >= max_header_bytes:
+                    break
+    except requests.exceptions.RequestException as e:
+        result['reason'] = f"request_error: {e.__class__.__name__}"
+        return result
+
+    result['format'] = sniff_image_format(header_bytes)
+    if result['format'] is None:
+        result['reason'] = "not_an_image"
+        return result
+    dimensions = read_image_dimensions(header_bytes)
+    if dimensions:
+        result['width'], result['height'] = dimensions
+    result['ok'] = True
+    return result
+
+def probe_image_urls(image_urls, timeout=5, max_header_bytes=65536, max_workers=8):
+    """Probe song song nhiều URL ảnh. Trả về dict {url: kết quả probe_image_url}."""
+    unique_urls = list(dict.fromkeys(url for url in image_urls if url))
+    if not unique_urls:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(unique_urls))), thread_name_prefix="image-probe") as executor:
+        probes = list(executor.map(lambda url: probe_image_url(url, timeout, max_header_bytes), unique_urls))
+    return {probe['url']: probe for probe in probes}
@@ -0,0 +1,211 @@
+# utils/image_transcoder.py
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from utils.image_utils import resize_image, resize_image_variants
+
+# Khởi tạo logger
+logger = logging.getLogger(__name__)
+
+def _transcode_job(resize_fn, source, resize_options, submitted_at):
+    """
+    Chạy trong process worker: decode, xoay theo EXIF, resize LANCZOS, encode (resize_image hoặc resize_image_variants).
+    Trả về (kết quả của resize_fn, CPU time của job, thời gian chờ trong hàng đợi).
+    """
+    queue_wait_sec = max(0.0, time.time() - submitted_at)
+    cpu_started_at = time.process_time()
+    image_data = resize_fn(source, **resize_options)
+    return image_data, time.process_time() - cpu_started_at, queue_wait_sec
+
+def _prepare_job_source(source):
+    """
+    Source gửi sang worker: bytes/đường dẫn giữ nguyên; file object có đường dẫn thật (vd: ảnh gốc trong cache)
+    -> đường dẫn; SpooledTemporaryFile còn trong RAM -> bytes (nhỏ hơn ngưỡng spool); file ẩn danh đã ra đĩa
+    -> copy theo từng chunk sang file tạm có tên. Trả về (source, đường dẫn file tạm cần xóa hoặc None).
+    """
+    if isinstance(source, (bytes, str)):
+        return source, None
+    if not hasattr(source, 'read'):
+        raise TypeError("ImageTranscoder accepts image bytes, a file path or a binary file object.")
+    file_path = getattr(source, 'name', None)
+    if isinstance(file_path, str) and os.path.isfile(file_path):
+        return file_path, None
+    source.seek(0)
+    if isinstance(source, tempfile.SpooledTemporaryFile) and not source._rolled:
+        return source.read(), None
+    fd, tmp_path = tempfile.mkstemp(prefix="img-transcode-")
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            shutil.copyfileobj(source, tmp_file)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, tmp_path
+
+def _remove_job_source(tmp_path):
+    if tmp_path:
+        try:
+            os.remove(tmp_path)
+        except OSError as e:
+            logger.debug(f"Could not remove transcode temp file {tmp_path}: {e}")
+
+def _default_mp_context():
+    # Process chính có nhiều thread (event loop LLM, thread pool ảnh) nên không fork trực tiếp:
+    # forkserver (Linux) hoặc spawn (macOS/Windows)
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(start_method)
+
+class ImageTranscoder:
+    """
+    Process pool cho phần tốn CPU của xử lý ảnh (resize_image), để Pillow không giữ GIL
+    của process chính trong lúc các thread mạng (LLM, tải ảnh, upload) đang chạy.
+    Nhận bytes, đường dẫn file hoặc file object (file object không pickle được nên worker nhận đường dẫn,
+    xem _prepare_job_source), trả về bytes đã encode.
+    """
+    def __init__(self, max_workers=2):
+        self.max_workers = max(1, int(max_workers))
+        self._lock = threading.Lock()
+        self._executor = None
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'queue_depth': 0, 'max_queue_depth': 0,
+                       'cpu_sec': 0.0, 'queue_wait_sec': 0.0, 'max_cpu_sec': 0.0}
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=_default_mp_context())
+            return self._executor
+
+    def _reset_broken_executor(self, broken_executor):
+        with self._lock:
+            if self._executor is broken_executor:
+                self._executor = None
+        broken_executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, source, resize_fn=resize_image, **resize_options):
+        """
+        Gửi một job resize/encode vào pool. Trả về concurrent.futures.Future với kết quả của resize_fn
+        (resize_image: bytes; resize_image_variants: list variant; None nếu ảnh lỗi).
+        resize_fn phải là hàm cấp module để pickle được sang process worker.
+        """
+        source, tmp_path = _prepare_job_source(source)
+        result_future = Future()
+        with self._lock:
+            self._stats['submitted'] += 1
+            self._stats['queue_depth'] += 1
+            self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], self._stats['queue_depth'])
+
+        executor = self._get_executor()
+        try:
+            job_future = executor.submit(_transcode_job, resize_fn, source, resize_options, time.time())
+        except (BrokenProcessPool, RuntimeError) as e:
+            _remove_job_source(tmp_path)
+            self._finish_job(result_future, error=e, executor=executor)
+            return result_future
+
+        def on_done(done_future):
+            _remove_job_source(tmp_path)
+            try:
+                image_data, cpu_sec, queue_wait_sec = done_future.result()
+            except Exception as e:
+                self._finish_job(result_future, error=e, executor=executor)
+                return
+            self._finish_job(result_future, image_data=image_data, cpu_sec=cpu_sec, queue_wait_sec=queue_wait_sec)
+        job_future.add_done_callback(on_done)
+        return result_future
+
+    def _finish_job(self, result_future, image_data=None, cpu_sec=0.0, queue_wait_sec=0.0, error=None, executor=None):
+        with self._lock:
+            self._stats['queue_depth'] -= 1
+            if error is not None or image_data is None: # dHash 0 là kết quả hợp lệ
+                self._stats['failed'] += 1
+            else:
+                self._stats['completed'] += 1
+            self._stats['cpu_sec'] += cpu_sec
+            self._stats['queue_wait_sec'] += queue_wait_sec
+            self._stats['max_cpu_sec'] = max(self._stats['max_cpu_sec'], cpu_sec)
+        if error is not None:
+            logger.error(f"Image transcode job failed: {error}")
+            if isinstance(error, BrokenProcessPool) and executor is not None:
+                self._reset_broken_executor(executor) # Worker chết (vd: OOM): tạo pool mới cho job sau
+            result_future.set_result(None)
+            return
+        logger.debug(f"Image transcode job done: cpu={cpu_sec:.3f}s, queue_wait={queue_wait_sec:.3f}s")
+        result_future.set_result(image_data)
+
+    def transcode(self, source, timeout=None, resize_fn=resize_image, **resize_options):
+        """Gửi job và chờ kết quả."""
+        return self.submit(source, resize_fn=resize_fn, **resize_options).result(timeout=timeout)
+
+    async def transcode_async(self, source, resize_fn=resize_image, **resize_options):
+        """Phiên bản await được cho code chạy trên event loop."""
+        return await asyncio.wrap_future(self.submit(source, resize_fn=resize_fn, **resize_options))
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+# Pool dùng chung cho process, None khi bị tắt (resize chạy ngay trong thread gọi)
+_active_transcoder = None
+
+def configure_image_transcoder(config):
+    """Bật/tắt pool theo config (IMAGE_TRANSCODER_ENABLED, IMAGE_TRANSCODER_MAX_WORKERS)."""
+    global _active_transcoder
+    shutdown_image_transcoder()
+    if not config.get('IMAGE_TRANSCODER_ENABLED', False):
+        logger.info("Image transcoder process pool is disabled. Images are resized in-thread.")
+        return None
+    max_workers = config.get('IMAGE_TRANSCODER_MAX_WORKERS') or min(4, os.cpu_count() or 1)
+    _active_transcoder = ImageTranscoder(max_workers=max_workers)
+    logger.info(f"Image transcoder process pool enabled with {_active_transcoder.max_workers} worker(s).")
+    return _active_transcoder
+
+def get_image_transcoder():
+    return _active_transcoder
+
+def transcode_image(source, **resize_options):
+    """
+    Resize/encode ảnh (cùng tham số với resize_image, không hỗ trợ output_path) qua process pool nếu được bật,
+    nếu không thì chạy trực tiếp. Trả về bytes hoặc None.
+    """
+    if _active_transcoder is None:
+        return resize_image(source, **resize_options)
+    return _active_transcoder.transcode(source, **resize_options)
+
+def transcode_image_variants(source, **variant_options):
+    """Tạo các bản resize cho srcset (cùng tham số với resize_image_variants) qua process pool nếu được bật."""
+    if _active_transcoder is None:
+        return resize_image_variants(source, **variant_options)
+    return _active_transcoder.transcode(source, resize_fn=resize_image_variants, **variant_options)
+
+def shutdown_image_transcoder():
+    global _active_transcoder
+    if _active_transcoder is not None:
+        _active_transcoder.shutdown()
+        _active_transcoder = None
+
+def log_image_transcoder_stats():
+    """Ghi log số job, độ sâu hàng đợi và CPU time của pool (gọi ở cuối mỗi lần chạy)."""
+    if _active_transcoder is None:
+        return None
+    stats = _active_transcoder.get_stats()
+    finished = stats['completed'] + stats['failed']
+    avg_cpu = stats['cpu_sec'] / finished if finished else 0.0
+    avg_wait = stats['queue_wait_sec'] / finished if finished else 0.0
+    logger.info(f"Image transcoder stats: jobs={stats['submitted']}, completed={stats['completed']}, failed={stats['failed']}, "
+                f"max_queue_depth={stats['max_queue_depth']}, cpu={stats['cpu_sec']:.2f}s (avg {avg_cpu:.3f}s, max {stats['max_cpu_sec']:.3f}s), "
+                f"avg_queue_wait={avg_wait:.3f}s")
+    return stats
@@ -1,5 +1,5 @@
 # utils/image_utils.py
-from PIL import Image, UnidentifiedImageError, ExifTags
+from PIL import Image, ImageCms, ImageOps, UnidentifiedImageError
 import io
 import logging
 import os
@@ -7,39 +7,181 @@ import os
 # Khởi tạo logger
 logger = logging.getLogger(__name__)
 
+# Tag EXIF Orientation
+_EXIF_ORIENTATION_TAG = 0x0112
+# Các giá trị orientation làm ảnh xoay 90/270 độ (width/height đổi chỗ sau khi transpose)
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+# reducing_gap cho resize/thumbnail: thu nhỏ bằng reduce() (nhanh) trước, chỉ LANCZOS ở bước cuối.
+# 3.0 cho kết quả gần như không phân biệt được với LANCZOS thuần.
+_RESIZE_REDUCING_GAP = 3.0
+# Chỉ dùng draft (JPEG reduce-on-decode) khi ảnh đích nhỏ hơn ảnh gốc ít nhất chừng này lần
+_DRAFT_MIN_DOWNSCALE = 2
+
+# Định dạng ảnh xuất mà pipeline hỗ trợ: (MIME type, phần mở rộng file)
+OUTPUT_FORMATS = {
+    'AVIF': ('image/avif', 'avif'),
+    'WEBP': ('image/webp', 'webp'),
+    'JPEG': ('image/jpeg', 'jpg'),
+    'PNG': ('image/png', 'png'),
+}
+# Định dạng có tham số quality (lossy) và cần ảnh RGB/L (không alpha/palette/CMYK) khi encode
+_LOSSY_FORMATS = ('JPEG', 'JPG', 'WEBP', 'AVIF')
+
+def choose_output_format(preferred_formats=None):
+    """
+    Chọn định dạng xuất đầu tiên trong preferred_formats (thứ tự ưu tiên, vd: ['AVIF', 'WEBP', 'JPEG'])
+    mà bản Pillow đang chạy encode được. Không có định dạng nào dùng được -> 'JPEG'.
+    """
+    Image.init() # Nạp đủ plugin (kể cả AVIF nếu bản build có) trước khi kiểm tra Image.SAVE
+    for image_format in preferred_formats or ['JPEG']:
+        image_format = str(image_format).upper()
+        if image_format in OUTPUT_FORMATS and image_format in Image.SAVE:
+            return image_format
+    logger.warning(f"None of the preferred output formats {preferred_formats} can be encoded by this Pillow build. Using JPEG.")
+    return 'JPEG'
+
+def get_output_mime_type(output_format):
+    return OUTPUT_FORMATS.get(output_format.upper(), (f"image/{output_format.lower()}", None))[0]
+
+def get_output_extension(output_format):
+    return OUTPUT_FORMATS.get(output_format.upper(), (None, output_format.lower()))[1]
+
+def _convert_to_srgb(image):
+    """
+    Ảnh có ICC profile khác sRGB (vd: Adobe RGB của ảnh nhà sản xuất) được chuyển sang sRGB để
+    bỏ ICC khi encode mà màu không bị lệch; ảnh sRGB hoặc không có ICC giữ nguyên.
+    """
+    icc_profile = image.info.get('icc_profile')
+    if not icc_profile or image.mode not in ('RGB', 'RGBA'):
+        return image
+    try:
+        source_profile = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+        if 'srgb' in (ImageCms.getProfileDescription(source_profile) or '').lower():
+            return image
+        converted = ImageCms.profileToProfile(image, source_profile, ImageCms.createProfile('sRGB'), outputMode=image.mode)
+        logger.debug("Converted image from embedded ICC profile to sRGB.")
+        return converted or image
+    except Exception as e:
+        logger.warning(f"Could not convert ICC profile to sRGB, dropping it: {e}")
+        return image
+
+def _get_save_params(output_format, quality):
+    """
+    Tham số encode theo định dạng. Không truyền exif/icc_profile nên EXIF (GPS, thông tin máy ảnh...)
+    và ICC không được ghi vào file xuất.
+    """
+    output_format = output_format.upper()
+    if output_format in ('JPEG', 'JPG'):
+        return {'quality': quality, 'optimize': True, 'progressive': True} # progressive: hiện dần khi tải trang
+    if output_format == 'WEBP':
+        return {'quality': quality, 'method': 5} # method 5: nén tốt hơn mặc định, vẫn đủ nhanh cho ảnh ~700px
+    if output_format == 'AVIF':
+        return {'quality': quality}
+    if output_format == 'PNG':
+        return {'optimize': True}
+    return {}
+
+def _encode_image(img, output_format, quality):
+    buffer = io.BytesIO()
+    img.save(buffer, format=output_format, **_get_save_params(output_format, quality))
+    return buffer.getvalue()
+
+def _encode_within_budget(img, output_format, max_quality, max_bytes=None, min_quality=50):
+    """
+    Encode ảnh với quality cao nhất (<= max_quality) mà kích thước file <= max_bytes (tìm nhị phân trên quality).
+    Không có quality nào >= min_quality đạt budget -> trả về bản ở min_quality.
+    Trả về (bytes, quality đã dùng).
+    """
+    encoded = _encode_image(img, output_format, max_quality)
+    if not max_bytes or len(encoded) <= max_bytes or output_format.upper() not in _LOSSY_FORMATS:
+        return encoded, max_quality
+    best, best_quality = None, None
+    low, high = min(min_quality, max_quality), max_quality - 1
+    while low <= high:
+        quality = (low + high) // 2
+        candidate = _encode_image(img, output_format, quality)
+        if len(candidate) <= max_bytes:
+            best, best_quality = candidate, quality
+            low = quality + 1
+        else:
+            high = quality - 1
+    if best is None:
+        best_quality = min(min_quality, max_quality)
+        best = _encode_image(img, output_format, best_quality)
+        logger.warning(f"Image exceeds byte budget even at quality {best_quality}: {len(best)} > {max_bytes} bytes.")
+    return best, best_quality
+
+def _get_exif_orientation(image):
+    try:
+        return image.getexif().get(_EXIF_ORIENTATION_TAG)
+    except Exception:
+        return None
+
 def _preserve_orientation(image):
     """
-    Checks for EXIF orientation data and rotates the image accordingly.
-    Returns the potentially rotated image.
+    Checks for EXIF orientation data and rotates/flips the image accordingly (all 8 orientations).
+    Returns the potentially transposed image.
     """
+    orientation = _get_exif_orientation(image)
+    if orientation in (None, 1):
+        return image # Không cần transpose: tránh exif_transpose tạo bản copy của cả ảnh
     try:
-        # Tìm tag orientation trong EXIF data
-        for orientation_tag in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[orientation_tag] == 'Orientation':
-                break
-        
-        exif = image._getexif() # Lấy EXIF data (nếu có)
-        if exif is not None:
-            orientation = exif.get(orientation_tag)
-            logger.debug(f"Original image orientation from EXIF: {orientation}")
-
-            if orientation == 3:
-                image = image.rotate(180, expand=True)
-                logger.info("Image rotated 180 degrees based on EXIF orientation.")
-            elif orientation == 6:
-                image = image.rotate(270, expand=True)
-                logger.info("Image rotated 270 degrees (CW) based on EXIF orientation.")
-            elif orientation == 8:
-                image = image.rotate(90, expand=True)
-                logger.info("Image rotated 90 degrees (CW) based on EXIF orientation.")
-            # Các trường hợp khác (1, 2, 4, 5, 7) có thể liên quan đến lật ảnh (flip)
-            # Hiện tại chúng ta chỉ xử lý các trường hợp xoay phổ biến.
-            # Orientation 1 là bình thường, không cần làm gì.
-    except (AttributeError, KeyError, IndexError, TypeError):
-        # Lỗi khi đọc EXIF data hoặc tag không tồn tại
+        image = ImageOps.exif_transpose(image)
+        logger.info(f"Image transposed based on EXIF orientation {orientation}.")
+    except Exception:
         logger.warning("Could not read or apply EXIF orientation data.", exc_info=False) # exc_info=False để không log traceback
     return image
 
+def _draft_jpeg_for_target(img, width, height, preserve_aspect_ratio):
+    """
+    JPEG reduce-on-decode: yêu cầu libjpeg decode ở tỉ lệ 1/2, 1/4 hoặc 1/8 khi ảnh đích nhỏ hơn nhiều,
+    giảm mạnh CPU và RAM lúc decode. Kích thước decode luôn >= kích thước cần cho bước resize cuối.
+    """
+    if img.format != 'JPEG' or not (width or height):
+        return
+    source_w, source_h = img.size
+    display_w, display_h = source_w, source_h
+    if _get_exif_orientation(img) in _TRANSPOSED_ORIENTATIONS:
+        display_w, display_h = source_h, source_w
+    scales = [target / source for target, source in ((width, display_w), (height, display_h)) if target]
+    # Giữ aspect ratio với cả width/height -> ảnh phải vừa cả hai (scale nhỏ nhất); resize chính xác -> scale lớn nhất
+    scale = min(scales) if preserve_aspect_ratio else max(scales)
+    if scale * _DRAFT_MIN_DOWNSCALE > 1:
+        return
+    requested_size = (max(1, int(source_w * scale) + 1), max(1, int(source_h * scale) + 1))
+    img.draft('RGB', requested_size)
+    logger.debug(f"JPEG draft decode: {source_w}x{source_h} -> {img.size[0]}x{img.size[1]} (requested {requested_size})")
+
+
+def _open_image(image_path_or_binary):
+    """Mở ảnh (lazy, chưa decode) từ đường dẫn, bytes hoặc file object. Trả về None nếu input không hợp lệ."""
+    if isinstance(image_path_or_binary, str):
+        if not os.path.exists(image_path_or_binary):
+            logger.error(f"Image file not found at: {image_path_or_binary}")
+            return None
+        img = Image.open(image_path_or_binary)
+        logger.info(f"Opened image from path: {image_path_or_binary}")
+    elif isinstance(image_path_or_binary, bytes):
+        img = Image.open(io.BytesIO(image_path_or_binary))
+        logger.info("Opened image from binary data.")
+    elif hasattr(image_path_or_binary, 'read'):
+        # File object (vd: SpooledTemporaryFile từ utils/image_download.py), không cần đọc hết vào RAM
+        img = Image.open(image_path_or_binary)
+        logger.info("Opened image from file object.")
+    else:
+        logger.error("Invalid image input type. Must be path (str), binary (bytes) or a file object.")
+        return None
+    return img
+
+def _prepare_for_encoding(img, output_format):
+    """Chuẩn hóa mode và màu trước khi encode."""
+    # Chuyển đổi sang RGB nếu là ảnh RGBA (có kênh alpha), palette, CMYK... để lưu JPEG/WEBP/AVIF không lỗi
+    # Trừ khi output là PNG hoặc GIF có thể giữ alpha. Ảnh đã là RGB (hoặc grayscale L) thì bỏ qua.
+    if output_format.upper() in _LOSSY_FORMATS and img.mode not in ('RGB', 'L'):
+        logger.debug(f"Image mode is {img.mode}. Converting to RGB for {output_format} output.")
+        img = img.convert("RGB")
+    # EXIF/ICC không được ghi vào file xuất: chuyển màu về sRGB trước để bỏ ICC mà không lệch màu
+    return _convert_to_srgb(img)
 
 def resize_image(
     image_path_or_binary,
@@ -49,40 +191,39 @@ def resize_image(
     output_format='JPEG',
     quality=85,
     only_if_larger=True,
-    preserve_aspect_ratio=True
+    preserve_aspect_ratio=True,
+    fast_path=True,
+    max_bytes=None,
+    min_quality=50
 ):
     """
     Resizes an image using Pillow.
     Can take an image path or binary data as input.
     If output_path is None, returns the resized image as binary data in memory.
 
-    :param image_path_or_binary: Path to the image file or binary image data (bytes).
+    :param image_path_or_binary: Path to the image file, binary image data (bytes) or a binary file object.
     :param output_path: Path to save the resized image. If None, returns binary data.
     :param width: Desired width. If None and height is provided, scales by height.
     :param height: Desired height. If None and width is provided, scales by width.
                    If both are None, no resize happens but format conversion can still occur.
     :param output_format: Desired output format (e.g., 'JPEG', 'PNG', 'WEBP').
-    :param quality: Quality for JPEG/WEBP (1-95 for JPEG, 1-100 for WEBP).
+    :param quality: Quality for JPEG/WEBP/AVIF (1-95 for JPEG, 1-100 for WEBP/AVIF). With max_bytes, this is the maximum quality.
     :param only_if_larger: If True, only resizes if the original image is larger than target dimensions.
     :param preserve_aspect_ratio: If True, maintains aspect ratio. If False and both width/height
                                   are given, it will crop/stretch (Pillow's thumbnail crops by default).
                                   For this function, if False and both width/height given, it will resize
                                   to exact dimensions, potentially changing aspect ratio.
+    :param fast_path: If True, uses JPEG reduce-on-decode (draft) and reducing_gap when downscaling.
+                      False keeps the plain full decode + LANCZOS path (used as a baseline by benchmark_image_resize.py).
+    :param max_bytes: Byte budget for the encoded image (lossy formats). Quality is lowered (not below min_quality)
+                      until the output fits. None disables the search.
+    :param min_quality: Lowest quality the byte-budget search may use.
     :return: Path to the saved image if output_path is provided,
              otherwise binary data of the resized image (bytes). Returns None on error.
     """
     try:
-        if isinstance(image_path_or_binary, str):
-            if not os.path.exists(image_path_or_binary):
-                logger.error(f"Image file not found at: {image_path_or_binary}")
-                return None
-            img = Image.open(image_path_or_binary)
-            logger.info(f"Opened image from path: {image_path_or_binary}")
-        elif isinstance(image_path_or_binary, bytes):
-            img = Image.open(io.BytesIO(image_path_or_binary))
-            logger.info("Opened image from binary data.")
-        else:
-            logger.error("Invalid image input type. Must be path (str) or binary (bytes).")
+        img = _open_image(image_path_or_binary)
+        if img is None:
             return None
 
         # Giữ nguyên định dạng nếu có thể và cần thiết (ví dụ ảnh động GIF)
@@ -95,11 +236,17 @@ def resize_image(
             logger.warning("GIF resizing might result in static image. Animation may be lost unless handled specifically.")
 
 
+        source_format = img.format
+        # Decode JPEG ở kích thước nhỏ hơn nếu ảnh đích nhỏ hơn nhiều (phải gọi trước khi ảnh được load)
+        if fast_path:
+            _draft_jpeg_for_target(img, width, height, preserve_aspect_ratio)
+        reducing_gap = _RESIZE_REDUCING_GAP if fast_path else None
+
         # Xử lý xoay ảnh theo EXIF
         img = _preserve_orientation(img)
 
         original_width, original_height = img.size
-        logger.debug(f"Original image dimensions: {original_width}x{original_height}, Format: {img.format}")
+        logger.debug(f"Original image dimensions: {original_width}x{original_height}, Format: {source_format}")
 
         # Xác định kích thước mới
         target_w, target_h = width, height
@@ -114,21 +261,21 @@ def resize_image(
             if preserve_aspect_ratio:
                 if target_w and target_h: # Cả width và height đều được cung cấp
                     # Giữ aspect ratio, thu nhỏ để vừa cả width và height (thumbnail behavior)
-                    img.thumbnail((target_w, target_h), Image.Resampling.LANCZOS)
+                    img.thumbnail((target_w, target_h), Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
                     logger.info(f"Resized image (preserving aspect ratio to fit within {target_w}x{target_h}) to: {img.size[0]}x{img.size[1]}")
                 elif target_w: # Chỉ có width
                     aspect_ratio = original_height / original_width
                     new_height = int(target_w * aspect_ratio)
-                    img = img.resize((target_w, new_height), Image.Resampling.LANCZOS)
+                    img = img.resize((target_w, new_height), Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
                     logger.info(f"Resized image (preserving aspect ratio by width {target_w}) to: {img.size[0]}x{img.size[1]}")
                 elif target_h: # Chỉ có height
                     aspect_ratio = original_width / original_height
                     new_width = int(target_h * aspect_ratio)
-                    img = img.resize((new_width, target_h), Image.Resampling.LANCZOS)
+                    img = img.resize((new_width, target_h), Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
                     logger.info(f"Resized image (preserving aspect ratio by height {target_h}) to: {img.size[0]}x{img.size[1]}")
             else: # Không giữ aspect ratio (nếu cả width và height được cung cấp)
                 if target_w and target_h:
-                    img = img.resize((target_w, target_h), Image.Resampling.LANCZOS)
+                    img = img.resize((target_w, target_h), Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
                     logger.info(f"Resized image (exact dimensions, aspect ratio may change) to: {target_w}x{target_h}")
                 else:
                     # Nếu chỉ có width hoặc height và preserve_aspect_ratio=False, hành vi giống True
@@ -137,50 +284,27 @@ def resize_image(
                     if target_w:
                         aspect_ratio = original_height / original_width
                         new_height = int(target_w * aspect_ratio)
-                        img = img.resize((target_w, new_height), Image.Resampling.LANCZOS)
+                        img = img.resize((target_w, new_height), Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
                     elif target_h:
                         aspect_ratio = original_width / original_height
                         new_width = int(target_h * aspect_ratio)
-                        img = img.resize((new_width, target_h), Image.Resampling.LANCZOS)
+                        img = img.resize((new_width, target_h), Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
 
 
-        # Chuyển đổi sang RGB nếu là ảnh RGBA (có kênh alpha) để lưu JPEG/WEBP không lỗi
-        # Trừ khi output là PNG hoặc GIF có thể giữ alpha
-        if output_format.upper() in ['JPEG', 'JPG', 'WEBP'] and img.mode in ('RGBA', 'P'): # 'P' là palette-based
-            logger.debug(f"Image mode is {img.mode}. Converting to RGB for {output_format} output.")
-            img = img.convert("RGB")
+        img = _prepare_for_encoding(img, output_format)
 
         # Lưu hoặc trả về binary
+        image_bytes, used_quality = _encode_within_budget(img, output_format, quality, max_bytes, min_quality)
         if output_path:
             # Tạo thư mục nếu chưa tồn tại
             os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            
-            save_params = {}
-            if output_format.upper() in ['JPEG', 'JPG']:
-                save_params['quality'] = quality
-                save_params['optimize'] = True # Cố gắng tối ưu hóa
-                save_params['progressive'] = True # Tạo JPEG progressive
-            elif output_format.upper() == 'PNG':
-                save_params['optimize'] = True
-            elif output_format.upper() == 'WEBP':
-                save_params['quality'] = quality
-                # save_params['lossless'] = False # Mặc định là lossy
-            
-            img.save(output_path, format=output_format, **save_params)
-            logger.info(f"Resized image saved to: {output_path} (Format: {output_format}, Quality: {quality if output_format.upper() in ['JPEG', 'WEBP'] else 'N/A'})")
+            with open(output_path, 'wb') as output_file:
+                output_file.write(image_bytes)
+            logger.info(f"Resized image saved to: {output_path} (Format: {output_format}, Quality: {used_quality if output_format.upper() in _LOSSY_FORMATS else 'N/A'})")
             return output_path
         else:
-            img_byte_arr = io.BytesIO()
-            save_params_in_memory = {}
-            if output_format.upper() in ['JPEG', 'JPG']:
-                save_params_in_memory['quality'] = quality
-            elif output_format.upper() == 'WEBP':
-                 save_params_in_memory['quality'] = quality
-
-            img.save(img_byte_arr, format=output_format, **save_params_in_memory)
-            img_byte_arr = img_byte_arr.getvalue()
-            logger.info(f"Resized image returned as binary data (Format: {output_format}, Size: {len(img_byte_arr)} bytes).")
-            return img_byte_arr
+            logger.info(f"Resized image returned as binary data (Format: {output_format}, Quality: {used_quality}, Size: {len(image_bytes)} bytes).")
+            return image_bytes
 
     except UnidentifiedImageError:
         logger.error(f"Cannot identify image file. It might be corrupted or not a valid image: {str(image_path_or_binary)[:100]}")
@@ -192,6 +316,80 @@ def resize_image(
         logger.error(f"Error resizing image '{str(image_path_or_binary)[:100]}...': {e}", exc_info=True) # exc_info=True để log traceback
         return None
 
+def _fit_size(source_width, source_height, box_width, box_height=None):
+    """Kích thước lớn nhất (giữ aspect ratio, không phóng to) vừa trong khung box_width x box_height."""
+    scale = box_width / source_width
+    if box_height:
+        scale = min(scale, box_height / source_height)
+    scale = min(scale, 1.0)
+    return max(1, round(source_width * scale)), max(1, round(source_height * scale))
+
+def resize_image_variants(
+    image_path_or_binary,
+    widths,
+    height_ratio=None,
+    output_format='JPEG',
+    quality=85,
+    max_bytes=None,
+    budget_width=None,
+    min_quality=50,
+    fast_path=True
+):
+    """
+    Tạo nhiều bản resize (responsive srcset) theo các chiều rộng trong widths, chỉ decode ảnh gốc một lần.
+    Mỗi variant vừa trong khung width x (width * height_ratio) (height_ratio=None: chỉ giới hạn width),
+    không phóng to; các width lớn hơn ảnh gốc cho ra cùng một kích thước nên chỉ giữ một bản.
+
+    :param max_bytes: Byte budget ứng với variant rộng budget_width (mặc định: width lớn nhất);
+                      variant khác có budget tỉ lệ theo số pixel.
+    :return: List dict {'width', 'height', 'quality', 'data', 'box_widths'} sắp theo width tăng dần
+             (box_widths: các width trong widths cho ra variant này), hoặc None nếu lỗi.
+    """
+    if not widths:
+        return None
+    box_widths = sorted({int(width) for width in widths if width})
+    try:
+        img = _open_image(image_path_or_binary)
+        if img is None:
+            return None
+        # Decode một lần, ở kích thước đủ cho variant lớn nhất
+        largest_box_height = int(box_widths[-1] * height_ratio) if height_ratio else None
+        if fast_path:
+            _draft_jpeg_for_target(img, box_widths[-1], largest_box_height, True)
+        img = _prepare_for_encoding(_preserve_orientation(img), output_format)
+        img.load()
+
+        budget_width = budget_width or box_widths[-1]
+        budget_size = _fit_size(img.size[0], img.size[1], budget_width, int(budget_width * height_ratio) if height_ratio else None)
+        variants = {}
+        for box_width in reversed(box_widths): # Từ lớn tới nhỏ
+            box_height = int(box_width * height_ratio) if height_ratio else None
+            target_size = _fit_size(img.size[0], img.size[1], box_width, box_height)
+            if target_size in variants:
+                variants[target_size]['box_widths'].append(box_width)
+                continue
+            if target_size == img.size:
+                resized = img
+            else:
+                resized = img.resize(target_size, Image.Resampling.LANCZOS,
+                                     reducing_gap=_RESIZE_REDUCING_GAP if fast_path else None)
+            variant_max_bytes = None
+            if max_bytes:
+                pixel_ratio = (target_size[0] * target_size[1]) / (budget_size[0] * budget_size[1])
+                variant_max_bytes = max(1, int(max_bytes * pixel_ratio))
+            image_bytes, used_quality = _encode_within_budget(resized, output_format, quality, variant_max_bytes, min_quality)
+            variants[target_size] = {'width': target_size[0], 'height': target_size[1], 'quality': used_quality,
+                                     'data': image_bytes, 'box_widths': [box_width]}
+        logger.info(f"Resized image into {len(variants)} variant(s) (Format: {output_format}): " +
+                    ", ".join(f"{v['width']}x{v['height']}={len(v['data'])}B" for v in variants.values()))
+        return sorted(variants.values(), key=lambda variant: variant['width'])
+    except UnidentifiedImageError:
+        logger.error(f"Cannot identify image file. It might be corrupted or not a valid image: {str(image_path_or_binary)[:100]}")
+        return None
+    except Exception as e:
+        logger.error(f"Error creating image variants '{str(image_path_or_binary)[:100]}...': {e}", exc_info=True)
+        return None
+
 # --- Example Usage ---
 # if __name__ == "__main__":
 #     # from utils.logging_config import setup_logging
@@ -0,0 +1,224 @@
+# utils/json_repair.py
+import json
+import logging
+import re
+import threading
+
+# Khởi tạo logger
+logger = logging.getLogger(__name__)
+
+_CODE_FENCE_RE = re.compile(r"```(?:json|JSON)?\s*(.*?)```", re.DOTALL)
+_SMART_QUOTES = {
+    '“': '"', '”': '"', '„': '"', '‟': '"',
+    '‘': "'", '’': "'", '‚': "'", '‛': "'",
+}
+
+def _strip_code_fences(text):
+    """Lấy nội dung trong ```json ... ``` nếu có."""
+    match = _CODE_FENCE_RE.search(text)
+    return match.group(1).strip() if match else text.strip()
+
+def _extract_first_balanced_json(text):
+    """
+    Trích xuất object {...} hoặc array [...] cân bằng đầu tiên trong chuỗi (bỏ qua ngoặc nằm trong string).
+    Trả về None nếu không tìm thấy.
+    """
+    start = None
+    for idx, char in enumerate(text):
+        if char in '{[':
+            start = idx
+            break
+    if start is None:
+        return None
+
+    stack = []
+    in_string = False
+    escaped = False
+    for idx in range(start, len(text)):
+        char = text[idx]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]':
+            if not stack or stack[-1] != char:
+                return None
+            stack.pop()
+            if not stack:
+                return text[start:idx + 1]
+    return None
+
+def _last_significant_index(chars):
+    """Vị trí ký tự không phải khoảng trắng cuối cùng trong list ký tự, -1 nếu không có."""
+    idx = len(chars) - 1
+    while idx >= 0 and chars[idx].isspace():
+        idx -= 1
+    return idx
+
+def _fix_outside_strings(text):
+    """
+    Sửa lỗi cú pháp phổ biến, chỉ ở phần nằm ngoài string:
+    - dấu phẩy thừa trước } hoặc ]
+    - thiếu dấu phẩy giữa hai phần tử nằm trên hai dòng ("a": "x"\n "b": ...)
+    """
+    result = []
+    in_string = False
+    escaped = False
+    for char in text:
+        if in_string:
+            result.append(char)
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            last_idx = _last_significant_index(result)
+            if last_idx >= 0 and '\n' in result[last_idx + 1:]:
+                tail = ''.join(result[max(0, last_idx - 4):last_idx + 1])
+                if result[last_idx] in '"}]' or result[last_idx].isdigit() or tail.endswith(('true', 'false', 'null')):
+                    result.insert(last_idx + 1, ',')
+            in_string = True
+        elif char in '}]':
+            last_idx = _last_significant_index(result)
+            if last_idx >= 0 and result[last_idx] == ',':
+                del result[last_idx]
+        result.append(char)
+    return ''.join(result)
+
+def _replace_smart_quotes(text):
+    for smart_quote, plain_quote in _SMART_QUOTES.items():
+        text = text.replace(smart_quote, plain_quote)
+    return text
+
+def parse_json_with_repair(raw_text):
+    """
+    Parse JSON từ output LLM, sửa các lỗi phổ biến nếu cần.
+    Trả về (parsed_value, was_repaired). Raise ValueError nếu không thể khôi phục.
+    Các bước (dừng ở bước đầu tiên parse được):
+      1. json.loads nguyên bản
+      2. bỏ code fence, trích object/array cân bằng đầu tiên
+      3. sửa dấu phẩy thừa/thiếu ngoài string
+      4. thay smart quotes bằng quote thường
+    """
+    if raw_text is None:
+        raise ValueError("Empty LLM response")
+    try:
+        return json.loads(raw_text), False
+    except (json.JSONDecodeError, TypeError):
+        pass
+
+    candidate = _strip_code_fences(str(raw_text))
+    extracted = _extract_first_balanced_json(candidate)
+    if extracted is None:
+        # Có thể ngoặc bị mất cân bằng do smart quotes -> thử lại sau khi thay
+        extracted = _extract_first_balanced_json(_replace_smart_quotes(candidate))
+        if extracted is None:
+            raise ValueError("No JSON object or array found in LLM response")
+
+    attempts = [
+        lambda text: text,
+        _fix_outside_strings,
+        lambda text: _fix_outside_strings(_replace_smart_quotes(text)),
+    ]
+    last_error = None
+    for transform in attempts:
+        try:
+            return json.loads(transform(extracted)), True
+        except json.JSONDecodeError as e:
+            last_error = e
+    raise ValueError(f"Could not repair JSON from LLM response: {last_error}")
+
+_JSON_TYPE_CHECKS = {
+    'object': lambda value: isinstance(value, dict),
+    'array': lambda value: isinstance(value, list),
+    'string': lambda value: isinstance(value, str),
+    'integer': lambda value: isinstance(value, int) and not isinstance(value, bool),
+    'number': lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    'boolean': lambda value: isinstance(value, bool),
+    'null': lambda value: value is None,
+}
+
+def validate_json_schema(value, schema, path="$"):
+    """
+    Kiểm tra value theo một tập con nhỏ của JSON Schema: type, required, properties, items, minItems, anyOf.
+    Trả về list thông báo lỗi (rỗng nếu hợp lệ).
+    """
+    if not schema:
+        return []
+    if 'anyOf' in schema:
+        branch_errors = [validate_json_schema(value, option, path) for option in schema['anyOf']]
+        if any(not errors for errors in branch_errors):
+            return []
+        return [f"{path}: does not match any allowed shape ({'; '.join(branch_errors[0])})"]
+
+    errors = []
+    expected_type = schema.get('type')
+    if expected_type and not _JSON_TYPE_CHECKS[expected_type](value):
+        return [f"{path}: expected {expected_type}, got {type(value).__name__}"]
+
+    if isinstance(value, dict):
+        for key in schema.get('required', []):
+            if key not in value:
+                errors.append(f"{path}: missing required key '{key}'")
+        for key, sub_schema in schema.get('properties', {}).items():
+            if key in value:
+                errors.extend(validate_json_schema(value[key], sub_schema, f"{path}.{key}"))
+    elif isinstance(value, list):
+        if len(value) < schema.get('minItems', 0):
+            errors.append(f"{path}: expected at least {schema['minItems']} items, got {len(value)}")
+        item_schema = schema.get('items')
+        if item_schema:
+            for idx, item in enumerate(value):
+                errors.extend(validate_json_schema(item, item_schema, f"{path}[{idx}]"))
+    return errors
+
+def build_structured_output_format(schema, name):
+    """
+    Tạo response_format kiểu "json_schema" (structured outputs) từ schema.
+    Chỉ áp dụng được khi root là object (API không nhận anyOf/array ở root); trả về None nếu không dùng được.
+    strict=False vì schema chỉ mô tả các key code cần đọc, không liệt kê hết mọi key.
+    """
+    if not schema or schema.get('type') != 'object' or 'anyOf' in schema:
+        return None
+    safe_name = re.sub(r'[^a-zA-Z0-9_-]', '_', name or 'response')[:64]
+    return {"type": "json_schema", "json_schema": {"name": safe_name, "schema": schema, "strict": False}}
+
+# Thống kê theo call site: parse thẳng / sửa cục bộ thành công / phải gọi lại LLM / thất bại hẳn
+_json_stats = {}
+_json_stats_lock = threading.Lock()
+
+def record_json_outcome(call_site, outcome):
+    """outcome: 'parsed' | 'repaired' | 'recalled' | 'failed'."""
+    with _json_stats_lock:
+        site_stats = _json_stats.setdefault(call_site or 'default', {'parsed': 0, 'repaired': 0, 'recalled': 0, 'failed': 0})
+        site_stats[outcome] += 1
+
+def get_json_repair_stats():
+    with _json_stats_lock:
+        return {site: dict(counts) for site, counts in _json_stats.items()}
+
+def log_json_repair_stats():
+    """Ghi log số lần JSON được sửa cục bộ so với số lần phải gọi lại LLM (gọi ở cuối mỗi lần chạy)."""
+    stats = get_json_repair_stats()
+    if not stats:
+        return stats
+    totals = {'parsed': 0, 'repaired': 0, 'recalled': 0, 'failed': 0}
+    for counts in stats.values():
+        for name in totals:
+            totals[name] += counts[name]
+    logger.info(f"LLM JSON stats: parsed={totals['parsed']}, repaired locally={totals['repaired']}, "
+                f"re-called={totals['recalled']}, failed={totals['failed']}")
+    for call_site, counts in sorted(stats.items()):
+        logger.info(f"  LLM JSON [{call_site}]: {counts}")
+    return stats
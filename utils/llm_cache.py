@@ -0,0 +1,193 @@
+# utils/llm_cache.py
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+import zstandard
+
+# Khởi tạo logger
+logger = logging.getLogger(__name__)
+
+_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_cache (
+    cache_key TEXT PRIMARY KEY,
+    call_site TEXT,
+    model TEXT,
+    value BLOB NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    expires_at REAL,
+    last_access REAL NOT NULL
+)
+"""
+
+def make_llm_cache_key(model_name, prompt_messages, response_format=None):
+    """
+    Key nội dung (content-addressed) cho một request chat: hash của model, messages và response_format.
+    Cùng prompt -> cùng key, bất kể keyword/site nào gửi request.
+    """
+    payload = json.dumps(
+        {"model": model_name, "messages": prompt_messages, "response_format": response_format},
+        sort_keys=True, ensure_ascii=False, separators=(',', ':')
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class LLMResponseCache:
+    """
+    Cache phản hồi LLM trên đĩa (SQLite, giá trị nén zstd).
+    - TTL theo call site (ttl_by_call_site, key 'default' làm fallback; TTL <= 0 nghĩa là không cache).
+    - Giới hạn tổng dung lượng (max_size_bytes), vượt quá thì xóa các entry ít được dùng gần đây nhất (LRU).
+    - Đếm hit/miss theo call site trong process hiện tại.
+    SQLite cho phép nhiều process (scheduler chạy nhiều site) dùng chung một file cache.
+    """
+    def __init__(self, db_path, ttl_by_call_site=None, max_size_bytes=512 * 1024 * 1024, compression_level=6):
+        self.db_path = db_path
+        self.ttl_by_call_site = dict(ttl_by_call_site or {})
+        self.max_size_bytes = int(max_size_bytes)
+        self._compressor = zstandard.ZstdCompressor(level=compression_level)
+        self._decompressor = zstandard.ZstdDecompressor()
+        self._lock = threading.Lock()
+        self._stats = {}
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(_CACHE_SCHEMA)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache(last_access)")
+
+    def _connect(self):
+        # Dùng `with closing(self._connect()) as conn, conn:` để vừa commit/rollback vừa đóng connection
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def get_ttl(self, call_site):
+        ttl = self.ttl_by_call_site.get(call_site or 'default', self.ttl_by_call_site.get('default', 0))
+        return float(ttl or 0)
+
+    def _record(self, call_site, outcome):
+        with self._lock:
+            site_stats = self._stats.setdefault(call_site or 'default', {'hits': 0, 'misses': 0, 'stores': 0})
+            site_stats[outcome] += 1
+
+    def get(self, cache_key, call_site=None):
+        """Trả về (True, value) nếu hit, (False, None) nếu miss/hết hạn/lỗi."""
+        if self.get_ttl(call_site) <= 0:
+            return False, None
+        now = time.time()
+        value_blob = None
+        try:
+            with self._lock, closing(self._connect()) as conn, conn:
+                row = conn.execute(
+                    "SELECT value, expires_at FROM llm_cache WHERE cache_key = ?", (cache_key,)
+                ).fetchone()
+                if row is not None:
+                    if row[1] is not None and row[1] < now:
+                        conn.execute("DELETE FROM llm_cache WHERE cache_key = ?", (cache_key,))
+                    else:
+                        value_blob = row[0]
+                        conn.execute("UPDATE llm_cache SET last_access = ? WHERE cache_key = ?", (now, cache_key))
+            if value_blob is None:
+                self._record(call_site, 'misses')
+                return False, None
+            value = json.loads(self._decompressor.decompress(value_blob).decode('utf-8'))
+        except Exception as e:
+            logger.warning(f"LLM cache read failed for call site '{call_site}': {e}")
+            self._record(call_site, 'misses')
+            return False, None
+        self._record(call_site, 'hits')
+        return True, value
+
+    def set(self, cache_key, value, call_site=None, model_name=None):
+        """Lưu value (phải serialize được sang JSON) với TTL của call site."""
+        ttl = self.get_ttl(call_site)
+        if ttl <= 0:
+            return False
+        now = time.time()
+        try:
+            value_blob = self._compressor.compress(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+            with self._lock, closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache "
+                    "(cache_key, call_site, model, value, size_bytes, created_at, expires_at, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (cache_key, call_site, model_name, value_blob, len(value_blob), now, now + ttl, now)
+                )
+                self._evict_if_needed(conn, now)
+        except Exception as e:
+            logger.warning(f"LLM cache write failed for call site '{call_site}': {e}")
+            return False
+        self._record(call_site, 'stores')
+        return True
+
+    def _evict_if_needed(self, conn, now):
+        """Xóa entry hết hạn, sau đó xóa theo LRU cho đến khi tổng dung lượng <= max_size_bytes."""
+        conn.execute("DELETE FROM llm_cache WHERE expires_at IS NOT NULL AND expires_at < ?", (now,))
+        total_size = conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM llm_cache").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        bytes_to_free = total_size - self.max_size_bytes
+        freed, evicted = 0, 0
+        for cache_key, size_bytes in conn.execute(
+            "SELECT cache_key, size_bytes FROM llm_cache ORDER BY last_access ASC"
+        ).fetchall():
+            if freed >= bytes_to_free:
+                break
+            conn.execute("DELETE FROM llm_cache WHERE cache_key = ?", (cache_key,))
+            freed += size_bytes
+            evicted += 1
+        logger.info(f"LLM cache evicted {evicted} LRU entries ({freed} bytes) to stay under {self.max_size_bytes} bytes.")
+
+    def get_stats(self):
+        """Thống kê hit/miss/store theo call site cho process hiện tại."""
+        with self._lock:
+            per_call_site = {site: dict(counts) for site, counts in self._stats.items()}
+        totals = {'hits': 0, 'misses': 0, 'stores': 0}
+        for counts in per_call_site.values():
+            for name in totals:
+                totals[name] += counts[name]
+        lookups = totals['hits'] + totals['misses']
+        totals['hit_rate'] = (totals['hits'] / lookups) if lookups else 0.0
+        return {'totals': totals, 'per_call_site': per_call_site}
+
+# Cache dùng chung cho process, None khi cache bị tắt
+_active_llm_cache = None
+
+def configure_llm_cache(config):
+    """Bật/tắt cache theo config (LLM_CACHE_ENABLED, LLM_CACHE_PATH, LLM_CACHE_MAX_SIZE_MB, LLM_CACHE_TTLS)."""
+    global _active_llm_cache
+    if not config.get('LLM_CACHE_ENABLED', False):
+        _active_llm_cache = None
+        logger.info("LLM response cache is disabled.")
+        return None
+    try:
+        _active_llm_cache = LLMResponseCache(
+            db_path=config.get('LLM_CACHE_PATH', 'cache/llm_cache.sqlite3'),
+            ttl_by_call_site=config.get('LLM_CACHE_TTLS') or {},
+            max_size_bytes=int(config.get('LLM_CACHE_MAX_SIZE_MB', 512)) * 1024 * 1024
+        )
+        logger.info(f"LLM response cache enabled at {_active_llm_cache.db_path} (max {config.get('LLM_CACHE_MAX_SIZE_MB', 512)} MB).")
+    except Exception as e:
+        logger.error(f"Could not initialize LLM response cache: {e}. Continuing without cache.")
+        _active_llm_cache = None
+    return _active_llm_cache
+
+def get_llm_cache():
+    return _active_llm_cache
+
+def log_llm_cache_stats():
+    """Ghi log thống kê hit/miss của cache (gọi ở cuối mỗi lần chạy)."""
+    if _active_llm_cache is None:
+        return None
+    stats = _active_llm_cache.get_stats()
+    totals = stats['totals']
+    logger.info(f"LLM cache stats: hits={totals['hits']}, misses={totals['misses']}, "
+                f"stores={totals['stores']}, hit_rate={totals['hit_rate']:.1%}")
+    for call_site, counts in sorted(stats['per_call_site'].items()):
+        logger.info(f"  LLM cache [{call_site}]: hits={counts['hits']}, misses={counts['misses']}, stores={counts['stores']}")
+    return stats
@@ -0,0 +1,148 @@
+# utils/model_router.py
+import logging
+import math
+import threading
+from collections import deque
+
+# Khởi tạo logger
+logger = logging.getLogger(__name__)
+
+class ModelProfile:
+    """Profile cuốn chiếu (N lời gọi gần nhất) của một model: độ trễ và lỗi."""
+    def __init__(self, window_size=50):
+        self.latencies = deque(maxlen=window_size) # Giây, chỉ tính các lời gọi có kết quả hoặc bị hủy do hedge
+        self.outcomes = deque(maxlen=window_size)  # True = thành công, False = lỗi
+
+    def percentile(self, pct):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        idx = min(len(ordered) - 1, max(0, math.ceil(pct / 100.0 * len(ordered)) - 1))
+        return ordered[idx]
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+class ModelRouter:
+    """
+    Chọn model cho mỗi lời gọi LLM dựa trên profile độ trễ/lỗi cuốn chiếu của từng model.
+      - failover_chains: {call_site | "default": [model dự phòng, ...]}. Chuỗi thực tế = [model của call site] + dự phòng.
+        Model có tỉ lệ lỗi gần đây >= error_rate_threshold bị đẩy xuống cuối chuỗi.
+      - hedged_call_sites: các call site cần độ trễ thấp. Nếu model chính chưa trả lời sau p90 của nó,
+        gửi thêm request tới model kế tiếp trong chuỗi; kết quả nào về trước thì dùng, request còn lại bị hủy.
+    """
+    def __init__(self, failover_chains=None, hedged_call_sites=None, window_size=50, min_samples=10,
+                 error_rate_threshold=0.5, hedge_percentile=90, default_hedge_delay_sec=20.0):
+        self.failover_chains = dict(failover_chains or {})
+        self.hedged_call_sites = set(hedged_call_sites or [])
+        self.window_size = int(window_size)
+        self.min_samples = int(min_samples)
+        self.error_rate_threshold = float(error_rate_threshold)
+        self.hedge_percentile = float(hedge_percentile)
+        self.default_hedge_delay_sec = float(default_hedge_delay_sec)
+        self._profiles = {}
+        self._stats = {'failovers': 0, 'hedges_sent': 0, 'hedges_won': 0}
+        self._lock = threading.Lock()
+
+    def _get_profile(self, model_name):
+        profile = self._profiles.get(model_name)
+        if profile is None:
+            profile = self._profiles[model_name] = ModelProfile(self.window_size)
+        return profile
+
+    def record_result(self, model_name, latency_sec, success):
+        """Ghi nhận một lời gọi đã kết thúc (thành công hoặc thất bại sau khi hết retry)."""
+        with self._lock:
+            profile = self._get_profile(model_name)
+            profile.latencies.append(latency_sec)
+            profile.outcomes.append(bool(success))
+
+    def record_cancelled(self, model_name, elapsed_sec):
+        """
+        Request bị hủy vì hedge thắng: chỉ biết độ trễ >= elapsed_sec.
+        Vẫn đưa vào profile để p90 không bị lệch thấp vì bỏ sót đúng những lời gọi chậm nhất.
+        """
+        with self._lock:
+            self._get_profile(model_name).latencies.append(elapsed_sec)
+
+    def _is_unhealthy(self, model_name):
+        profile = self._profiles.get(model_name)
+        return (profile is not None and len(profile.outcomes) >= self.min_samples
+                and profile.error_rate() >= self.error_rate_threshold)
+
+    def get_chain(self, call_site, primary_model):
+        """Chuỗi model để thử lần lượt cho call site, model khỏe mạnh lên trước (giữ thứ tự cấu hình)."""
+        fallbacks = self.failover_chains.get(call_site or 'default', self.failover_chains.get('default', []))
+        chain = [primary_model] + [model for model in fallbacks if model != primary_model]
+        with self._lock:
+            healthy = [model for model in chain if not self._is_unhealthy(model)]
+            unhealthy = [model for model in chain if self._is_unhealthy(model)]
+        if unhealthy and healthy:
+            logger.warning(f"Model router: deprioritizing models with high recent error rate: {unhealthy}")
+        return healthy + unhealthy
+
+    def should_hedge(self, call_site):
+        return call_site in self.hedged_call_sites
+
+    def get_hedge_delay(self, model_name):
+        """Thời gian chờ model chính trước khi gửi hedge: p90 độ trễ, hoặc giá trị mặc định khi chưa đủ mẫu."""
+        with self._lock:
+            profile = self._profiles.get(model_name)
+            if profile is None or len(profile.latencies) < self.min_samples:
+                return self.default_hedge_delay_sec
+            return profile.percentile(self.hedge_percentile)
+
+    def count(self, stat_name):
+        with self._lock:
+            self._stats[stat_name] += 1
+
+    def get_stats(self):
+        with self._lock:
+            models = {}
+            for model_name, profile in self._profiles.items():
+                models[model_name] = {
+                    'samples': len(profile.latencies),
+                    'p50_sec': profile.percentile(50),
+                    'p90_sec': profile.percentile(90),
+                    'error_rate': profile.error_rate(),
+                }
+            return {**self._stats, 'models': models}
+
+# Router dùng chung cho process, None khi bị tắt
+_active_model_router = None
+
+def configure_model_router(config):
+    """Bật/tắt router theo config (LLM_ROUTER_ENABLED, LLM_MODEL_FAILOVER_CHAINS, LLM_HEDGED_CALL_SITES, ...)."""
+    global _active_model_router
+    if not config.get('LLM_ROUTER_ENABLED', False):
+        _active_model_router = None
+        logger.info("LLM model router is disabled.")
+        return None
+    _active_model_router = ModelRouter(
+        failover_chains=config.get('LLM_MODEL_FAILOVER_CHAINS') or {},
+        hedged_call_sites=config.get('LLM_HEDGED_CALL_SITES') or [],
+        window_size=config.get('LLM_ROUTER_WINDOW_SIZE', 50),
+        min_samples=config.get('LLM_ROUTER_MIN_SAMPLES', 10),
+        error_rate_threshold=config.get('LLM_ROUTER_ERROR_RATE_THRESHOLD', 0.5),
+        default_hedge_delay_sec=config.get('LLM_HEDGE_DEFAULT_DELAY_SEC', 20.0)
+    )
+    logger.info(f"LLM model router enabled. Failover chains: {_active_model_router.failover_chains}. "
+                f"Hedged call sites: {sorted(_active_model_router.hedged_call_sites)}")
+    return _active_model_router
+
+def get_model_router():
+    return _active_model_router
+
+def log_model_router_stats():
+    """Ghi log profile độ trễ/lỗi theo model và số lần failover/hedge (gọi ở cuối mỗi lần chạy)."""
+    if _active_model_router is None:
+        return None
+    stats = _active_model_router.get_stats()
+    logger.info(f"LLM router stats: failovers={stats['failovers']}, hedges sent={stats['hedges_sent']}, "
+                f"hedges won={stats['hedges_won']}")
+    for model_name, profile in sorted(stats['models'].items()):
+        logger.info(f"  LLM router [{model_name}]: samples={profile['samples']}, p50={profile['p50_sec']:.2f}s, "
+                    f"p90={profile['p90_sec']:.2f}s, error rate={profile['error_rate']:.0%}")
+    return stats
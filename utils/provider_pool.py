@@ -0,0 +1,210 @@
+# utils/provider_pool.py
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from utils.rate_limiter import get_rate_limiter
+from utils.retry_policy import get_http_status, get_retry_after_seconds
+
+# Khởi tạo logger
+logger = logging.getLogger(__name__)
+
+# Base URL (API tương thích OpenAI) mặc định theo provider
+PROVIDER_BASE_URLS = {
+    'openrouter': 'https://openrouter.ai/api/v1',
+    'openai': None, # Mặc định của thư viện OpenAI
+    'gemini': 'https://generativelanguage.googleapis.com/v1beta/openai/',
+}
+
+# Lỗi do chính key (hết quota/credit, key bị thu hồi): loại key khỏi vòng xoay lâu hơn
+_KEY_AUTH_ERROR_STATUSES = frozenset({401, 402, 403})
+_AUTH_ERROR_COOLDOWN_SEC = 3600.0
+_RATE_LIMIT_BASE_COOLDOWN_SEC = 15.0
+_MAX_COOLDOWN_SEC = 300.0
+# Lỗi server/kết nối liên tiếp trên cùng một key trước khi tạm loại key
+_MAX_CONSECUTIVE_FAILURES = 3
+
+class ProviderKey:
+    """
+    Một API key trong pool, với quota riêng (rpm/tpm) và danh sách model nó phục vụ được.
+    model_map: {tên model OpenRouter: tên model của provider}. Key OpenRouter không có model_map phục vụ mọi model.
+    """
+    def __init__(self, name, provider, api_key, base_url=None, limits=None, model_map=None):
+        self.name = name
+        self.provider = provider
+        self.api_key = api_key
+        self.base_url = base_url
+        self.limits = dict(limits or {})
+        self.model_map = dict(model_map or {})
+        self.cooldown_until = 0.0
+        self.consecutive_failures = 0
+        self.last_used_at = 0.0
+        self.stats = {'requests': 0, 'failures': 0, 'cooldowns': 0}
+
+    @property
+    def bucket_key(self):
+        return f"key:{self.name}"
+
+    def resolve_model(self, model_name):
+        """Tên model gửi tới provider của key này, None nếu key không phục vụ model đó."""
+        if self.model_map:
+            return self.model_map.get(model_name)
+        return model_name if self.provider == 'openrouter' else None
+
+    def is_cooling_down(self, now=None):
+        return (now or time.time()) < self.cooldown_until
+
+class ProviderKeyPool:
+    """
+    Chia lưu lượng chat giữa nhiều key/provider theo phần quota RPM/TPM còn trống của từng key.
+    Quota được theo dõi bằng bucket "key:<name>" trong rate limiter SQLite (dùng chung giữa các process/site).
+    Key bị rate limit (429), hết credit/sai key (401/402/403) hoặc lỗi liên tiếp sẽ tạm bị loại khỏi vòng xoay.
+    """
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self._lock = threading.Lock()
+
+    def _eligible_keys(self, model_name, exclude=None):
+        return [key for key in self.keys if key is not exclude and key.resolve_model(model_name)]
+
+    def has_available_key(self, model_name, exclude=None):
+        """Còn key nào (ngoài exclude) phục vụ được model và không trong thời gian cooldown không."""
+        now = time.time()
+        return any(not key.is_cooling_down(now) for key in self._eligible_keys(model_name, exclude))
+
+    def choose(self, model_name, token_cost=0):
+        """
+        Chọn key cho một request: trong các key đang hoạt động, ưu tiên key còn nhiều quota nhất
+        (bằng nhau thì key lâu chưa dùng nhất). Nếu mọi key đều đang cooldown, chọn key sắp hết cooldown nhất.
+        Trả về None nếu không có key nào phục vụ model này.
+        """
+        candidates = self._eligible_keys(model_name)
+        if not candidates:
+            return None
+        now = time.time()
+        active = [key for key in candidates if not key.is_cooling_down(now)]
+        if not active:
+            chosen = min(candidates, key=lambda key: key.cooldown_until)
+            logger.warning(f"All provider keys for {model_name} are cooling down. Using '{chosen.name}' anyway.")
+        else:
+            rate_limiter = get_rate_limiter()
+            if rate_limiter is not None and len(active) > 1:
+                headroom = {key.name: rate_limiter.get_headroom(key.bucket_key, key.limits, token_cost) for key in active}
+                chosen = max(active, key=lambda key: (headroom[key.name], -key.last_used_at))
+            else:
+                chosen = min(active, key=lambda key: key.last_used_at)
+        with self._lock:
+            chosen.last_used_at = now
+            chosen.stats['requests'] += 1
+        return chosen
+
+    async def choose_async(self, model_name, token_cost=0):
+        """Phiên bản asyncio của choose: đọc headroom trong SQLite từ thread pool, không chặn event loop LLM."""
+        return await asyncio.to_thread(self.choose, model_name, token_cost)
+
+    async def acquire_async(self, key, token_cost=0):
+        """Chờ quota của key (bucket dùng chung giữa các process)."""
+        rate_limiter = get_rate_limiter()
+        if rate_limiter is not None and key.limits:
+            await rate_limiter.acquire_bucket_async(key.bucket_key, key.limits, token_cost)
+
+    async def settle_async(self, key, estimated_cost, actual_cost):
+        """Điều chỉnh quota TPM của key theo usage thực tế của request (xem RateLimiter.settle_bucket)."""
+        rate_limiter = get_rate_limiter()
+        if rate_limiter is not None and key.limits:
+            await rate_limiter.settle_bucket_async(key.bucket_key, key.limits, estimated_cost, actual_cost)
+
+    def report_success(self, key):
+        with self._lock:
+            key.consecutive_failures = 0
+
+    def report_failure(self, key, error):
+        """
+        Ghi nhận lỗi của một request trên key. Trả về True nếu key bị tạm loại khỏi vòng xoay
+        (lỗi do key, nên thử key khác ngay thay vì chờ).
+        """
+        status = get_http_status(error)
+        with self._lock:
+            key.stats['failures'] += 1
+            key.consecutive_failures += 1
+            if status in _KEY_AUTH_ERROR_STATUSES:
+                cooldown = _AUTH_ERROR_COOLDOWN_SEC
+            elif status == 429:
+                retry_after = get_retry_after_seconds(error)
+                cooldown = retry_after if retry_after is not None else min(
+                    _MAX_COOLDOWN_SEC, _RATE_LIMIT_BASE_COOLDOWN_SEC * (2 ** (key.consecutive_failures - 1)))
+            elif (status is None or status >= 500) and key.consecutive_failures >= _MAX_CONSECUTIVE_FAILURES:
+                cooldown = min(_MAX_COOLDOWN_SEC, _RATE_LIMIT_BASE_COOLDOWN_SEC * key.consecutive_failures)
+            else:
+                return False # Lỗi của request (vd: 400) hoặc chưa đủ số lỗi liên tiếp
+            key.cooldown_until = time.time() + cooldown
+            key.stats['cooldowns'] += 1
+        logger.warning(f"Provider key '{key.name}' ({key.provider}) taken out of rotation for {cooldown:.0f}s (status: {status}).")
+        return True
+
+    def get_stats(self):
+        now = time.time()
+        with self._lock:
+            return {key.name: {**key.stats, 'provider': key.provider, 'cooling_down': key.is_cooling_down(now)}
+                    for key in self.keys}
+
+def _resolve_api_key(entry, config):
+    """API key của một entry: 'api_key' trực tiếp, hoặc tên biến ở 'api_key_env' (tìm trong config rồi tới biến môi trường)."""
+    if entry.get('api_key'):
+        return entry['api_key']
+    env_name = entry.get('api_key_env')
+    if not env_name:
+        return None
+    return config.get(env_name) or os.getenv(env_name)
+
+# Pool dùng chung cho process, None khi bị tắt hoặc chỉ có một key
+_active_key_pool = None
+
+def configure_provider_key_pool(config):
+    """Tạo pool từ LLM_PROVIDER_KEYS (bỏ qua entry không có key). Pool chỉ được bật khi có từ 2 key trở lên."""
+    global _active_key_pool
+    _active_key_pool = None
+    if not config.get('LLM_KEY_POOL_ENABLED', False):
+        logger.info("LLM provider key pool is disabled.")
+        return None
+
+    keys = []
+    for entry in config.get('LLM_PROVIDER_KEYS') or []:
+        provider = entry.get('provider', 'openrouter')
+        api_key = _resolve_api_key(entry, config)
+        if not api_key:
+            logger.debug(f"Skipping provider key '{entry.get('name')}': no API key configured.")
+            continue
+        base_url = entry.get('base_url') or PROVIDER_BASE_URLS.get(provider)
+        if provider == 'openrouter' and not entry.get('base_url'):
+            base_url = config.get('OPENROUTER_BASE_URL') or base_url
+        keys.append(ProviderKey(
+            name=entry.get('name', f"{provider}-{len(keys) + 1}"),
+            provider=provider,
+            api_key=api_key,
+            base_url=base_url,
+            limits={'rpm': entry.get('rpm'), 'tpm': entry.get('tpm')},
+            model_map=entry.get('model_map')
+        ))
+
+    if len(keys) < 2:
+        logger.info(f"LLM provider key pool not used: {len(keys)} key(s) configured.")
+        return None
+    _active_key_pool = ProviderKeyPool(keys)
+    logger.info(f"LLM provider key pool enabled with keys: {[f'{key.name} ({key.provider})' for key in keys]}")
+    return _active_key_pool
+
+def get_provider_key_pool():
+    return _active_key_pool
+
+def log_provider_key_pool_stats():
+    """Ghi log số request/lỗi/cooldown theo key (gọi ở cuối mỗi lần chạy)."""
+    if _active_key_pool is None:
+        return None
+    stats = _active_key_pool.get_stats()
+    for name, key_stats in stats.items():
+        logger.info(f"LLM key pool [{name}]: requests={key_stats['requests']}, failures={key_stats['failures']}, "
+                    f"cooldowns={key_stats['cooldowns']}")
+    return stats
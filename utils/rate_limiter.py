@@ -0,0 +1,254 @@
+# utils/rate_limiter.py
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import time
+from contextlib import closing
+
+# Khởi tạo logger
+logger = logging.getLogger(__name__)
+
+_BUCKET_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_buckets (
+    bucket_key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+# Thời gian chờ tối đa cho mỗi lần ngủ giữa hai lần kiểm tra bucket
+_MAX_SLEEP_SLICE_SEC = 5.0
+
+class RateLimiter:
+    """
+    Token bucket dùng chung giữa các process (state lưu trong SQLite, không cần service ngoài).
+    Mỗi bucket key có dạng "provider:model" (vd: "openrouter:openai/gpt-4o-mini") và có hai giới hạn:
+      - rpm: số request mỗi phút
+      - tpm: số token mỗi phút (token được ước lượng trước khi gửi request)
+    limits: dict {"provider:model" | "provider:*": {"rpm": int, "tpm": int}}. Key không khớp -> không giới hạn.
+    completion_tokens_estimate: số token output cộng thêm vào chi phí ước lượng của mỗi request chat.
+    """
+    def __init__(self, db_path, limits=None, max_wait_sec=120, completion_tokens_estimate=800):
+        self.db_path = db_path
+        self.limits = dict(limits or {})
+        self.max_wait_sec = float(max_wait_sec)
+        self.completion_tokens_estimate = int(completion_tokens_estimate)
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(_BUCKET_SCHEMA)
+
+    def _connect(self):
+        # isolation_level=None để tự quản lý transaction (BEGIN IMMEDIATE khóa ghi giữa các process)
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def get_limits(self, provider, model_name):
+        """Tìm giới hạn theo thứ tự: 'provider:model' -> 'provider:*'. Trả về None nếu không giới hạn."""
+        return self.limits.get(f"{provider}:{model_name}") or self.limits.get(f"{provider}:*")
+
+    def _sub_buckets(self, bucket_key, limits, token_cost):
+        """List (tên bucket con, dung lượng/phút, chi phí của request này) cho các giới hạn được cấu hình."""
+        sub_buckets = []
+        if limits.get('rpm'):
+            sub_buckets.append((f"{bucket_key}|rpm", float(limits['rpm']), 1.0))
+        if limits.get('tpm') and token_cost > 0:
+            capacity = float(limits['tpm'])
+            # Request lớn hơn cả dung lượng bucket thì chỉ cần chờ bucket đầy
+            sub_buckets.append((f"{bucket_key}|tpm", capacity, min(float(token_cost), capacity)))
+        return sub_buckets
+
+    @staticmethod
+    def _available_tokens(conn, name, capacity, now):
+        row = conn.execute("SELECT tokens, updated_at FROM rate_buckets WHERE bucket_key = ?", (name,)).fetchone()
+        if row is None:
+            return capacity
+        refill_rate = capacity / 60.0
+        return min(capacity, row[0] + max(0.0, now - row[1]) * refill_rate)
+
+    def get_headroom(self, bucket_key, limits, token_cost=0):
+        """
+        Tỉ lệ dung lượng còn trống (0..1) của bucket_key - nhỏ nhất giữa RPM và TPM, không trừ gì khỏi bucket.
+        Trả về 1.0 nếu không có giới hạn hoặc không đọc được state.
+        """
+        sub_buckets = self._sub_buckets(bucket_key, limits or {}, max(1, token_cost))
+        if not sub_buckets:
+            return 1.0
+        now = time.time()
+        try:
+            conn = self._connect()
+            try:
+                return min(self._available_tokens(conn, name, capacity, now) / capacity for name, capacity, _ in sub_buckets)
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.warning(f"Could not read rate limiter state for {bucket_key}: {e}")
+            return 1.0
+
+    def _try_acquire(self, bucket_key, limits, token_cost):
+        """
+        Thử lấy 1 request + token_cost token từ các bucket của bucket_key (atomic giữa các process).
+        Trả về 0 nếu lấy được, ngược lại trả về số giây cần chờ (không trừ gì khỏi bucket).
+        """
+        sub_buckets = self._sub_buckets(bucket_key, limits, token_cost)
+        if not sub_buckets:
+            return 0.0
+
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            refilled = []
+            wait_sec = 0.0
+            for name, capacity, cost in sub_buckets:
+                available = self._available_tokens(conn, name, capacity, now)
+                refilled.append((name, available, cost))
+                if available < cost:
+                    wait_sec = max(wait_sec, (cost - available) / (capacity / 60.0))
+            if wait_sec > 0:
+                conn.execute("ROLLBACK")
+                return wait_sec
+            for name, available, cost in refilled:
+                conn.execute(
+                    "INSERT OR REPLACE INTO rate_buckets (bucket_key, tokens, updated_at) VALUES (?, ?, ?)",
+                    (name, available - cost, now)
+                )
+            conn.execute("COMMIT")
+            return 0.0
+        except Exception:
+            try:
+                conn.execute("ROLLBACK")
+            except Exception:
+                pass
+            raise
+        finally:
+            conn.close()
+
+    def _next_sleep(self, bucket_key, limits, token_cost, waited):
+        """Trả về số giây cần ngủ trước lần thử tiếp theo, 0 nếu đã lấy được slot, None nếu nên bỏ qua limiter."""
+        if not limits:
+            return 0.0
+        try:
+            wait_sec = self._try_acquire(bucket_key, limits, token_cost)
+        except Exception as e:
+            logger.warning(f"Rate limiter unavailable for {bucket_key}: {e}. Proceeding without waiting.")
+            return 0.0
+        if wait_sec <= 0:
+            return 0.0
+        if waited + wait_sec > self.max_wait_sec:
+            logger.warning(f"Rate limiter wait for {bucket_key} exceeded {self.max_wait_sec}s. Proceeding anyway.")
+            return None
+        # Jitter nhỏ để các process không cùng thức dậy một lúc
+        return min(wait_sec, _MAX_SLEEP_SLICE_SEC) * random.uniform(1.0, 1.2)
+
+    def acquire_bucket(self, bucket_key, limits, token_cost=0):
+        """Chờ (blocking) cho đến khi bucket_key có slot theo limits. Trả về tổng số giây đã chờ."""
+        waited = 0.0
+        while True:
+            sleep_sec = self._next_sleep(bucket_key, limits, token_cost, waited)
+            if not sleep_sec:
+                break
+            time.sleep(sleep_sec)
+            waited += sleep_sec
+        if waited > 0:
+            logger.info(f"Rate limiter: waited {waited:.1f}s for {bucket_key} (estimated tokens: {token_cost}).")
+        return waited
+
+    async def acquire_bucket_async(self, bucket_key, limits, token_cost=0):
+        """
+        Phiên bản asyncio của acquire_bucket (không chặn event loop khi chờ).
+        Transaction SQLite (BEGIN IMMEDIATE, có thể chờ khóa của process khác tới 30s) chạy trong thread pool.
+        """
+        waited = 0.0
+        while True:
+            sleep_sec = await asyncio.to_thread(self._next_sleep, bucket_key, limits, token_cost, waited)
+            if not sleep_sec:
+                break
+            await asyncio.sleep(sleep_sec)
+            waited += sleep_sec
+        if waited > 0:
+            logger.info(f"Rate limiter: waited {waited:.1f}s for {bucket_key} (estimated tokens: {token_cost}).")
+        return waited
+
+    def settle_bucket(self, bucket_key, limits, estimated_cost, actual_cost):
+        """
+        Điều chỉnh bucket TPM theo usage thực tế sau khi có response: hoàn lại phần ước lượng dư
+        (estimated_cost > actual_cost) hoặc trừ thêm phần thiếu (bucket có thể tạm âm, request sau chờ lâu hơn).
+        """
+        if not limits or not limits.get('tpm') or estimated_cost <= 0:
+            return
+        capacity = float(limits['tpm'])
+        # acquire chỉ trừ tối đa bằng dung lượng bucket
+        token_delta = min(float(estimated_cost), capacity) - min(float(actual_cost), capacity)
+        if abs(token_delta) < 1:
+            return
+        name = f"{bucket_key}|tpm"
+        now = time.time()
+        try:
+            conn = self._connect()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                available = self._available_tokens(conn, name, capacity, now)
+                conn.execute(
+                    "INSERT OR REPLACE INTO rate_buckets (bucket_key, tokens, updated_at) VALUES (?, ?, ?)",
+                    (name, min(capacity, available + token_delta), now)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                try:
+                    conn.execute("ROLLBACK")
+                except Exception:
+                    pass
+                raise
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.warning(f"Could not settle rate limiter bucket {bucket_key}: {e}")
+            return
+        logger.debug(f"Rate limiter: settled {bucket_key} (estimated {estimated_cost} tokens, actual {actual_cost}).")
+
+    async def settle_bucket_async(self, bucket_key, limits, estimated_cost, actual_cost):
+        """Phiên bản asyncio của settle_bucket (transaction SQLite chạy trong thread pool)."""
+        await asyncio.to_thread(self.settle_bucket, bucket_key, limits, estimated_cost, actual_cost)
+
+    async def settle_async(self, provider, model_name, estimated_cost, actual_cost):
+        """settle_bucket cho bucket provider:model."""
+        await self.settle_bucket_async(f"{provider}:{model_name}", self.get_limits(provider, model_name), estimated_cost, actual_cost)
+
+    def acquire(self, provider, model_name, token_cost=0):
+        """Chờ (blocking) cho đến khi có slot cho provider:model. Trả về tổng số giây đã chờ."""
+        return self.acquire_bucket(f"{provider}:{model_name}", self.get_limits(provider, model_name), token_cost)
+
+    async def acquire_async(self, provider, model_name, token_cost=0):
+        """Phiên bản asyncio của acquire (không chặn event loop khi chờ)."""
+        return await self.acquire_bucket_async(f"{provider}:{model_name}", self.get_limits(provider, model_name), token_cost)
+
+# Limiter dùng chung cho process, None khi bị tắt
+_active_rate_limiter = None
+
+def configure_rate_limiter(config):
+    """Bật/tắt limiter theo config (LLM_RATE_LIMIT_ENABLED, LLM_RATE_LIMIT_DB_PATH, LLM_RATE_LIMITS, ...)."""
+    global _active_rate_limiter
+    if not config.get('LLM_RATE_LIMIT_ENABLED', False):
+        _active_rate_limiter = None
+        logger.info("LLM rate limiter is disabled.")
+        return None
+    try:
+        _active_rate_limiter = RateLimiter(
+            db_path=config.get('LLM_RATE_LIMIT_DB_PATH', 'cache/rate_limiter.sqlite3'),
+            limits=config.get('LLM_RATE_LIMITS') or {},
+            max_wait_sec=config.get('LLM_RATE_LIMIT_MAX_WAIT_SEC', 120),
+            completion_tokens_estimate=config.get('LLM_RATE_LIMIT_COMPLETION_TOKENS_ESTIMATE', 800)
+        )
+        logger.info(f"LLM rate limiter enabled at {_active_rate_limiter.db_path} with limits: {_active_rate_limiter.limits}")
+    except Exception as e:
+        logger.error(f"Could not initialize LLM rate limiter: {e}. Continuing without rate limiting.")
+        _active_rate_limiter = None
+    return _active_rate_limiter
+
+def get_rate_limiter():
+    return _active_rate_limiter
@@ -0,0 +1,203 @@
+# utils/retry_policy.py
+import email.utils
+import json
+import logging
+import random
+import re
+import time
+
+import httpx
+import openai
+import requests
+
+# Khởi tạo logger
+logger = logging.getLogger(__name__)
+
+# Status HTTP có thể thành công nếu thử lại (timeout, conflict, rate limit, lỗi server tạm thời)
+RETRIABLE_HTTP_STATUSES = frozenset({408, 409, 425, 429, 500, 502, 503, 504})
+
+# Giá trị mặc định, có thể ghi đè qua configure_retry_policy(config)
+_retry_defaults = {
+    'max_delay': 30.0,        # Trần cho mỗi lần chờ (giây)
+    'deadline': 180.0,        # Tổng thời gian tối đa cho một lời gọi, tính cả các lần retry (giây)
+    'max_retry_after': 60.0,  # Không chờ theo Retry-After lâu hơn mức này
+    'request_timeout': 60.0,  # Timeout mặc định cho mỗi request HTTP
+}
+
+def configure_retry_policy(config):
+    """Cập nhật giá trị mặc định của retry policy từ config (RETRY_MAX_DELAY_SEC, RETRY_DEADLINE_SEC, ...)."""
+    _retry_defaults['max_delay'] = float(config.get('RETRY_MAX_DELAY_SEC', _retry_defaults['max_delay']))
+    _retry_defaults['deadline'] = float(config.get('RETRY_DEADLINE_SEC', _retry_defaults['deadline']))
+    _retry_defaults['max_retry_after'] = float(config.get('RETRY_MAX_RETRY_AFTER_SEC', _retry_defaults['max_retry_after']))
+    _retry_defaults['request_timeout'] = float(config.get('HTTP_REQUEST_TIMEOUT_SEC', _retry_defaults['request_timeout']))
+    logger.info(f"Retry policy defaults configured: {_retry_defaults}")
+
+def _get_status_and_headers(error):
+    """Lấy (status_code, headers) từ exception của requests/openai/httpx. (None, {}) nếu không có response."""
+    response = None
+    if isinstance(error, requests.exceptions.RequestException):
+        response = error.response
+    elif isinstance(error, openai.APIStatusError):
+        response = error.response
+    elif isinstance(error, httpx.HTTPStatusError):
+        response = error.response
+    if response is None:
+        return None, {}
+    status = getattr(response, 'status_code', None)
+    headers = getattr(response, 'headers', None) or {}
+    return status, headers
+
+def get_http_status(error):
+    """Status HTTP của exception (requests/openai/httpx), None nếu lỗi không có response."""
+    return _get_status_and_headers(error)[0]
+
+def _parse_duration(value):
+    """Parse thời lượng dạng '1s', '6m0s', '250ms', '1.5' (giây). Trả về giây hoặc None."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    matches = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if not matches:
+        return None
+    units = {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+    return sum(float(number) * units[unit] for number, unit in matches)
+
+def get_retry_after_seconds(error):
+    """
+    Đọc thời gian chờ server yêu cầu từ header của response lỗi:
+    retry-after-ms, Retry-After (giây hoặc HTTP-date), x-ratelimit-reset-requests/-tokens (OpenAI),
+    x-ratelimit-reset (epoch, OpenRouter). Trả về số giây hoặc None.
+    """
+    _, headers = _get_status_and_headers(error)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000.0)
+        except ValueError:
+            pass
+
+    retry_after = headers.get('retry-after')
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry_after)
+                return max(0.0, retry_at.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    reset_durations = [_parse_duration(headers.get(name)) for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens')]
+    reset_durations = [d for d in reset_durations if d is not None]
+    if reset_durations:
+        return max(reset_durations)
+
+    reset_epoch = headers.get('x-ratelimit-reset')
+    if reset_epoch:
+        try:
+            reset_value = float(reset_epoch)
+            if reset_value > 1e12: # epoch tính bằng mili giây
+                reset_value /= 1000.0
+            if reset_value > 1e9: # epoch (giây)
+                return max(0.0, reset_value - time.time())
+            return max(0.0, reset_value) # Số giây tương đối
+        except ValueError:
+            pass
+    return None
+
+def is_retriable_error(error):
+    """
+    Phân loại lỗi: True nếu thử lại có thể thành công.
+    - Lỗi HTTP: chỉ retry các status trong RETRIABLE_HTTP_STATUSES (400/401/403/404... thì không).
+    - Lỗi kết nối/timeout: retry.
+    - Lỗi request không hợp lệ (URL sai, thiếu schema...): không retry.
+    - Lỗi parse JSON từ response và các lỗi khác không rõ nguồn: retry (giữ hành vi cũ).
+    """
+    status, _ = _get_status_and_headers(error)
+    if status is not None:
+        return status in RETRIABLE_HTTP_STATUSES
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                          requests.exceptions.ChunkedEncodingError)):
+        return True
+    if isinstance(error, (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema,
+                          requests.exceptions.InvalidSchema, requests.exceptions.InvalidHeader)):
+        return False
+    if isinstance(error, json.JSONDecodeError):
+        return True
+    if isinstance(error, (openai.OpenAIError, requests.exceptions.RequestException)):
+        return False
+    return True
+
+class RetryPolicy:
+    """
+    Chính sách retry dùng chung: exponential backoff có trần + full jitter, tôn trọng Retry-After
+    và giới hạn tổng thời gian (deadline) cho một lời gọi.
+
+    Cách dùng (mỗi lời gọi tạo một policy mới vì policy giữ trạng thái số lần thử/thời điểm bắt đầu):
+        retry_policy = RetryPolicy(max_attempts=max_retries, base_delay=retry_delay)
+        while True:
+            try:
+                ...
+                return result
+            except Exception as e:
+                error = e
+            delay = retry_policy.next_delay(error)
+            if delay is None:
+                return None # Hết lượt, lỗi không retry được, hoặc quá deadline
+            time.sleep(delay)
+    """
+    def __init__(self, max_attempts=3, base_delay=1.0, max_delay=None, deadline=None, max_retry_after=None):
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = max(0.0, float(base_delay))
+        self.max_delay = float(max_delay if max_delay is not None else _retry_defaults['max_delay'])
+        self.deadline = float(deadline if deadline is not None else _retry_defaults['deadline'])
+        self.max_retry_after = float(max_retry_after if max_retry_after is not None else _retry_defaults['max_retry_after'])
+        self.attempt = 0 # Số lần đã thất bại
+        self.started_at = time.monotonic()
+
+    def remaining_time(self):
+        return max(0.0, self.deadline - (time.monotonic() - self.started_at))
+
+    def request_timeout(self, default_timeout=None):
+        """Timeout cho request kế tiếp: không vượt quá thời gian còn lại của deadline."""
+        timeout = float(default_timeout if default_timeout is not None else _retry_defaults['request_timeout'])
+        return max(1.0, min(timeout, self.remaining_time()))
+
+    def compute_delay(self, error=None):
+        """Full jitter: uniform(0, min(max_delay, base * 2^attempt)); ưu tiên Retry-After nếu server có gửi."""
+        backoff_cap = min(self.max_delay, self.base_delay * (2 ** max(0, self.attempt - 1)))
+        delay = random.uniform(0, backoff_cap)
+        retry_after = get_retry_after_seconds(error) if error is not None else None
+        if retry_after is not None:
+            # Thêm chút jitter để các process không cùng retry một lúc
+            delay = min(retry_after, self.max_retry_after) + random.uniform(0, min(1.0, self.base_delay))
+        return delay
+
+    def next_delay(self, error=None, description="call"):
+        """
+        Ghi nhận một lần thất bại và trả về số giây cần chờ trước lần thử tiếp theo,
+        hoặc None nếu không nên thử lại nữa.
+        """
+        self.attempt += 1
+        if error is not None and not is_retriable_error(error):
+            status, _ = _get_status_and_headers(error)
+            logger.warning(f"Not retrying {description}: non-retriable error (status: {status}, {type(error).__name__}).")
+            return None
+        if self.attempt >= self.max_attempts:
+            logger.error(f"Max retries ({self.max_attempts}) reached for {description}.")
+            return None
+        delay = self.compute_delay(error)
+        if delay >= self.remaining_time():
+            logger.error(f"Retry deadline ({self.deadline:.0f}s) exceeded for {description}. Giving up.")
+            return None
+        logger.info(f"Retrying {description} in {delay:.1f} seconds (attempt {self.attempt + 1}/{self.max_attempts})...")
+        return delay
@@ -0,0 +1,99 @@
+# utils/single_flight.py
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import threading
+
+# Khởi tạo logger
+logger = logging.getLogger(__name__)
+
+def make_request_key(*parts):
+    """Key ổn định cho một request từ các thành phần (dict/list được sắp key trước khi hash)."""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class _InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    Gộp các lời gọi giống hệt nhau đang chạy đồng thời (dùng cho code sync, nhiều thread):
+    lời gọi đầu tiên với một key sẽ thực thi, các lời gọi cùng key đến sau khi nó chưa xong
+    sẽ chờ và nhận chung kết quả (bản copy, để caller sửa kết quả không ảnh hưởng nhau).
+    Chỉ gộp các lời gọi đang chạy song song - không phải cache; lời gọi sau khi đã xong sẽ thực thi lại.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _InFlightCall()
+                self.executed += 1
+                is_leader = True
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+                is_leader = False
+
+        if not is_leader:
+            logger.debug(f"Single-flight ({self.name}): waiting on identical in-flight request.")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            if call.waiters:
+                logger.info(f"Single-flight ({self.name}): shared one result with {call.waiters} identical concurrent request(s).")
+            call.done.set()
+
+class AsyncSingleFlight:
+    """
+    Phiên bản asyncio của SingleFlight. Phải được dùng từ cùng một event loop.
+    Lời gọi thực thi chạy trong task riêng; caller bị hủy (vd: hedge thua) không hủy kết quả mà caller khác đang chờ.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._tasks = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key, coro_factory):
+        task = self._tasks.get(key)
+        if task is not None:
+            self.coalesced += 1
+            logger.info(f"Single-flight ({self.name}): joining identical in-flight request.")
+            result = await asyncio.shield(task)
+            return copy.deepcopy(result)
+
+        self.executed += 1
+        task = asyncio.ensure_future(coro_factory())
+        self._tasks[key] = task
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        return await asyncio.shield(task)
+
+def log_single_flight_stats(*groups):
+    """Ghi log số request đã thực thi và số request được gộp (gọi ở cuối mỗi lần chạy)."""
+    for group in groups:
+        if group.executed or group.coalesced:
+            logger.info(f"Single-flight stats [{group.name}]: executed={group.executed}, coalesced={group.coalesced}")
@@ -0,0 +1,76 @@
+# utils/task_graph.py
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Khởi tạo logger
+logger = logging.getLogger(__name__)
+
+class GraphTask:
+    """
+    Một node trong đồ thị: fn nhận dict {tên task phụ thuộc: kết quả} và trả về kết quả của node.
+    deps: tên các task phải xong trước khi node này chạy.
+    """
+    def __init__(self, name, fn, deps=()):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+
+def _validate_graph(tasks_by_name):
+    for task in tasks_by_name.values():
+        unknown = [dep for dep in task.deps if dep not in tasks_by_name]
+        if unknown:
+            raise ValueError(f"Task '{task.name}' depends on unknown task(s): {unknown}")
+    # Phát hiện vòng lặp bằng DFS
+    visiting, visited = set(), set()
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f"Task graph has a cycle through '{name}'")
+        visiting.add(name)
+        for dep in tasks_by_name[name].deps:
+            visit(dep)
+        visiting.discard(name)
+        visited.add(name)
+    for name in tasks_by_name:
+        visit(name)
+
+def run_task_graph(tasks, max_workers=None, graph_name="task graph"):
+    """
+    Chạy các GraphTask đồng thời (thread pool), mỗi task bắt đầu ngay khi các task nó phụ thuộc đã xong.
+    Task raise exception: lỗi được log, kết quả là None và các task phụ thuộc vẫn chạy (tự xử lý None).
+    Trả về (results, timings): {tên task: kết quả}, {tên task: số giây chạy}.
+    """
+    tasks_by_name = {task.name: task for task in tasks}
+    _validate_graph(tasks_by_name)
+    results, timings = {}, {}
+    pending = dict(tasks_by_name)
+    running = {}
+    graph_started_at = time.time()
+
+    def run_task(task, dep_results):
+        started_at = time.time()
+        try:
+            return task.fn(dep_results)
+        except Exception as e:
+            logger.exception(f"{graph_name}: task '{task.name}' failed: {e}")
+            return None
+        finally:
+            timings[task.name] = time.time() - started_at
+
+    with ThreadPoolExecutor(max_workers=max_workers or max(1, len(tasks_by_name)),
+                            thread_name_prefix=graph_name.replace(" ", "-")) as executor:
+        while pending or running:
+            ready = [task for task in pending.values() if all(dep in results for dep in task.deps)]
+            for task in ready:
+                del pending[task.name]
+                dep_results = {dep: results[dep] for dep in task.deps}
+                running[executor.submit(run_task, task, dep_results)] = task.name
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+
+    logger.info(f"{graph_name} finished in {time.time() - graph_started_at:.1f}s: " +
+                ", ".join(f"{name}={seconds:.1f}s" for name, seconds in timings.items()))
+    return results, timings
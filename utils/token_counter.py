@@ -0,0 +1,117 @@
+# utils/token_counter.py
+import logging
+import math
+import os
+import threading
+
+import tiktoken
+
+# Khởi tạo logger
+logger = logging.getLogger(__name__)
+
+# Ước lượng ~4 ký tự / token khi không load được encoding của tiktoken
+CHARS_PER_TOKEN_FALLBACK = 4
+# Overhead mỗi message trong chat format (role, phân tách...)
+TOKENS_PER_MESSAGE_OVERHEAD = 4
+# Số token trung bình cho một từ tiếng Anh (dùng để đổi độ dài yêu cầu theo từ sang max_tokens)
+TOKENS_PER_WORD = 1.35
+
+_encoding_cache = {}
+_encoding_cache_lock = threading.Lock()
+
+def configure_token_counter(config):
+    """
+    Trỏ tiktoken tới thư mục cache cố định (TIKTOKEN_CACHE_DIR) để các file encoding đã tải
+    được dùng lại khi khởi động, kể cả khi máy không có mạng. Mặc định tiktoken cache vào thư mục tạm.
+    Chạy prefetch_tiktoken_encodings.py một lần (khi có mạng) để tải sẵn encoding vào thư mục này.
+    """
+    cache_dir = os.environ.get('TIKTOKEN_CACHE_DIR') or config.get('TIKTOKEN_CACHE_DIR', 'cache/tiktoken')
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError as e:
+        logger.warning(f"Could not create tiktoken cache directory '{cache_dir}': {e}")
+    os.environ['TIKTOKEN_CACHE_DIR'] = cache_dir
+    with _encoding_cache_lock:
+        _encoding_cache.clear() # Thử load lại các encoding trước đó thất bại
+    logger.info(f"tiktoken encodings will be loaded from cache directory: {cache_dir}")
+
+def _strip_provider_prefix(model_name):
+    """'openai/gpt-4o-mini' (tên model OpenRouter) -> 'gpt-4o-mini'."""
+    if not model_name:
+        return ""
+    return model_name.split('/', 1)[-1]
+
+def get_encoding_for_model(model_name):
+    """
+    Trả về encoding tiktoken cho model, hoặc None nếu không load được
+    (ví dụ máy không có mạng và chưa có file encoding trong TIKTOKEN_CACHE_DIR).
+    Kết quả (kể cả thất bại) được nhớ lại theo tên encoding để không tải lại ở mỗi lần gọi.
+    """
+    base_model = _strip_provider_prefix(model_name)
+    try:
+        encoding_name = tiktoken.encoding_name_for_model(base_model)
+    except KeyError:
+        # Model không phải của OpenAI (hoặc tiktoken chưa biết) -> dùng encoding mới nhất
+        encoding_name = "o200k_base"
+    with _encoding_cache_lock:
+        if encoding_name in _encoding_cache:
+            return _encoding_cache[encoding_name]
+        try:
+            encoding = tiktoken.get_encoding(encoding_name)
+        except Exception as e:
+            logger.warning(f"Could not load tiktoken encoding '{encoding_name}' (model '{model_name}'): {e}. Falling back to character-based estimates.")
+            encoding = None
+        _encoding_cache[encoding_name] = encoding
+    return encoding
+
+def count_tokens(text, model_name=None):
+    """Đếm số token của một chuỗi (ước lượng theo số ký tự nếu không có encoding)."""
+    if not text:
+        return 0
+    encoding = get_encoding_for_model(model_name)
+    if encoding is None:
+        return (len(text) + CHARS_PER_TOKEN_FALLBACK - 1) // CHARS_PER_TOKEN_FALLBACK
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_chat_tokens(prompt_messages, model_name=None):
+    """Ước lượng số token prompt của một list message chat."""
+    total = 3 # Token mồi cho câu trả lời của assistant
+    for message in prompt_messages or []:
+        total += TOKENS_PER_MESSAGE_OVERHEAD
+        content = message.get('content')
+        if isinstance(content, str):
+            total += count_tokens(content, model_name)
+        elif isinstance(content, list): # Content dạng nhiều phần (text/image)
+            for part in content:
+                if isinstance(part, dict) and part.get('type') == 'text':
+                    total += count_tokens(part.get('text', ''), model_name)
+    return total
+
+def words_to_tokens(word_count):
+    """Ước lượng số token cho một đoạn văn có word_count từ."""
+    return int(math.ceil(max(0, word_count) * TOKENS_PER_WORD))
+
+def truncate_to_token_budget(text, max_tokens, model_name=None, separator="\n", label="text"):
+    """
+    Cắt text để không vượt quá max_tokens token. Ưu tiên cắt tại separator cuối cùng
+    (vd: "\n" giữa các kết quả SERP, ", " giữa các tên section) nếu nó nằm trong nửa sau đoạn giữ lại.
+    Trả về text nguyên vẹn nếu đã nằm trong budget (hoặc max_tokens không hợp lệ).
+    """
+    if not text or not max_tokens or max_tokens <= 0:
+        return text
+    token_count = count_tokens(text, model_name)
+    if token_count <= max_tokens:
+        return text
+
+    encoding = get_encoding_for_model(model_name)
+    if encoding is not None:
+        truncated = encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    else:
+        truncated = text[:max_tokens * CHARS_PER_TOKEN_FALLBACK]
+    if separator:
+        cut_idx = truncated.rfind(separator)
+        if cut_idx > len(truncated) // 2:
+            truncated = truncated[:cut_idx]
+    truncated = truncated.rstrip()
+    logger.warning(f"Trimmed {label} from ~{token_count} to ~{count_tokens(truncated, model_name)} tokens (budget: {max_tokens}).")
+    return truncated
@@ -0,0 +1,174 @@
+# utils/usage_ledger.py
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+# Khởi tạo logger
+logger = logging.getLogger(__name__)
+
+_ledger_settings = {
+    'output_dir': 'logs/usage',
+    'pricing_per_1m_tokens': {}, # {model: {"prompt": USD, "completion": USD, "cached": USD}}
+    'price_per_image': {},       # {model: USD}
+}
+
+def extract_usage_tokens(usage):
+    """
+    Lấy (prompt_tokens, completion_tokens, cached_tokens) từ response.usage của OpenAI/OpenRouter.
+    cached_tokens = số token prompt được provider đọc từ prompt cache (prompt_tokens_details.cached_tokens).
+    """
+    if usage is None:
+        return 0, 0, 0
+    prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+    completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = (getattr(details, 'cached_tokens', 0) or 0) if details is not None else 0
+    return prompt_tokens, completion_tokens, cached_tokens
+
+def estimate_cost_usd(model_name, prompt_tokens=0, completion_tokens=0, cached_tokens=0, images=0):
+    """Ước lượng chi phí (USD) theo bảng giá trong config. Model không có trong bảng giá -> 0."""
+    cost = 0.0
+    prices = _ledger_settings['pricing_per_1m_tokens'].get(model_name)
+    if prices:
+        uncached_prompt = max(0, prompt_tokens - cached_tokens)
+        cached_price = prices.get('cached', prices.get('prompt', 0.0))
+        cost += (uncached_prompt * prices.get('prompt', 0.0)
+                 + cached_tokens * cached_price
+                 + completion_tokens * prices.get('completion', 0.0)) / 1_000_000
+    if images:
+        cost += images * _ledger_settings['price_per_image'].get(model_name, 0.0)
+    return cost
+
+def cached_prompt_ratio(totals):
+    """Tỉ lệ token prompt được provider đọc từ prompt cache (0.0 nếu chưa có token prompt nào)."""
+    return totals['cached_tokens'] / totals['prompt_tokens'] if totals.get('prompt_tokens') else 0.0
+
+def _empty_totals():
+    return {'calls': 0, 'errors': 0, 'cancelled': 0, 'cache_hits': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+            'cached_tokens': 0, 'total_tokens': 0, 'images': 0, 'wall_sec': 0.0, 'cost_usd': 0.0}
+
+def _add_record(totals, record):
+    totals['calls'] += 1
+    totals['errors'] += 0 if record['success'] or record.get('cancelled') else 1
+    totals['cancelled'] += 1 if record.get('cancelled') else 0
+    totals['cache_hits'] += 1 if record['cache_hit'] else 0
+    for key in ('prompt_tokens', 'completion_tokens', 'cached_tokens', 'images'):
+        totals[key] += record[key]
+    totals['total_tokens'] += record['prompt_tokens'] + record['completion_tokens']
+    totals['wall_sec'] += record['wall_sec']
+    totals['cost_usd'] += record['cost_usd']
+
+class UsageLedger:
+    """Sổ ghi usage (token, thời gian, chi phí ước lượng) của mọi lời gọi LLM/embedding/DALL-E trong một lần chạy."""
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.started_at = time.time()
+        self.records = []
+        self._lock = threading.Lock()
+
+    def record(self, kind, model_name, call_site=None, wall_sec=0.0, prompt_tokens=0, completion_tokens=0,
+               cached_tokens=0, images=0, success=True, cache_hit=False, cancelled=False, provider=None):
+        """
+        kind: 'chat' | 'embedding' | 'image'. Mỗi request HTTP (kể cả lần retry thất bại) là một record.
+        cancelled: request bị hủy giữa chừng (vd: hedge thua) - token là ước lượng, không tính là lỗi.
+        provider: provider thực sự nhận request ('openrouter', 'openai', 'gemini'...), None nếu không rõ.
+        """
+        record = {
+            'kind': kind,
+            'model': model_name,
+            'provider': provider,
+            'call_site': call_site or 'default',
+            'wall_sec': round(float(wall_sec), 4),
+            'prompt_tokens': int(prompt_tokens),
+            'completion_tokens': int(completion_tokens),
+            'cached_tokens': int(cached_tokens),
+            'images': int(images),
+            'success': bool(success),
+            'cache_hit': bool(cache_hit),
+            'cancelled': bool(cancelled),
+            'cost_usd': estimate_cost_usd(model_name, prompt_tokens, completion_tokens, cached_tokens, images),
+            'timestamp': time.time(),
+        }
+        with self._lock:
+            self.records.append(record)
+
+    def summarize(self):
+        """Tổng hợp theo call site và theo model."""
+        with self._lock:
+            records = list(self.records)
+        totals = _empty_totals()
+        by_call_site = {}
+        by_model = {}
+        for record in records:
+            _add_record(totals, record)
+            _add_record(by_call_site.setdefault(record['call_site'], _empty_totals()), record)
+            _add_record(by_model.setdefault(record['model'], _empty_totals()), record)
+        return {'totals': totals, 'by_call_site': by_call_site, 'by_model': by_model, 'records': records}
+
+    def write_summary(self, output_dir=None):
+        """Ghi summary JSON của lần chạy vào output_dir/<run_id>.json. Trả về đường dẫn file hoặc None nếu lỗi."""
+        output_dir = output_dir or _ledger_settings['output_dir']
+        summary = self.summarize()
+        summary.update({
+            'run_id': self.run_id,
+            'started_at': datetime.datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+            'finished_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        })
+        safe_run_id = "".join(c if c.isalnum() or c in '-_' else '_' for c in self.run_id)
+        file_path = os.path.join(output_dir, f"{safe_run_id}.json")
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            with open(file_path, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+        except OSError as e:
+            logger.error(f"Could not write usage summary for run '{self.run_id}' to {file_path}: {e}")
+            return None
+
+        totals = summary['totals']
+        logger.info(f"Usage for run '{self.run_id}': {totals['calls']} calls, {totals['total_tokens']} tokens "
+                    f"({totals['cached_tokens']} cached), {totals['wall_sec']:.1f}s, ~${totals['cost_usd']:.4f}. Saved to {file_path}")
+        top_call_sites = sorted(summary['by_call_site'].items(), key=lambda item: item[1]['total_tokens'], reverse=True)
+        for call_site, site_totals in top_call_sites[:5]:
+            logger.info(f"  Usage [{call_site}]: {site_totals['calls']} calls, {site_totals['total_tokens']} tokens "
+                        f"({cached_prompt_ratio(site_totals):.0%} of prompt tokens cached), "
+                        f"{site_totals['wall_sec']:.1f}s, ~${site_totals['cost_usd']:.4f}")
+        return file_path
+
+# Ledger của lần chạy đang xử lý (mỗi process chỉ xử lý một bài viết tại một thời điểm)
+_active_ledger = None
+
+def configure_usage_ledger(config):
+    """Đọc thư mục lưu summary và bảng giá từ config (USAGE_LOG_DIR, LLM_PRICING_PER_1M_TOKENS, IMAGE_PRICE_PER_IMAGE)."""
+    output_dir = config.get('USAGE_LOG_DIR')
+    if not output_dir:
+        # Mặc định: thư mục "usage" cạnh file log của orchestrator
+        log_dir = os.path.dirname(config.get('ORCHESTRATOR_LOG_FILE_PATH', 'logs/orchestrator.log'))
+        output_dir = os.path.join(log_dir or 'logs', 'usage')
+    _ledger_settings['output_dir'] = output_dir
+    _ledger_settings['pricing_per_1m_tokens'] = dict(config.get('LLM_PRICING_PER_1M_TOKENS') or {})
+    _ledger_settings['price_per_image'] = dict(config.get('IMAGE_PRICE_PER_IMAGE') or {})
+    logger.info(f"Usage ledger summaries will be written to: {output_dir}")
+
+def set_active_usage_ledger(ledger):
+    """Đặt ledger nhận record cho lần chạy hiện tại (None để tắt)."""
+    global _active_ledger
+    _active_ledger = ledger
+
+def get_usage_totals(call_site=None):
+    """Totals của ledger đang hoạt động (toàn bộ hoặc một call site). None nếu không có lần chạy nào đang diễn ra."""
+    ledger = _active_ledger
+    if ledger is None:
+        return None
+    summary = ledger.summarize()
+    if call_site is None:
+        return summary['totals']
+    return summary['by_call_site'].get(call_site, _empty_totals())
+
+def record_usage(kind, model_name, **kwargs):
+    """Ghi một record vào ledger đang hoạt động; không làm gì nếu không có lần chạy nào đang diễn ra."""
+    ledger = _active_ledger
+    if ledger is not None:
+        ledger.record(kind, model_name, **kwargs)
@@ -6,7 +6,7 @@ import html
 import urllib.parse 
 from bs4 import BeautifulSoup
 from utils.api_clients import call_openai_chat, perform_search
-from prompts import external_link_prompts
+from prompts import external_link_prompts, response_schemas
 
 logger = logging.getLogger(__name__)
 
@@ -91,7 +91,9 @@ def process_external_links_for_section(
         is_json_output=True,
         target_api="openrouter",
         openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-        openrouter_base_url=config.get('OPENROUTER_BASE_URL')
+        openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+        call_site="anchor_texts",
+        json_schema=response_schemas.ANCHOR_TEXTS_SCHEMA
     )
     
     # Kiểm tra định dạng của anchor_texts_info_raw
@@ -144,7 +146,8 @@ def process_external_links_for_section(
             api_key=openai_api_key, # OpenAI API key gốc
             target_api="openrouter",
             openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-            openrouter_base_url=config.get('OPENROUTER_BASE_URL')
+            openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+            call_site="citation_keyword"
         )
         if not citation_search_keyword: continue
         logger.info(f"ExtLinks: Search keyword for '{anchor_text_original}': '{citation_search_keyword}'")
@@ -174,7 +177,8 @@ def process_external_links_for_section(
             api_key=openai_api_key, # OpenAI API key gốc
             target_api="openrouter",
             openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-            openrouter_base_url=config.get('OPENROUTER_BASE_URL')
+            openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+            call_site="choose_external_link"
         )
         if not selected_url_string or selected_url_string == "NO_SUITABLE_LINK_FOUND": continue
         
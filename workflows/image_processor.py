@@ -1,15 +1,18 @@
 # workflows/image_processor.py
 import logging
-import time
-import requests # Để tải ảnh
 import urllib.parse # Để encode keyword
+from concurrent.futures import ThreadPoolExecutor
 from utils.api_clients import ( # Đã import perform_search ở file trước
     call_openai_chat, 
     perform_search, # Sử dụng perform_search thay vì google_search trực tiếp
     upload_wp_media
 )
-from utils.image_utils import resize_image
-from prompts import image_prompts
+from utils.image_probe import probe_image_urls
+from utils.image_download import ImageDownloadError
+from utils.image_cache import fetch_resized_image_variants
+from utils.image_dedupe import DuplicateImageError, PublishedImageMatch, get_image_dedupe_index
+from utils.image_utils import choose_output_format, get_output_extension, get_output_mime_type
+from prompts import image_prompts, response_schemas
 # from utils.config_loader import APP_CONFIG # Import config của bạn
 
 logger = logging.getLogger(__name__)
@@ -17,7 +20,6 @@ logger = logging.getLogger(__name__)
 # --- Constants (có thể lấy từ APP_CONFIG) ---
 # MAX_IMAGE_SELECTION_ATTEMPTS = 3 # Số lần thử chọn ảnh khác nhau cho 1 section
 # IMAGE_DOWNLOAD_TIMEOUT = 10 # giây
-# IMAGE_PROCESS_RETRY_DELAY = 5 # giây
 
 def _should_skip_image(section_data):
     """Kiểm tra xem có nên bỏ qua việc chèn ảnh cho section này không."""
@@ -66,6 +68,131 @@ def _filter_image_search_results(image_search_list, failed_urls_list):
     return [img for img in image_search_list if img.get('imageUrl') not in failed_urls_list]
 
 
+def _probe_and_filter_candidates(image_candidates, run_context, config, section_name):
+    """
+    Probe song song mọi ảnh ứng viên (GET có Range lấy phần đầu file) trước khi gửi cho LLM chọn:
+    loại URL chết, nội dung không phải ảnh (theo magic bytes) và ảnh nhỏ hơn IMAGE_SEARCH_MIN_WIDTH/HEIGHT
+    (theo kích thước thật đọc từ header). URL bị loại được đánh dấu lỗi cho cả bài viết.
+    Ứng viên còn lại được cập nhật imageWidth/imageHeight/imageFormat từ kết quả probe.
+    """
+    if not config.get('IMAGE_PROBE_ENABLED', True) or not image_candidates:
+        return image_candidates
+    unavailable_urls = run_context.get_unavailable_image_urls()
+    candidates = [img for img in image_candidates if img.get('imageUrl') not in unavailable_urls]
+    probes = probe_image_urls(
+        [img.get('imageUrl') for img in candidates],
+        timeout=config.get('IMAGE_PROBE_TIMEOUT_SEC', 5),
+        max_header_bytes=config.get('IMAGE_PROBE_MAX_BYTES', 65536),
+        max_workers=config.get('IMAGE_PROBE_MAX_WORKERS', 8)
+    )
+    min_width = config.get('IMAGE_SEARCH_MIN_WIDTH') or 0
+    min_height = config.get('IMAGE_SEARCH_MIN_HEIGHT') or 0
+
+    usable_candidates = []
+    dropped_reasons = {}
+    for img in candidates:
+        image_url = img.get('imageUrl')
+        probe = probes.get(image_url)
+        reason = None
+        if not probe or not probe['ok']:
+            reason = probe['reason'] if probe else 'not_probed'
+        elif probe['width'] and probe['height'] and (probe['width'] < min_width or probe['height'] < min_height):
+            reason = 'too_small'
+        if reason:
+            dropped_reasons[reason] = dropped_reasons.get(reason, 0) + 1
+            run_context.mark_image_url_failed(image_url)
+            continue
+        usable_candidates.append(dict(
+            img,
+            imageWidth=probe['width'] or img.get('imageWidth'),
+            imageHeight=probe['height'] or img.get('imageHeight'),
+            imageFormat=probe['format']
+        ))
+    logger.info(f"Probed {len(candidates)} image candidates for section '{section_name}': "
+                f"{len(usable_candidates)} usable, dropped {dropped_reasons or 'none'}.")
+    return usable_candidates
+
+def _make_image_dedupe_check(run_context, config, reserved_hashes):
+    """
+    Hàm kiểm tra perceptual hash của ảnh gốc (truyền cho fetch_resized_image_variants, chạy trước khi resize):
+    raise DuplicateImageError nếu ảnh gần trùng với ảnh đã dùng trong bài này; raise PublishedImageMatch nếu ảnh
+    gần trùng với ảnh đã publish trên site từ bài khác (index dùng chung giữa các lần chạy) để caller dùng lại
+    media item đó. Hash giữ chỗ thành công (kể cả khi dùng lại ảnh đã publish) được thêm vào reserved_hashes.
+    Trả về None khi IMAGE_DEDUPE_ENABLED tắt.
+    """
+    if not config.get('IMAGE_DEDUPE_ENABLED', False):
+        return None
+    dedupe_index = get_image_dedupe_index()
+    max_distance = config.get('IMAGE_DEDUPE_MAX_DISTANCE', 6)
+
+    def check_image_hash(image_hash):
+        if not run_context.reserve_image_hash(image_hash, max_distance):
+            raise DuplicateImageError("near-duplicate of an image already used in this article")
+        reserved_hashes.append(image_hash)
+        if dedupe_index is not None:
+            match = dedupe_index.find_near_duplicate(config.get('WP_BASE_URL'), image_hash)
+            if match:
+                raise PublishedImageMatch(f"near-duplicate of already published image {match['wp_url']} "
+                                          f"(distance {match['distance']})", match)
+    return check_image_hash
+
+def _get_wp_generated_sizes(wp_media_response, width, height):
+    """
+    Các bản resize WordPress tự tạo khi upload (media_details.sizes) cùng tỉ lệ khung với ảnh width x height
+    (bỏ các size bị crop, vd: thumbnail 150x150), dùng cho srcset mà không phải upload thêm media item.
+    Trả về list {'url', 'width', 'height'}.
+    """
+    sizes = ((wp_media_response.get('media_details') or {}).get('sizes') or {}).values()
+    generated = []
+    for size in sizes:
+        try:
+            size_width, size_height, size_url = int(size['width']), int(size['height']), size['source_url']
+        except (KeyError, TypeError, ValueError):
+            continue
+        if 0 < size_width < width and abs(size_width * height - size_height * width) <= width: # Lệch do làm tròn <= 1px
+            generated.append({'url': size_url, 'width': size_width, 'height': size_height})
+    return generated
+
+def _upload_image_variants(image_variants, primary_variant, base_filename, output_format, config, wp_auth_tuple):
+    """
+    Upload các bản resize của một ảnh lên WordPress (mỗi bản là một media item): ảnh chính trước, các bản srcset
+    còn lại (upload đồng thời) chỉ khi ảnh chính đã upload thành công, để ảnh chính lỗi không để lại media item mồ côi.
+    Trả về {width: {'url', 'width', 'height', 'wp_sizes'}} của các bản upload thành công ({} nếu ảnh chính lỗi)
+    (wp_sizes: các bản resize WordPress tự tạo, xem _get_wp_generated_sizes).
+    """
+    extension = get_output_extension(output_format)
+    mime_type = get_output_mime_type(output_format)
+
+    def upload_variant(variant):
+        wp_media_response = upload_wp_media(
+            config.get('WP_BASE_URL'),
+            wp_auth_tuple[0], wp_auth_tuple[1],
+            variant['data'],
+            f"{base_filename}-{variant['width']}w.{extension}",
+            mime_type
+        )
+        if not (wp_media_response and wp_media_response.get('source_url')):
+            logger.error(f"Failed to upload {variant['width']}w image variant '{base_filename}'. Response: {wp_media_response}")
+            return None
+        return {'url': wp_media_response['source_url'], 'width': variant['width'], 'height': variant['height'],
+                'wp_sizes': _get_wp_generated_sizes(wp_media_response, variant['width'], variant['height'])}
+
+    primary_upload = upload_variant(primary_variant)
+    if not primary_upload:
+        return {}
+    extra_variants = [variant for variant in image_variants if variant is not primary_variant]
+    if not extra_variants:
+        return {primary_upload['width']: primary_upload}
+    with ThreadPoolExecutor(max_workers=len(extra_variants), thread_name_prefix="image-upload") as executor:
+        uploads = [primary_upload] + list(executor.map(upload_variant, extra_variants))
+    return {upload['width']: upload for upload in uploads if upload}
+
+def _release_image_reservation(run_context, image_url, reserved_hashes):
+    """Trả lại URL ảnh gốc (đánh dấu lỗi để không section nào thử lại) và mọi perceptual hash đã giữ chỗ cho nó."""
+    run_context.release_image_url(image_url, failed=True)
+    for image_hash in reserved_hashes:
+        run_context.release_image_hash(image_hash)
+
 def process_single_section_image(section_data, article_title, parent_section_name_for_subchapter,
                                  run_context, # Thay redis_handler bằng run_context
                                  config, openai_api_key, google_api_key,
@@ -77,7 +204,6 @@ def process_single_section_image(section_data, article_title, parent_section_nam
     """
     max_selection_attempts = config.get('MAX_IMAGE_SELECTION_ATTEMPTS', 3)
     download_timeout = config.get('IMAGE_DOWNLOAD_TIMEOUT', 10)
-    retry_delay = config.get('IMAGE_PROCESS_RETRY_DELAY', 5)
     
     # Không cần redis_keys nữa
     # current_section_image_search_key sẽ là section_index_for_redis_key (là một số int)
@@ -100,7 +226,8 @@ def process_single_section_image(section_data, article_title, parent_section_nam
         api_key=openai_api_key, # OpenAI API key gốc
         target_api="openrouter",
         openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-        openrouter_base_url=config.get('OPENROUTER_BASE_URL')
+        openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+        call_site="image_keyword"
     )
     if not image_keyword:
         logger.error(f"Failed to generate image keyword for section: {section_data.get('sectionName')}")
@@ -131,10 +258,12 @@ def process_single_section_image(section_data, article_title, parent_section_nam
         )
         
         image_search_results = _parse_search_results_for_images(search_results_standardized)
+        # Loại trước các ứng viên chết/không phải ảnh/quá nhỏ để LLM chỉ chọn trong các ảnh dùng được
+        image_search_results = _probe_and_filter_candidates(image_search_results, run_context, config, section_data.get('sectionName'))
         if image_search_results:
             run_context.image_search_cache_per_section[section_index_for_redis_key] = image_search_results # Cache vào RunContext
         else:
-            logger.warning(f"No images found from Google Search for keyword: '{image_keyword}'")
+            logger.warning(f"No usable images found from Google Search for keyword: '{image_keyword}'")
             return {"url": "no_images_found_google", "index": section_data.get('sectionIndex')}
     else:
         logger.info(f"Using cached image search results for section {section_data.get('sectionName')}")
@@ -144,9 +273,8 @@ def process_single_section_image(section_data, article_title, parent_section_nam
     for attempt in range(max_selection_attempts):
         logger.info(f"Image selection attempt {attempt + 1}/{max_selection_attempts} for section '{section_data.get('sectionName')}'")
 
-        # Lọc bỏ các URL đã thất bại (từ Redis global failed_urls)
-        # failed_urls_global = redis_handler.get_value(redis_keys['failed_urls']) or [] # Sẽ đọc từ run_context
-        current_image_options_list = _filter_image_search_results(image_search_results, run_context.failed_image_urls)
+        # Lọc bỏ các URL đã thất bại hoặc đã được section khác dùng/giữ chỗ (các section chạy song song)
+        current_image_options_list = _filter_image_search_results(image_search_results, run_context.get_unavailable_image_urls())
 
         if not current_image_options_list:
             logger.warning(f"No image options left to try for section '{section_data.get('sectionName')}' after filtering failed URLs.")
@@ -157,10 +285,11 @@ def process_single_section_image(section_data, article_title, parent_section_nam
         for i, img_data in enumerate(current_image_options_list):
             desc = img_data.get('imageDes', 'N/A')
             url = img_data.get('imageUrl', 'N/A')
-            # Nếu muốn OpenAI cân nhắc kích thước, có thể thêm vào đây:
-            # width = img_data.get('imageWidth', 'N/A')
-            # height = img_data.get('imageHeight', 'N/A')
-            options_parts.append(f"{i+1}. Image Description: {desc}, imageURL: {url}") # , Width: {width}, Height: {height}
+            # Kích thước thật (từ probe) giúp LLM tránh chọn ảnh quá nhỏ hoặc tỉ lệ lạ
+            width = img_data.get('imageWidth')
+            height = img_data.get('imageHeight')
+            size_str = f", Size: {width}x{height}" if width and height else ""
+            options_parts.append(f"{i+1}. Image Description: {desc}, imageURL: {url}{size_str}")
         image_options_str = "\n".join(options_parts)
         if not image_options_str: # Double check
              image_options_str = "No image options available."
@@ -192,7 +321,9 @@ def process_single_section_image(section_data, article_title, parent_section_nam
             is_json_output=True,
             target_api="openrouter",
             openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-            openrouter_base_url=config.get('OPENROUTER_BASE_URL')
+            openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+            call_site="choose_image",
+            json_schema=response_schemas.CHOOSE_IMAGE_SCHEMA
         )
 
         if not chosen_image_info or not chosen_image_info.get('imageURL'):
@@ -210,98 +341,136 @@ def process_single_section_image(section_data, article_title, parent_section_nam
         selected_image_url = chosen_image_info.get('imageURL')
         selected_image_des = chosen_image_info.get('imageDes', s_name) # Dùng section name làm alt text nếu không có des
 
-        # Kiểm tra xem URL này đã được sử dụng cho bài viết này chưa (từ Redis global used_urls)
-        # Để tránh ảnh bị trùng lặp quá nhiều trong cùng một bài.
-        # used_urls_global = redis_handler.get_value(redis_keys['used_urls']) or [] # Sẽ đọc từ run_context
-        if selected_image_url in run_context.used_image_urls:
-            logger.info(f"Image URL '{selected_image_url}' has already been used in this article. Adding to failed list for this section and retrying.")
-            # Thêm vào failed_urls_global để không thử lại URL này cho bất kỳ section nào nữa
-            # Và loại nó khỏi image_search_results của section hiện tại để không bị OpenAI chọn lại
-            run_context.failed_image_urls.add(selected_image_url) # Thêm vào set
-            
-            # Cập nhật image_search_results của section này (trong Redis) bằng cách loại bỏ URL vừa thử
+        # Giữ chỗ URL atomically để hai section chạy song song không bao giờ upload cùng một ảnh gốc.
+        # Thất bại nếu URL đã được dùng/giữ chỗ trong bài viết này hoặc đã bị đánh dấu lỗi.
+        if not run_context.reserve_image_url(selected_image_url):
+            logger.info(f"Image URL '{selected_image_url}' is already used or reserved in this article. Choosing another image.")
+            # Loại nó khỏi image_search_results của section hiện tại để không bị chọn lại
             image_search_results = [img for img in image_search_results if img.get('imageUrl') != selected_image_url]
             run_context.image_search_cache_per_section[section_index_for_redis_key] = image_search_results # Cập nhật cache trong RunContext
-            
-            time.sleep(retry_delay) # Chờ trước khi thử lại với các ảnh còn lại
             continue # Thử chọn ảnh khác từ list đã được lọc
 
 
-        # Tải ảnh
-        image_binary_downloaded = None
+        # URL gốc và các hash giữ chỗ cho ảnh này được trả lại (đánh dấu lỗi) trên mọi đường thất bại,
+        # kể cả khi exception thoát ra ngoài (transcoder/upload/WP lỗi), để không chặn các section khác
+        reserved_hashes = [] # Perceptual hash của ảnh này nếu được giữ chỗ (để trả lại khi lỗi / ghi vào index khi thành công)
+        keep_reservation = False
         try:
-            logger.info(f"Downloading image: {selected_image_url}")
-            response = requests.get(selected_image_url, timeout=download_timeout, stream=True)
-            response.raise_for_status()
-            # Kiểm tra content type (tùy chọn nhưng nên có)
-            content_type = response.headers.get('content-type', '').lower()
-            if 'image' not in content_type:
-                logger.warning(f"URL '{selected_image_url}' does not seem to be an image (Content-Type: {content_type}). Marking as failed.")
-                raise ValueError("Not an image content type")
-            image_binary_downloaded = response.content
-            logger.info(f"Image downloaded successfully (size: {len(image_binary_downloaded)} bytes).")
-        except Exception as e:
-            logger.error(f"Failed to download image '{selected_image_url}': {e}")
-            # Thêm vào failed_urls_global và cập nhật image_search_results của section
-            run_context.failed_image_urls.add(selected_image_url)
-            image_search_results = [img for img in image_search_results if img.get('imageUrl') != selected_image_url]
-            run_context.image_search_cache_per_section[section_index_for_redis_key] = image_search_results
-            time.sleep(retry_delay)
-            continue # Thử chọn ảnh khác
-
-        # Resize ảnh
-        # Xác định output format, ví dụ luôn là JPEG
-        output_img_format = "JPEG"
-        resized_image_data = resize_image(
-            image_binary_downloaded,
-            width=config.get('IMAGE_RESIZE_WIDTH'),
-            height=config.get('IMAGE_RESIZE_HEIGHT'), # Có thể để None nếu chỉ muốn resize theo width
-            output_format=output_img_format,
-            quality=config.get('IMAGE_RESIZE_QUALITY', 85)
-        )
-        if not resized_image_data:
-            logger.error(f"Failed to resize image from URL: {selected_image_url}")
-            run_context.failed_image_urls.add(selected_image_url)
-            image_search_results = [img for img in image_search_results if img.get('imageUrl') != selected_image_url]
-            run_context.image_search_cache_per_section[section_index_for_redis_key] = image_search_results
-            time.sleep(retry_delay)
-            continue # Thử chọn ảnh khác
-
-        # Upload WordPress
-        # Tạo filename (ví dụ: section-name-sanitized.jpg)
-        section_slug = "".join(c if c.isalnum() else '-' for c in s_name.lower()).strip('-')
-        wp_filename = f"{section_slug}-{section_data.get('sectionIndex', 'img')}.{output_img_format.lower()}"
-        mime_type = f"image/{output_img_format.lower()}"
-
-        wp_media_response = upload_wp_media(
-            config.get('WP_BASE_URL'),
-            wp_auth_tuple[0], wp_auth_tuple[1],
-            resized_image_data,
-            wp_filename,
-            mime_type
-        )
-
-        if wp_media_response and wp_media_response.get('source_url'):
-            wp_image_url = wp_media_response.get('source_url')
-            logger.info(f"Image successfully uploaded to WordPress for section '{s_name}'. URL: {wp_image_url}")
+            # Tải + resize ảnh qua cache ảnh trên đĩa (dùng chung giữa các lần chạy/site): bản resize đã cache ->
+            # ảnh gốc đã cache/revalidate -> tải mới (stream, dừng sớm nếu không phải ảnh/quá lớn/quá deadline)
+            # Định dạng xuất: định dạng đầu tiên trong IMAGE_OUTPUT_FORMATS mà Pillow encode được (AVIF/WebP, fallback JPEG)
+            output_img_format = choose_output_format(config.get('IMAGE_OUTPUT_FORMATS'))
+            # Các bản resize cho srcset (IMAGE_SRCSET_WIDTHS + IMAGE_RESIZE_WIDTH) được tạo từ một lần decode;
+            # bản ứng với IMAGE_RESIZE_WIDTH là ảnh chính (src, width/height). IMAGE_RESIZE_HEIGHT giữ nguyên tỉ lệ khung.
+            primary_width = config.get('IMAGE_RESIZE_WIDTH') or 800
+            resize_height = config.get('IMAGE_RESIZE_HEIGHT') # Có thể để None nếu chỉ muốn resize theo width
+            try:
+                logger.info(f"Fetching image: {selected_image_url}")
+                image_variants = fetch_resized_image_variants(
+                    selected_image_url,
+                    widths=[primary_width] + list(config.get('IMAGE_SRCSET_WIDTHS') or []),
+                    height_ratio=(resize_height / primary_width) if resize_height else None,
+                    output_format=output_img_format,
+                    quality=config.get('IMAGE_RESIZE_QUALITY', 85),
+                    max_bytes=config.get('IMAGE_OUTPUT_MAX_BYTES'),
+                    budget_width=primary_width,
+                    min_quality=config.get('IMAGE_OUTPUT_MIN_QUALITY', 50),
+                    download_options={
+                        'timeout': download_timeout,
+                        'max_bytes': config.get('IMAGE_DOWNLOAD_MAX_BYTES', 15 * 1024 * 1024),
+                        'deadline_sec': config.get('IMAGE_DOWNLOAD_DEADLINE_SEC', 30),
+                        'spool_max_memory_bytes': config.get('IMAGE_DOWNLOAD_SPOOL_MEMORY_BYTES', 2 * 1024 * 1024)
+                    },
+                    image_check=_make_image_dedupe_check(run_context, config, reserved_hashes)
+                )
+            except PublishedImageMatch as e:
+                # Ảnh đã upload lên site từ bài khác (vd: ảnh sản phẩm từ CDN khác): dùng lại media item đó,
+                # không resize/upload lại. URL gốc và hash vẫn giữ chỗ để section khác trong bài không dùng lại.
+                published_image = e.published_image
+                keep_reservation = True
+                logger.info(f"Reusing published image {published_image['wp_url']} for section '{s_name}' "
+                            f"(near-duplicate of '{selected_image_url}', distance {published_image['distance']}).")
+                return {
+                    "url": published_image['wp_url'],
+                    "index": section_data.get('sectionIndex'),
+                    "alt_text": selected_image_des,
+                    "width": published_image['width'],
+                    "height": published_image['height'],
+                    "srcset": published_image['srcset']
+                }
+            except DuplicateImageError as e:
+                # Trùng ảnh đã dùng trong bài này (có thể từ URL khác): không resize/upload lại, chọn ảnh khác
+                logger.info(f"Skipping image '{selected_image_url}' for section '{s_name}': {e}")
+                image_search_results = [img for img in image_search_results if img.get('imageUrl') != selected_image_url]
+                run_context.image_search_cache_per_section[section_index_for_redis_key] = image_search_results
+                continue # Thử chọn ảnh khác
+            except ImageDownloadError as e:
+                logger.error(f"Failed to download image '{selected_image_url}' ({e.reason}): {e}")
+                # Chỗ giữ được trả lại (đánh dấu lỗi cho cả bài) trong finally; cập nhật image_search_results của section
+                image_search_results = [img for img in image_search_results if img.get('imageUrl') != selected_image_url]
+                run_context.image_search_cache_per_section[section_index_for_redis_key] = image_search_results
+                continue # Thử chọn ảnh khác
+            if not image_variants:
+                logger.error(f"Failed to resize image from URL: {selected_image_url}")
+                image_search_results = [img for img in image_search_results if img.get('imageUrl') != selected_image_url]
+                run_context.image_search_cache_per_section[section_index_for_redis_key] = image_search_results
+                continue # Thử chọn ảnh khác
+
+            # Upload WordPress
+            # Tạo filename (ví dụ: section-name-sanitized-3-700w.webp)
+            section_slug = "".join(c if c.isalnum() else '-' for c in s_name.lower()).strip('-')
+            primary_variant = next((v for v in image_variants if primary_width in v['box_widths']), image_variants[-1])
+            uploaded_variants = _upload_image_variants(
+                image_variants,
+                primary_variant,
+                f"{section_slug}-{section_data.get('sectionIndex', 'img')}",
+                output_img_format,
+                config,
+                wp_auth_tuple
+            )
+            primary_upload = uploaded_variants.get(primary_variant['width'])
+
+            if primary_upload:
+                wp_image_url = primary_upload['url']
+                # srcset: các bản WordPress tự tạo từ ảnh chính, cộng các bản upload riêng (IMAGE_SRCSET_WIDTHS) nếu có
+                srcset_by_width = {size['width']: size for size in primary_upload['wp_sizes']}
+                srcset_by_width.update({width: {key: upload[key] for key in ('url', 'width', 'height')}
+                                        for width, upload in uploaded_variants.items()})
+                logger.info(f"Image successfully uploaded to WordPress for section '{s_name}'. URL: {wp_image_url} "
+                            f"({len(uploaded_variants)}/{len(image_variants)} uploaded variants, {len(srcset_by_width)} srcset widths)")
+                srcset = [srcset_by_width[width] for width in sorted(srcset_by_width)]
+                dedupe_index = get_image_dedupe_index()
+                if dedupe_index is not None:
+                    for image_hash in reserved_hashes:
+                        dedupe_index.add(config.get('WP_BASE_URL'), image_hash, selected_image_url, wp_image_url,
+                                         primary_upload['width'], primary_upload['height'], srcset)
             
-            # Thêm vào run_context.used_image_urls để không dùng lại cho section khác
-            run_context.used_image_urls.add(selected_image_url) # Lưu URL gốc đã chọn
-
-            # Không cần xóa cache image_search_results của section này khỏi RunContext
-            # vì nó sẽ tự bị hủy khi RunContext bị hủy.
-            # Nếu muốn xóa để tiết kiệm bộ nhớ ngay lập tức (không cần thiết lắm):
-            # if section_index_for_redis_key in run_context.image_search_cache_per_section:
-            #     del run_context.image_search_cache_per_section[section_index_for_redis_key]
-
-            return {"url": wp_image_url, "index": section_data.get('sectionIndex'), "alt_text": selected_image_des}
-        else:
-            logger.error(f"Failed to upload image to WordPress for section '{s_name}'. Original URL: {selected_image_url}. Response: {wp_media_response}")
-            run_context.failed_image_urls.add(selected_image_url)
-            image_search_results = [img for img in image_search_results if img.get('imageUrl') != selected_image_url]
-            run_context.image_search_cache_per_section[section_index_for_redis_key] = image_search_results
-            time.sleep(retry_delay)
-            # continue # Thử chọn ảnh khác (vòng lặp sẽ tự làm)
+                # URL gốc đã nằm trong run_context.used_image_urls từ lúc giữ chỗ -> section khác không dùng lại
+
+                # Không cần xóa cache image_search_results của section này khỏi RunContext
+                # vì nó sẽ tự bị hủy khi RunContext bị hủy.
+                # Nếu muốn xóa để tiết kiệm bộ nhớ ngay lập tức (không cần thiết lắm):
+                # if section_index_for_redis_key in run_context.image_search_cache_per_section:
+                #     del run_context.image_search_cache_per_section[section_index_for_redis_key]
+
+                keep_reservation = True
+                return {
+                    "url": wp_image_url,
+                    "index": section_data.get('sectionIndex'),
+                    "alt_text": selected_image_des,
+                    "width": primary_upload['width'],
+                    "height": primary_upload['height'],
+                    "srcset": srcset
+                }
+            else:
+                logger.error(f"Failed to upload image to WordPress for section '{s_name}'. Original URL: {selected_image_url}.")
+                image_search_results = [img for img in image_search_results if img.get('imageUrl') != selected_image_url]
+                run_context.image_search_cache_per_section[section_index_for_redis_key] = image_search_results
+                # Không cần chờ: upload_wp_media đã tự retry theo RetryPolicy, lần thử sau dùng ảnh khác
+                # continue # Thử chọn ảnh khác (vòng lặp sẽ tự làm)
+        finally:
+            if not keep_reservation:
+                _release_image_reservation(run_context, selected_image_url, reserved_hashes)
 
     # Nếu hết vòng lặp mà không thành công
     logger.warning(f"Exhausted all attempts or options for section '{section_data.get('sectionName')}'. No image uploaded.")
@@ -331,22 +500,22 @@ def process_images_for_article(sections_data_list, article_title, run_context, c
 
     # run_context đã được khởi tạo với các list/set rỗng
 
+    # Xác định chapter cha của từng section theo thứ tự outline trước khi xử lý song song
+    section_jobs = [] # (vị trí trong list, section, tên chapter cha nếu là subchapter)
     parent_chapter_name = None # Theo dõi chapter cha cho các subchapter
     for i, section in enumerate(sections_data_list):
         if section.get('sectionType') == 'chapter':
             parent_chapter_name = section.get('sectionName')
+        parent_name_for_sub = parent_chapter_name if section.get('sectionType') == 'subchapter' else None
+        section_jobs.append((i, section, parent_name_for_sub))
 
-        current_image_data_for_section = {"url": "not_inserted_by_default", "index": section.get('sectionIndex'), "alt_text": section.get('sectionName')}
-
+    def process_section_job(job):
+        i, section, parent_name_for_sub = job
         if _should_skip_image(section):
-            current_image_data_for_section["url"] = "skipped_section_type"
             logger.info(f"Image skipped for section {section.get('sectionName')}, added placeholder to array.")
-        else:
-            # Thực sự xử lý ảnh
-            # Truyền parent_chapter_name nếu section hiện tại là subchapter
-            parent_name_for_sub = parent_chapter_name if section.get('sectionType') == 'subchapter' else None
-            
-            image_result = process_single_section_image(
+            return {"url": "skipped_section_type", "index": section.get('sectionIndex'), "alt_text": section.get('sectionName')}
+        try:
+            return process_single_section_image(
                 section_data=section,
                 article_title=article_title,
                 parent_section_name_for_subchapter=parent_name_for_sub,
@@ -358,27 +527,20 @@ def process_images_for_article(sections_data_list, article_title, run_context, c
                 unique_run_id=run_context.unique_run_id, 
                 section_index_for_redis_key=i # Dùng index trong list làm ID cho key cache
             )
-            current_image_data_for_section = image_result
-        
-        # Cập nhật image_array trong Redis sau mỗi section (hoặc có thể làm cuối cùng)
-        # Logic này tương tự node "imageArray2" -> "Set imageArray to Redis2"
-        # current_global_image_array = redis_handler.get_value(redis_keys['image_array']) or [] # Sẽ đọc từ run_context
-        # Đảm bảo không thêm trùng entry cho cùng một index nếu có retry ở mức cao hơn
-        # Hoặc, cách đơn giản hơn là chỉ build list ở Python rồi set một lần vào Redis ở cuối.
-        # Tạm thời build ở Python trước:
-        run_context.processed_image_data.append(current_image_data_for_section)
-
-
-    # Sắp xếp lại run_context.processed_image_data theo 'index' nếu cần thiết (nếu xử lý song song)
-    # Nếu xử lý tuần tự thì nó đã theo thứ tự.
-    # Loại bỏ trùng lặp theo index nếu có (hiếm khi xảy ra với logic tuần tự)
-    # unique_images_by_index = {img['index']: img for img in run_context.processed_image_data}
-    # sorted_unique_images = sorted(unique_images_by_index.values(), key=lambda x: x['index'])
-
-    # Không cần lưu vào Redis nữa, vì đã lưu vào run_context.processed_image_data
-    # Điều này đơn giản hơn việc đọc/ghi Redis liên tục cho image_array chính.
-    # redis_handler.set_value(redis_keys['image_array'], run_context.processed_image_data) 
-    
+        except Exception as e:
+            logger.exception(f"Unexpected error processing image for section '{section.get('sectionName')}': {e}")
+            return {"url": "error_unexpected", "index": section.get('sectionIndex')}
+
+    # Các section độc lập với nhau (trùng ảnh được chặn bằng run_context.reserve_image_url),
+    # nên chạy song song; executor.map giữ nguyên thứ tự section trong kết quả.
+    max_workers = max(1, int(config.get('IMAGE_PROCESSING_MAX_WORKERS', 1)))
+    if max_workers > 1 and len(section_jobs) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(section_jobs)), thread_name_prefix="image-section") as executor:
+            section_results = list(executor.map(process_section_job, section_jobs))
+    else:
+        section_results = [process_section_job(job) for job in section_jobs]
+    run_context.processed_image_data.extend(section_results)
+
     logger.info(f"Finished image processing for article '{article_title}'. Final image data for this run (stored in RunContext): {run_context.processed_image_data}")
     
     # Hàm này chỉ trả về kết quả của lần chạy này.
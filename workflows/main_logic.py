@@ -3,12 +3,14 @@ import logging
 import json
 import re
 import time # Cho việc sleep nếu cần
+import threading
 import html
 import requests
 import random # Thêm import random
 import datetime # Thêm import datetime
 from datetime import timezone # Cụ thể hơn cho timezone.utc
 from bs4 import BeautifulSoup # Thêm BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
 from utils.api_clients import (
     call_openai_dalle, 
     create_wp_category, 
@@ -22,11 +24,17 @@ from utils.api_clients import (
 )
 from utils.google_sheets_handler import GoogleSheetsHandler
 from utils.pinecone_handler import PineconeHandler
-from utils.image_utils import resize_image
+from utils.image_transcoder import transcode_image
+from utils.image_utils import choose_output_format, get_output_extension, get_output_mime_type
+from utils.image_dedupe import hamming_distance
+from utils.image_download import download_image
 from utils.db_handler import MySQLHandler
 from utils.html_utils import basic_markdown_to_html
+from utils.task_graph import GraphTask, run_task_graph
+from utils.usage_ledger import UsageLedger, set_active_usage_ledger, get_usage_totals, cached_prompt_ratio
+from utils.token_counter import count_tokens, truncate_to_token_budget, words_to_tokens
 
-from prompts import main_prompts, content_prompts, misc_prompts, image_prompts
+from prompts import main_prompts, content_prompts, misc_prompts, image_prompts, response_schemas
 from workflows import image_processor
 from workflows import video_processor
 from workflows import external_links_processor
@@ -46,6 +54,7 @@ class RunContext:
         self.image_search_cache_per_section: dict = {} # Key: section_index, Value: list kết quả tìm kiếm
         self.failed_image_urls: set = set() # Set các URL ảnh tải thất bại trong lần chạy này
         self.used_image_urls: set = set()   # Set các URL ảnh gốc đã được sử dụng trong bài viết này
+        self.used_image_hashes: list = []   # Perceptual hash (dHash) của các ảnh đã dùng/đang giữ chỗ trong bài viết này
         self.processed_image_data: list = [] # List các dict thông tin ảnh đã xử lý và upload
 
         # Dữ liệu cho video_processor
@@ -54,8 +63,63 @@ class RunContext:
         # Dữ liệu cho external_links_processor
         self.used_external_links: set = set() # Set các URL external link đã chèn
 
+        # Usage (token, thời gian, chi phí) của mọi lời gọi LLM/embedding/DALL-E trong lần chạy này
+        self.usage_ledger: UsageLedger = UsageLedger(unique_run_id)
+
+        # Bảo vệ used_image_urls/failed_image_urls/used_image_hashes khi nhiều section xử lý ảnh song song
+        self.image_urls_lock = threading.Lock()
+
         logger.info(f"RunContext initialized for run_id: {unique_run_id}")
 
+    def reserve_image_url(self, image_url) -> bool:
+        """
+        Giữ chỗ atomically một URL ảnh gốc cho section đang xử lý: thành công (True) nếu URL chưa được
+        section nào dùng/giữ chỗ và chưa bị đánh dấu lỗi. URL giữ chỗ được tính là đã dùng cho tới khi release.
+        """
+        with self.image_urls_lock:
+            if image_url in self.used_image_urls or image_url in self.failed_image_urls:
+                return False
+            self.used_image_urls.add(image_url)
+            return True
+
+    def release_image_url(self, image_url, failed=True):
+        """Trả lại URL đã giữ chỗ (tải/resize/upload không thành công); failed=True để không section nào thử lại nó."""
+        with self.image_urls_lock:
+            self.used_image_urls.discard(image_url)
+            if failed:
+                self.failed_image_urls.add(image_url)
+
+    def mark_image_url_failed(self, image_url):
+        """Đánh dấu URL không dùng được (chết/không phải ảnh/quá nhỏ) cho mọi section của bài viết."""
+        with self.image_urls_lock:
+            self.failed_image_urls.add(image_url)
+
+    def reserve_image_hash(self, image_hash, max_distance) -> bool:
+        """
+        Giữ chỗ atomically perceptual hash của ảnh: thất bại (False) nếu bài viết đã dùng/đang giữ chỗ một ảnh
+        gần trùng (khoảng cách Hamming <= max_distance), kể cả khi nó đến từ URL khác.
+        """
+        with self.image_urls_lock:
+            if any(hamming_distance(image_hash, used_hash) <= max_distance for used_hash in self.used_image_hashes):
+                return False
+            self.used_image_hashes.append(image_hash)
+            return True
+
+    def release_image_hash(self, image_hash):
+        """Trả lại hash đã giữ chỗ (resize/upload ảnh không thành công)."""
+        with self.image_urls_lock:
+            if image_hash in self.used_image_hashes:
+                self.used_image_hashes.remove(image_hash)
+
+    def get_unavailable_image_urls(self) -> set:
+        """Snapshot các URL không được chọn nữa (đã dùng/đang giữ chỗ bởi section khác hoặc đã lỗi)."""
+        with self.image_urls_lock:
+            return self.used_image_urls | self.failed_image_urls
+
+def _get_prompt_token_budget(context_name, config):
+    """Budget token cho một phần context biến đổi của prompt (PROMPT_TOKEN_BUDGETS), None nếu không giới hạn."""
+    return (config.get('PROMPT_TOKEN_BUDGETS') or {}).get(context_name)
+
 #####################################################
 ### --- Bước 1: Phân tích Keyword và Chuẩn bị --- ###
 #####################################################
@@ -106,7 +170,9 @@ def choose_author_for_topic(topic_or_keyword, author_personas_list_from_config,
             is_json_output=True,
             target_api="openrouter",
             openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-            openrouter_base_url=config.get('OPENROUTER_BASE_URL')
+            openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+            call_site="choose_author",
+            json_schema=response_schemas.CHOOSE_AUTHOR_SCHEMA
         )
         
         if chosen_author_data and isinstance(chosen_author_data, dict) and \
@@ -164,6 +230,10 @@ def analyze_serp_and_keyword(keyword, serp_data_string, config):
         return None
         
     logger.info(f"Analyzing SERP and keyword: '{keyword}'")
+    serp_data_string = truncate_to_token_budget(
+        serp_data_string, _get_prompt_token_budget("serp_results", config),
+        model_name=config.get('DEFAULT_OPENAI_CHAT_MODEL'), separator="\n---", label="SERP data"
+    )
     prompt = main_prompts.ANALYZE_KEYWORD_FROM_SERP_PROMPT.format(
         keyword=keyword,
         search_results_data=serp_data_string
@@ -176,7 +246,9 @@ def analyze_serp_and_keyword(keyword, serp_data_string, config):
             is_json_output=True,
             target_api="openrouter",
             openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-            openrouter_base_url=config.get('OPENROUTER_BASE_URL')
+            openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+            call_site="serp_analysis",
+            json_schema=response_schemas.SERP_ANALYSIS_SCHEMA
         )
         if analysis_result and isinstance(analysis_result, dict) and \
            all(k in analysis_result for k in ['searchIntent', 'contentFormat', 'articleType', 'selectedModel', 'semanticKeyword']):
@@ -205,7 +277,8 @@ def check_keyword_suitability(keyword, config, gsheet_handler):
             is_json_output=True, # Vì prompt yêu cầu JSON
             target_api="openrouter", # Hoặc "openai" tùy cấu hình
             openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-            openrouter_base_url=config.get('OPENROUTER_BASE_URL')
+            openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+            call_site="keyword_suitability"
         )
         if suitability_response and isinstance(suitability_response, dict) and \
            suitability_response.get('suitable', '').lower() == 'yes':
@@ -507,7 +580,9 @@ def generate_initial_outline(keyword_to_process, preparation_data, config):
             is_json_output=True, # Prompt yêu cầu JSON
             target_api="openrouter",
             openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-            openrouter_base_url=config.get('OPENROUTER_BASE_URL')
+            openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+            call_site="outline_initial",
+            json_schema=response_schemas.INITIAL_OUTLINE_SCHEMA
         )
 
         if initial_outline_json and isinstance(initial_outline_json, dict) and \
@@ -549,7 +624,8 @@ def enrich_outline_with_author_hooks(keyword_to_process, initial_outline_dict, c
         keyword=keyword_to_process,
         initial_outline_json_string=initial_outline_json_string,
         author_name=chosen_author_data.get("name"),
-        author_bio=chosen_author_data.get("info")
+        author_bio=truncate_to_token_budget(chosen_author_data.get("info"), _get_prompt_token_budget("author_info", config),
+                                            separator=". ", label="author info")
     )
 
     try:
@@ -560,7 +636,9 @@ def enrich_outline_with_author_hooks(keyword_to_process, initial_outline_dict, c
             is_json_output=True, # Prompt yêu cầu JSON
             target_api="openrouter",
             openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-            openrouter_base_url=config.get('OPENROUTER_BASE_URL')
+            openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+            call_site="outline_enrich",
+            json_schema=response_schemas.ENRICHED_OUTLINE_SCHEMA
         )
 
         if enriched_outline_json and isinstance(enriched_outline_json, dict) and \
@@ -740,10 +818,57 @@ def create_article_outline_step(keyword_to_process, preparation_data, config):
 ### --- Bước 3: Viết Nội dung từng Section --- ###
 ##################################################
 
+def _get_stream_word_limit(target_words, config):
+    """
+    Số từ tối đa trước khi dừng stream sớm: độ dài yêu cầu * LLM_STREAM_OVERSHOOT_FACTOR.
+    Trả về None nếu không xác định được độ dài (khi đó chỉ còn trần token cứng).
+    """
+    try:
+        target_words = int(target_words)
+    except (TypeError, ValueError):
+        return None
+    if target_words <= 0:
+        return None
+    return int(target_words * float(config.get('LLM_STREAM_OVERSHOOT_FACTOR', 1.6)))
+
+def _get_section_max_tokens(target_words, config):
+    """
+    max_tokens cho một section: độ dài yêu cầu (từ) đổi ra token * SECTION_MAX_TOKENS_FACTOR
+    (chừa chỗ cho markup Markdown/HTML). None nếu không xác định được độ dài.
+    """
+    try:
+        target_words = int(target_words)
+    except (TypeError, ValueError):
+        return None
+    if target_words <= 0:
+        return None
+    return int(words_to_tokens(target_words) * float(config.get('SECTION_MAX_TOKENS_FACTOR', 2.0)))
+
+def _is_faq_section(section_data):
+    """Section FAQ (WRITE_FAQ_SECTION_PROMPT): output là HTML kèm markup FAQ schema.org, không viết theo độ dài yêu cầu."""
+    return section_data.get("sectionNameTag", "").lower() == "faqs"
+
+def _generate_section_writer_context(article_meta, chosen_author_data, all_section_names_list_str,
+                                     preparation_data, config):
+    """
+    Tạo system message chung cho mọi section của bài viết (tiêu đề, tác giả, model, outline, quy tắc viết).
+    Nội dung phải giống hệt nhau giữa các section để provider cache được prefix của prompt.
+    """
+    author_bio = truncate_to_token_budget(chosen_author_data.get("info", ""), _get_prompt_token_budget("author_info", config),
+                                          separator=". ", label="author info")
+    return content_prompts.SECTION_WRITER_CONTEXT_PROMPT.format(
+        article_title=article_meta.get("title", "N/A Article Title"),
+        author_name=chosen_author_data.get("name", "The Author"),
+        author_bio=author_bio,
+        selected_model=preparation_data.get("keyword_analysis", {}).get("selectedModel", "N/A"),
+        section_names_list=all_section_names_list_str
+    )
+
 def _generate_prompt_for_section_content(section_data, article_meta, chosen_author_data, 
                                          all_section_names_list_str, preparation_data, config):
     """
-    Tạo prompt cụ thể để LLM viết nội dung cho một section.
+    Tạo prompt cụ thể để LLM viết nội dung cho một section (user message).
+    Chỉ chứa phần riêng của section; ngữ cảnh chung của bài nằm trong _generate_section_writer_context.
     """
     s_name = section_data.get("sectionName")
     s_type = section_data.get("sectionType")
@@ -752,14 +877,13 @@ def _generate_prompt_for_section_content(section_data, article_meta, chosen_auth
     s_length = section_data.get("length", 200) # Độ dài mặc định
     s_hook_text = section_data.get("sectionHook", "")
     s_author_info = section_data.get("authorInfo", chosen_author_data.get("info", "")) # Dùng author info chung nếu section không có info riêng
+    s_author_info = truncate_to_token_budget(s_author_info, _get_prompt_token_budget("author_info", config),
+                                             separator=". ", label="author info")
     s_semantic_keywords_list = section_data.get("separatedSemanticKeyword", [])
     s_semantic_keywords_str = ", ".join(s_semantic_keywords_list) if isinstance(s_semantic_keywords_list, list) else (s_semantic_keywords_list or "")
 
     article_title = article_meta.get("title", "N/A Article Title")
     # article_type = article_meta.get("article_type", "N/A Type") # Có thể cần cho một số prompt
-    selected_model = preparation_data.get("keyword_analysis", {}).get("selectedModel", "N/A") # Lấy từ preparation_data
-    
-    author_name = chosen_author_data.get("name", "The Author")
 
     prompt_section_hook_instruction = ""
     if s_hook_text:
@@ -774,26 +898,19 @@ def _generate_prompt_for_section_content(section_data, article_meta, chosen_auth
         prompt_template = content_prompts.WRITE_INTRODUCTION_PROMPT_WITH_HOOK_CHOICES
         return prompt_template.format(
             length=s_length,
-            article_title=article_title,
             keyword_for_hook=keyword_for_hook, # Placeholder mới
             semantic_keywords=s_semantic_keywords_str,
-            author_name=author_name,
-            author_info=s_author_info, # authorInfo cụ thể cho section Intro
-            section_names_list=all_section_names_list_str
+            author_info=s_author_info # authorInfo cụ thể cho section Intro
         )
     elif s_name_tag == "conclusion":
         prompt_template = content_prompts.WRITE_CONCLUSION_PROMPT
         # Định dạng và trả về ngay cho Conclusion
         return prompt_template.format(
             length=s_length,
-            article_title=article_title,
             prompt_section_hook=prompt_section_hook_instruction,
             semantic_keywords=s_semantic_keywords_str,
-            author_name=author_name,
             author_info=s_author_info, # authorInfo cụ thể cho section Conclusion
-            section_names_list=all_section_names_list_str,
-            model_role=s_model_role, # ADDED: Provide model_role
-            selected_model=selected_model  # ADDED: Provide selected_model
+            model_role=s_model_role # ADDED: Provide model_role
         )
     elif s_name_tag == "faqs":
         prompt_template = content_prompts.WRITE_FAQ_SECTION_PROMPT
@@ -828,15 +945,11 @@ def _generate_prompt_for_section_content(section_data, article_meta, chosen_auth
                 section_name=s_name,
                 headline=section_data.get("headline", f"Review of {s_name}"), # Lấy headline từ section_data
                 parent_section_name=section_data.get("parentChapterName", "the main topic"),
-                article_title=article_title,
                 model_role=s_model_role,
-                selected_model=selected_model,
                 prompt_section_hook=prompt_section_hook_instruction,
                 semantic_keywords=s_semantic_keywords_str,
-                author_name=author_name,
                 author_info=s_author_info,
-                product_list=section_data.get("product_list_for_comparison", "other related products"), # Cần truyền vào
-                section_names_list=all_section_names_list_str
+                product_list=section_data.get("product_list_for_comparison", "other related products") # Cần truyền vào
             )
         else: # Subchapter thông thường
             prompt_template = content_prompts.WRITE_SUBCHAPTER_PROMPT
@@ -844,14 +957,10 @@ def _generate_prompt_for_section_content(section_data, article_meta, chosen_auth
                 length=s_length,
                 section_name=s_name,
                 parent_section_name=section_data.get("parentChapterName", "the main topic"),
-                article_title=article_title,
                 model_role=s_model_role,
-                selected_model=selected_model,
                 prompt_section_hook=prompt_section_hook_instruction,
                 semantic_keywords=s_semantic_keywords_str,
-                author_name=author_name,
-                author_info=s_author_info,
-                section_names_list=all_section_names_list_str
+                author_info=s_author_info
             )
     
     if not prompt_template: # Trường hợp không xác định được template (không nên xảy ra)
@@ -862,19 +971,197 @@ def _generate_prompt_for_section_content(section_data, article_meta, chosen_auth
     return prompt_template.format(
         length=s_length,
         section_name=s_name, # Chỉ có ở WRITE_CHAPTER_PROMPT
-        article_title=article_title,
         model_role=s_model_role,
-        selected_model=selected_model,
         prompt_section_hook=prompt_section_hook_instruction,
         semantic_keywords=s_semantic_keywords_str,
-        author_name=author_name,
-        author_info=s_author_info,
-        section_names_list=all_section_names_list_str
+        author_info=s_author_info
+    )
+
+def _write_section_content(section_copy, prompt_for_llm, section_writer_context, config):
+    """
+    Gọi LLM viết nội dung HTML cho một section. Trả về html_content
+    (hoặc comment placeholder nếu section là container/không có prompt/lỗi).
+    """
+    logger.info(f"--- Writing content for section: {section_copy.get('sectionName')} (Index: {section_copy.get('sectionIndex')}) ---")
+    html_content = ""
+    if prompt_for_llm == content_prompts.SAY_I_LOVE_YOU_PROMPT:
+        logger.info(f"Section '{section_copy.get('sectionName')}' is a container, content will be 'I love you' (ignored).")
+        html_content = "<!-- Container Chapter - No Content Needed -->" # Hoặc để rỗng
+    elif prompt_for_llm:
+        logger.debug(f"Prompt for LLM (section: {section_copy.get('sectionName')}):\n{prompt_for_llm[:300]}...") # Log phần đầu prompt
+        
+        # Sử dụng model mạnh hơn cho content writing nếu cần
+        content_model = config.get('DEFAULT_OPENAI_CHAT_MODEL_FOR_CONTENT', config.get('DEFAULT_OPENAI_CHAT_MODEL'))
+        is_faq_section = _is_faq_section(section_copy)
+        if is_faq_section: # FAQ có thể dùng model thường
+            content_model = config.get('DEFAULT_OPENAI_CHAT_MODEL')
+        # FAQ: markup schema.org dài hơn nhiều so với "length" của section -> không áp max_tokens/giới hạn số từ
+        # theo độ dài (sẽ cắt giữa markup), chỉ còn trần cứng LLM_STREAM_MAX_OUTPUT_TOKENS
+        section_length = None if is_faq_section else section_copy.get("length")
+
+        llm_response = call_openai_chat(
+            prompt_messages=[
+                {"role": "system", "content": section_writer_context},
+                {"role": "user", "content": prompt_for_llm}
+            ],
+            model_name=content_model,
+            api_key=config.get('OPENAI_API_KEY'), # OpenAI API key gốc
+            is_json_output=False, # Nội dung là HTML string, không phải JSON
+            target_api="openrouter",
+            openrouter_api_key=config.get('OPENROUTER_API_KEY'),
+            openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+            call_site="section_content",
+            max_tokens=_get_section_max_tokens(section_length, config),
+            stream=config.get('LLM_STREAMING_ENABLED', False),
+            # Output vượt quá xa độ dài yêu cầu -> dừng sớm, cắt tại block hoàn chỉnh cuối cùng
+            max_output_words=_get_stream_word_limit(section_length, config),
+            max_output_tokens=config.get('LLM_STREAM_MAX_OUTPUT_TOKENS')
+        )
+        if llm_response:
+            # Kiểm tra nếu LLM trả về "I love you" (dù không nên nếu prompt khác)
+            if "i love you" in llm_response.lower() and len(llm_response) < 20:
+                logger.info(f"LLM responded with 'I love you' for section '{section_copy.get('sectionName')}'. Treating as no content.")
+                html_content = "<!-- LLM Fallback to ILY - No Content -->"
+            else:
+                # Luôn xử lý phản hồi của LLM qua markdown_to_html_advanced.
+                # Điều này đảm bảo rằng mọi Markdown sẽ được chuyển đổi sang HTML.
+                # Giả định rằng markdown_to_html_advanced xử lý đầu vào đã là HTML một cách duyên dáng
+                # (ví dụ: bằng cách bỏ qua hoặc chuẩn hóa nó mà không làm hỏng).
+                logger.info(f"Converting LLM response to HTML for section '{section_copy.get('sectionName')}' using markdown_to_html_advanced.")
+                html_content = basic_markdown_to_html(llm_response)
+        else:
+            logger.error(f"Failed to generate content from LLM for section '{section_copy.get('sectionName')}'.")
+            html_content = f"<!-- Error generating content for {section_copy.get('sectionName')} -->"
+    else:
+        logger.warning(f"No prompt generated for section '{section_copy.get('sectionName')}'. Skipping content generation.")
+        html_content = "<!-- No prompt for this section -->"
+    return html_content
+
+def _write_section_content_safe(section_copy, prompt_for_llm, section_writer_context, config):
+    """Như _write_section_content, nhưng lỗi bất ngờ trong worker thread trở thành placeholder lỗi của section."""
+    try:
+        return _write_section_content(section_copy, prompt_for_llm, section_writer_context, config)
+    except Exception as e:
+        logger.exception(f"Unexpected error writing content for section '{section_copy.get('sectionName')}': {e}")
+        return f"<!-- Error generating content for {section_copy.get('sectionName')} -->"
+
+def _map_section_tasks(task_fn, items, max_workers):
+    """
+    Chạy task_fn cho từng item với tối đa max_workers thread, trả về kết quả theo đúng thứ tự items.
+    task_fn không được raise (dùng các hàm *_safe). Lời gọi LLM từ các thread vẫn đi qua
+    semaphore theo model và rate limiter của utils/api_clients.py.
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [task_fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items)), thread_name_prefix="section-writer") as executor:
+        return list(executor.map(task_fn, items))
+
+def _is_batchable_section(section_data, prompt_for_llm, config):
+    """Subchapter ngắn (độ dài yêu cầu <= SECTION_BATCH_MAX_WORDS) có prompt thật (không phải container)."""
+    if not prompt_for_llm or prompt_for_llm == content_prompts.SAY_I_LOVE_YOU_PROMPT:
+        return False
+    if section_data.get("sectionType") != "subchapter":
+        return False
+    try:
+        length = int(section_data.get("length", 0))
+    except (TypeError, ValueError):
+        return False
+    return 0 < length <= int(config.get('SECTION_BATCH_MAX_WORDS', 200))
+
+def _group_section_jobs_for_batching(section_jobs, config):
+    """
+    Gom các subchapter ngắn nằm liền nhau trong outline thành nhóm tối đa SECTION_BATCH_MAX_SECTIONS section.
+    Chỉ trả về các nhóm có từ 2 section trở lên; section còn lại được viết riêng như bình thường.
+    """
+    max_sections = int(config.get('SECTION_BATCH_MAX_SECTIONS', 4))
+    if max_sections < 2:
+        return []
+    batches = []
+    current_batch = []
+    for section_copy, prompt_for_llm in section_jobs:
+        if _is_batchable_section(section_copy, prompt_for_llm, config):
+            current_batch.append((section_copy, prompt_for_llm))
+            if len(current_batch) < max_sections:
+                continue
+        if len(current_batch) >= 2:
+            batches.append(current_batch)
+        current_batch = []
+    if len(current_batch) >= 2:
+        batches.append(current_batch)
+    return batches
+
+def _write_section_batch_content(batch_jobs, section_writer_context, config):
+    """
+    Viết nhiều subchapter ngắn trong một request LLM. LLM trả JSON {"sections": [{"sectionIndex", "content"}]}.
+    Trả về dict {str(sectionIndex): html_content} chỉ gồm các section có nội dung hợp lệ trong kết quả;
+    section bị thiếu/rỗng sẽ được caller viết lại bằng request riêng.
+    """
+    expected_indexes = [str(section_copy.get("sectionIndex")) for section_copy, _ in batch_jobs]
+    section_names = [section_copy.get("sectionName") for section_copy, _ in batch_jobs]
+    logger.info(f"--- Writing {len(batch_jobs)} short sections in one request: {section_names} (Indexes: {expected_indexes}) ---")
+
+    section_requests = "\n\n".join(
+        content_prompts.SECTION_BATCH_ITEM_TEMPLATE.format(section_index=section_index, section_prompt=prompt_for_llm.strip())
+        for section_index, (_, prompt_for_llm) in zip(expected_indexes, batch_jobs)
+    )
+    batch_prompt = content_prompts.WRITE_SECTION_BATCH_PROMPT.format(
+        section_count=len(batch_jobs),
+        section_requests=section_requests
+    )
+    section_max_tokens = [_get_section_max_tokens(section_copy.get("length"), config) for section_copy, _ in batch_jobs]
+    batch_max_tokens = sum(section_max_tokens) if all(section_max_tokens) else None
+
+    llm_response = call_openai_chat(
+        prompt_messages=[
+            {"role": "system", "content": section_writer_context},
+            {"role": "user", "content": batch_prompt}
+        ],
+        model_name=config.get('DEFAULT_OPENAI_CHAT_MODEL_FOR_CONTENT', config.get('DEFAULT_OPENAI_CHAT_MODEL')),
+        api_key=config.get('OPENAI_API_KEY'),
+        is_json_output=True,
+        target_api="openrouter",
+        openrouter_api_key=config.get('OPENROUTER_API_KEY'),
+        openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+        call_site="section_content_batch",
+        json_schema=response_schemas.SECTION_BATCH_SCHEMA,
+        max_tokens=batch_max_tokens
     )
+    if not isinstance(llm_response, dict) or not isinstance(llm_response.get("sections"), list):
+        logger.warning(f"Batched section request returned no usable result. Writing sections {expected_indexes} one by one.")
+        return {}
+
+    html_by_index = {}
+    for item in llm_response["sections"]:
+        if not isinstance(item, dict):
+            continue
+        section_index = str(item.get("sectionIndex"))
+        content = item.get("content")
+        if section_index not in expected_indexes or section_index in html_by_index:
+            continue
+        if not isinstance(content, str) or not content.strip():
+            continue
+        if "i love you" in content.lower() and len(content) < 20:
+            continue
+        html_by_index[section_index] = basic_markdown_to_html(content)
+
+    missing_indexes = [section_index for section_index in expected_indexes if section_index not in html_by_index]
+    if missing_indexes:
+        logger.warning(f"Batched section request is missing sections {missing_indexes}. They will be written individually.")
+    logger.info(f"Batched section request produced {len(html_by_index)}/{len(expected_indexes)} sections.")
+    return html_by_index
+
+def _write_section_batch_content_safe(batch_jobs, section_writer_context, config):
+    """Như _write_section_batch_content; lỗi bất ngờ -> {} để các section trong batch được viết riêng."""
+    try:
+        return _write_section_batch_content(batch_jobs, section_writer_context, config)
+    except Exception as e:
+        logger.exception(f"Unexpected error in batched section request: {e}")
+        return {}
 
 def write_content_for_all_sections_step(processed_sections_list, article_meta, preparation_data, config):
     """
-    Lặp qua từng section và gọi LLM để viết nội dung HTML.
+    Gọi LLM viết nội dung HTML cho từng section, tối đa SECTION_WRITER_MAX_WORKERS request đồng thời.
     Trả về một list các dictionaries, mỗi dict chứa thông tin section và 'html_content'.
     """
     if not processed_sections_list:
@@ -888,7 +1175,10 @@ def write_content_for_all_sections_step(processed_sections_list, article_meta, p
 
     sections_with_written_content = []
     all_section_names = [s.get("sectionName") for s in processed_sections_list if s.get("sectionName")]
-    all_section_names_list_str = ", ".join(all_section_names)
+    all_section_names_list_str = truncate_to_token_budget(
+        ", ".join(all_section_names), _get_prompt_token_budget("section_names_list", config),
+        separator=", ", label="section names list"
+    )
 
     # Chuẩn bị product_list_for_comparison cho các product review subchapters
     product_names_for_comparison = [
@@ -902,11 +1192,19 @@ def write_content_for_all_sections_step(processed_sections_list, article_meta, p
         if section_data.get("sectionType") == "subchapter" and section_data.get("sectionNameTag", "").lower() == "product":
             section_data["product_list_for_comparison"] = product_list_for_comparison_str
 
+    # System message chung, giống hệt nhau cho mọi section -> phần prefix được provider cache lại
+    section_writer_context = _generate_section_writer_context(
+        article_meta, chosen_author_data, all_section_names_list_str, preparation_data, config
+    )
+    context_tokens = count_tokens(section_writer_context, config.get('DEFAULT_OPENAI_CHAT_MODEL_FOR_CONTENT'))
+    logger.info(f"Shared section-writer context: {context_tokens} tokens (reused as cacheable prompt prefix for every section).")
+    min_cacheable_tokens = config.get('PROMPT_CACHE_MIN_PREFIX_TOKENS', 1024)
+    if context_tokens < min_cacheable_tokens:
+        logger.info(f"Shared context is below {min_cacheable_tokens} tokens; the provider may not cache it.")
 
+    section_jobs = [] # (section_copy, prompt_for_llm) theo đúng thứ tự outline
     for section_data in processed_sections_list:
         section_copy = dict(section_data) # Làm việc trên bản copy
-        logger.info(f"--- Writing content for section: {section_copy.get('sectionName')} (Index: {section_copy.get('sectionIndex')}) ---")
-
         prompt_for_llm = _generate_prompt_for_section_content(
             section_data=section_copy,
             article_meta=article_meta,
@@ -915,53 +1213,59 @@ def write_content_for_all_sections_step(processed_sections_list, article_meta, p
             preparation_data=preparation_data, # TRUYỀN VÀO ĐÂY
             config=config
         )
+        section_jobs.append((section_copy, prompt_for_llm))
 
-        html_content = ""
-        if prompt_for_llm == content_prompts.SAY_I_LOVE_YOU_PROMPT:
-            logger.info(f"Section '{section_copy.get('sectionName')}' is a container, content will be 'I love you' (ignored).")
-            html_content = "<!-- Container Chapter - No Content Needed -->" # Hoặc để rỗng
-        elif prompt_for_llm:
-            logger.debug(f"Prompt for LLM (section: {section_copy.get('sectionName')}):\n{prompt_for_llm[:300]}...") # Log phần đầu prompt
-            
-            # Sử dụng model mạnh hơn cho content writing nếu cần
-            content_model = config.get('DEFAULT_OPENAI_CHAT_MODEL_FOR_CONTENT', config.get('DEFAULT_OPENAI_CHAT_MODEL'))
-            if section_copy.get('sectionNameTag', '').lower() == 'faqs': # FAQ có thể dùng model thường
-                content_model = config.get('DEFAULT_OPENAI_CHAT_MODEL')
-
-            llm_response = call_openai_chat(
-                prompt_messages=[{"role": "user", "content": prompt_for_llm}],
-                model_name=content_model,
-                api_key=config.get('OPENAI_API_KEY'), # OpenAI API key gốc
-                is_json_output=False, # Nội dung là HTML string, không phải JSON
-                target_api="openrouter",
-                openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-                openrouter_base_url=config.get('OPENROUTER_BASE_URL')
-            )
-            if llm_response:
-                # Kiểm tra nếu LLM trả về "I love you" (dù không nên nếu prompt khác)
-                if "i love you" in llm_response.lower() and len(llm_response) < 20:
-                    logger.info(f"LLM responded with 'I love you' for section '{section_copy.get('sectionName')}'. Treating as no content.")
-                    html_content = "<!-- LLM Fallback to ILY - No Content -->"
-                else:
-                    # Luôn xử lý phản hồi của LLM qua markdown_to_html_advanced.
-                    # Điều này đảm bảo rằng mọi Markdown sẽ được chuyển đổi sang HTML.
-                    # Giả định rằng markdown_to_html_advanced xử lý đầu vào đã là HTML một cách duyên dáng
-                    # (ví dụ: bằng cách bỏ qua hoặc chuẩn hóa nó mà không làm hỏng).
-                    logger.info(f"Converting LLM response to HTML for section '{section_copy.get('sectionName')}' using markdown_to_html_advanced.")
-                    html_content = basic_markdown_to_html(llm_response)
-            else:
-                logger.error(f"Failed to generate content from LLM for section '{section_copy.get('sectionName')}'.")
-                html_content = f"<!-- Error generating content for {section_copy.get('sectionName')} -->"
+    max_workers = max(1, int(config.get('SECTION_WRITER_MAX_WORKERS', 1)))
+    step_started_at = time.time()
+
+    # Gộp các subchapter ngắn liền nhau vào một request (nếu bật); section thiếu trong kết quả sẽ được viết riêng
+    batched_html_by_index = {}
+    if config.get('SECTION_BATCHING_ENABLED', False):
+        batch_results = _map_section_tasks(
+            lambda batch_jobs: _write_section_batch_content_safe(batch_jobs, section_writer_context, config),
+            _group_section_jobs_for_batching(section_jobs, config), max_workers
+        )
+        for batch_result in batch_results:
+            batched_html_by_index.update(batch_result)
+
+    # Các section còn lại cần một request riêng (container chapter và section không có prompt không gọi LLM)
+    pending_positions = [
+        position for position, (section_copy, prompt_for_llm) in enumerate(section_jobs)
+        if str(section_copy.get("sectionIndex")) not in batched_html_by_index
+        and prompt_for_llm and prompt_for_llm != content_prompts.SAY_I_LOVE_YOU_PROMPT
+    ]
+    written_html_by_position = {}
+    if pending_positions:
+        # Viết section đầu tiên trước để provider cache system message chung, các section sau đọc từ cache
+        first_position = pending_positions[0]
+        written_html_by_position[first_position] = _write_section_content_safe(
+            *section_jobs[first_position], section_writer_context, config)
+        remaining_results = _map_section_tasks(
+            lambda position: _write_section_content_safe(*section_jobs[position], section_writer_context, config),
+            pending_positions[1:], max_workers
+        )
+        written_html_by_position.update(zip(pending_positions[1:], remaining_results))
+
+    # Ghép kết quả theo đúng thứ tự outline
+    for position, (section_copy, prompt_for_llm) in enumerate(section_jobs):
+        batch_key = str(section_copy.get("sectionIndex"))
+        if batch_key in batched_html_by_index:
+            html_content = batched_html_by_index[batch_key]
+        elif position in written_html_by_position:
+            html_content = written_html_by_position[position]
         else:
-            logger.warning(f"No prompt generated for section '{section_copy.get('sectionName')}'. Skipping content generation.")
-            html_content = "<!-- No prompt for this section -->"
-            
+            html_content = _write_section_content(section_copy, prompt_for_llm, section_writer_context, config)
         section_copy["html_content"] = html_content
         sections_with_written_content.append(section_copy)
-        
-        # Thêm delay nhỏ giữa các API call để tránh rate limit (tùy chỉnh)
-        # time.sleep(config.get("API_CALL_DELAY_CONTENT", 1)) 
 
+    logger.info(f"Wrote {len(section_jobs)} sections in {time.time() - step_started_at:.1f}s "
+                f"({len(pending_positions)} individual requests, {len(batched_html_by_index)} sections from batches, "
+                f"max {max_workers} concurrent).")
+    for usage_call_site in ("section_content", "section_content_batch"):
+        section_usage = get_usage_totals(call_site=usage_call_site)
+        if section_usage and section_usage['prompt_tokens']:
+            logger.info(f"Prompt caching [{usage_call_site}]: {section_usage['cached_tokens']}/{section_usage['prompt_tokens']} "
+                        f"prompt tokens served from provider cache ({cached_prompt_ratio(section_usage):.1%}).")
     logger.info("Step 3 (Write Content for All Sections) completed.")
     return sections_with_written_content
 
@@ -981,6 +1285,7 @@ def process_sub_workflows_step(sections_with_initial_content, article_meta, run_
         - 'sections_after_external_links': list các section với HTML đã chèn external links.
         - 'final_image_data_list': list thông tin ảnh cho từng section.
         - 'final_video_data_list': list thông tin video cho từng section.
+        - 'processor_timings': số giây chạy của từng processor (external_links, images, videos, merge).
     Hoặc None nếu có lỗi nghiêm trọng.
     """
     if not sections_with_initial_content:
@@ -990,81 +1295,89 @@ def process_sub_workflows_step(sections_with_initial_content, article_meta, run_
     article_title = article_meta.get("title", "Untitled Article")
     logger.info(f"--- Starting Step 4: Sub-Workflow Processing for article '{article_title}', run_id: {run_context.unique_run_id} ---")
 
-    # 1. Xử lý External Links trước (vì nó thay đổi html_content)
-    # sections_with_initial_content là list các dict, mỗi dict có key 'current_html_content'
-    # mà external_links_processor cần đọc và cập nhật.
-    # Đổi tên key cho rõ ràng hơn
-    sections_for_ext_links = []
-    for sec_data in sections_with_initial_content:
-        copy_sec = dict(sec_data)
+    # Ba processor độc lập với nhau: external links chỉ sửa html_content, images/videos chỉ đọc metadata
+    # của section (không dùng HTML đã chèn link) -> chạy song song, rồi ghép kết quả theo sectionIndex.
+    def run_external_links(_):
         # external_links_processor mong đợi key 'current_html_content'
-        copy_sec['current_html_content'] = sec_data.get('html_content', '') 
-        sections_for_ext_links.append(copy_sec)
-
-    logger.info("Starting external links processing...")
-    sections_after_external_links = external_links_processor.process_external_links_for_article(
-        sections_with_content_list=sections_for_ext_links,
-        article_title_main=article_title,
-        run_context=run_context, # Thêm run_context
-        config=config
-    )
+        sections_for_ext_links = []
+        for sec_data in sections_with_initial_content:
+            copy_sec = dict(sec_data)
+            copy_sec['current_html_content'] = sec_data.get('html_content', '')
+            sections_for_ext_links.append(copy_sec)
+        logger.info("Starting external links processing...")
+        return external_links_processor.process_external_links_for_article(
+            sections_with_content_list=sections_for_ext_links,
+            article_title_main=article_title,
+            run_context=run_context, # Thêm run_context
+            config=config
+        )
 
-    if not sections_after_external_links:
-        logger.error("External links processing failed. Proceeding without external links.")
-        # Quyết định: Dừng lại hay tiếp tục? Tạm thời tiếp tục và dùng content cũ.
-        sections_after_external_links = sections_with_initial_content
-    else:
-        sections_final_content_structure = [dict(s) for s in sections_with_initial_content] # Tạo bản sao
-        temp_dict_after_ext_links = {s['sectionIndex']: s['current_html_content'] for s in sections_after_external_links}
-        for i, sec in enumerate(sections_final_content_structure):
-            sections_final_content_structure[i]['html_content'] = temp_dict_after_ext_links.get(
-                sec['sectionIndex'], 
-                sec.get('html_content', '') # Fallback nếu sectionIndex không tìm thấy
-            )
-        logger.info("External links processing completed.")
-
-
-    # 2. Xử lý Images
-    # image_processor cần list các section_data (không nhất thiết phải có html_content)
-    # Nó sẽ tự đọc/lưu image_array vào Redis dựa trên unique_run_id.
-    logger.info("Starting image processing...")
-    # `process_images_for_article` nên trả về list các image_data mà nó đã xử lý trong lần chạy đó
-    # hoặc main_logic có thể đọc trực tiếp từ Redis sau khi hàm này chạy xong.
-    # Để đơn giản, giả sử nó trả về list kết quả.
-    final_image_data_list = image_processor.process_images_for_article(
-        sections_data_list=sections_with_initial_content, 
-        article_title=article_title,
-        run_context=run_context, # Thêm run_context
-        config=config
-    )
+    def run_images(_):
+        # image_processor cần list các section_data (không nhất thiết phải có html_content)
+        logger.info("Starting image processing...")
+        return image_processor.process_images_for_article(
+            sections_data_list=sections_with_initial_content,
+            article_title=article_title,
+            run_context=run_context, # Thêm run_context
+            config=config
+        )
 
-    if not final_image_data_list:
-        logger.warning("Image processing did not return data. Assuming no images or errors occurred.")
-        final_image_data_list = [] # Đảm bảo là list
-    logger.info("Image processing completed.")
-
-    # 3. Xử lý Videos
-    # Tương tự image_processor
-    logger.info("Starting video processing...")
-    final_video_data_list = video_processor.process_videos_for_article(
-        sections_data_list=sections_with_initial_content,
-        article_title=article_title,
-        run_context=run_context, # Thêm run_context
-        config=config
-    )
+    def run_videos(_):
+        logger.info("Starting video processing...")
+        return video_processor.process_videos_for_article(
+            sections_data_list=sections_with_initial_content,
+            article_title=article_title,
+            run_context=run_context, # Thêm run_context
+            config=config
+        )
+
+    def merge_results(dep_results):
+        sections_after_external_links = dep_results["external_links"]
+        sections_final_content_structure = [dict(s) for s in sections_with_initial_content] # Tạo bản sao
+        if not sections_after_external_links:
+            logger.error("External links processing failed. Proceeding without external links.")
+        else:
+            temp_dict_after_ext_links = {s['sectionIndex']: s['current_html_content'] for s in sections_after_external_links}
+            for sec in sections_final_content_structure:
+                sec['html_content'] = temp_dict_after_ext_links.get(
+                    sec['sectionIndex'],
+                    sec.get('html_content', '') # Fallback nếu sectionIndex không tìm thấy
+                )
+            logger.info("External links processing completed.")
+
+        final_image_data_list = dep_results["images"]
+        if not final_image_data_list:
+            logger.warning("Image processing did not return data. Assuming no images or errors occurred.")
+            final_image_data_list = [] # Đảm bảo là list
+        logger.info("Image processing completed.")
+
+        final_video_data_list = dep_results["videos"]
+        if not final_video_data_list:
+            logger.warning("Video processing did not return data. Assuming no videos or errors occurred.")
+            final_video_data_list = [] # Đảm bảo là list
+        logger.info("Video processing completed.")
+
+        return {
+            "sections_final_content_structure": sections_final_content_structure, # Sửa ở đây
+            "final_image_data_list": final_image_data_list,
+            "final_video_data_list": final_video_data_list
+        }
 
-    if not final_video_data_list:
-        logger.warning("Video processing did not return data. Assuming no videos or errors occurred.")
-        final_video_data_list = [] # Đảm bảo là list
-    logger.info("Video processing completed.")
+    results, timings = run_task_graph([
+        GraphTask("external_links", run_external_links),
+        GraphTask("images", run_images),
+        GraphTask("videos", run_videos),
+        GraphTask("merge", merge_results, deps=("external_links", "images", "videos")),
+    ], graph_name="Step 4 sub-workflows")
+    step_result = results["merge"]
+    if step_result is None:
+        logger.error("Step 4 could not merge sub-workflow results.")
+        return None
+    step_result["processor_timings"] = timings # Thời gian chạy (giây) của từng processor
 
     logger.info(f"--- Step 4 (Sub-Workflow Processing) completed for run_id: {run_context.unique_run_id} ---")
     
-    return {
-        "sections_final_content_structure": sections_final_content_structure, # Sửa ở đây
-        "final_image_data_list": final_image_data_list,
-        "final_video_data_list": final_video_data_list
-    }
+    return step_result
 
 
 ######################################################
@@ -1123,7 +1436,10 @@ def _generate_comparison_table_if_needed(article_meta, processed_sections_list_f
             is_json_output=False, # Mong đợi HTML string
             target_api="openrouter",
             openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-            openrouter_base_url=config.get('OPENROUTER_BASE_URL')
+            openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+            call_site="comparison_table",
+            stream=config.get('LLM_STREAMING_ENABLED', False)
+            # Không đặt trần token: bảng bị cắt giữa chừng thì không dùng được, dừng sớm chỉ phí số token đã trả
         )
 
         if not comparison_table_html:
@@ -1199,6 +1515,28 @@ def _generate_comparison_table_if_needed(article_meta, processed_sections_list_f
         logger.error(f"Error generating comparison table: {e}", exc_info=True)
         return None
 
+def _generate_image_figure_html(image_info, alt_text, config):
+    """
+    Tạo thẻ <figure><img> cho ảnh section. Có srcset (nhiều bản resize) thì thêm srcset/sizes để trình duyệt
+    mobile tải bản nhỏ; width/height giúp trình duyệt giữ chỗ cho ảnh, tránh layout shift.
+    """
+    img_attributes = [f'src="{html.escape(image_info["url"])}"']
+    srcset_variants = image_info.get('srcset') or []
+    if len(srcset_variants) > 1:
+        srcset = ", ".join(f"{html.escape(variant['url'])} {variant['width']}w" for variant in srcset_variants)
+        display_width = image_info.get('width') or srcset_variants[-1]['width']
+        sizes = config.get('IMAGE_SRCSET_SIZES') or f"(max-width: {display_width}px) 100vw, {display_width}px"
+        img_attributes.append(f'srcset="{srcset}"')
+        img_attributes.append(f'sizes="{html.escape(sizes)}"')
+    if image_info.get('width') and image_info.get('height'):
+        img_attributes.append(f'width="{image_info["width"]}" height="{image_info["height"]}"')
+    img_attributes.append(f'alt="{html.escape(alt_text or "")}"')
+    return f"""
+<figure style="text-align:center; margin-top: 20px; margin-bottom: 20px;">
+    <img {" ".join(img_attributes)} />
+</figure>
+"""
+
 def _generate_youtube_iframe_html(video_id):
     """Tạo mã HTML iframe cho YouTube video."""
     if not video_id or str(video_id).lower() == "none":
@@ -1298,12 +1636,7 @@ def assemble_full_html_step(sections_final_content_structure,
         if image_info and image_info.get('url') not in ["skipped_section_type", "not_inserted_by_default"] and "error" not in image_info.get('url'):
             # image_processor._should_skip_image đã xử lý việc không chèn vào các section đặc biệt
             # và mother chapters. Vậy ở đây chỉ cần check URL hợp lệ.
-             alt_text = html.escape(image_info.get('alt_text', s_name))
-             section_html_parts.append(f"""
-<figure style="text-align:center; margin-top: 20px; margin-bottom: 20px;">
-    <img src="{html.escape(image_info['url'])}" alt="{alt_text}" />
-</figure>
-""")
+             section_html_parts.append(_generate_image_figure_html(image_info, image_info.get('alt_text', s_name), config))
         
         # --- D. Chèn Nội dung Section (đã có external links) ---
         if s_html_content_with_ext_links and "<!-- Container Chapter" not in s_html_content_with_ext_links and "<!-- No prompt for this section -->" not in s_html_content_with_ext_links:
@@ -1347,14 +1680,25 @@ def refine_and_finalize_article_html_step(
     logger.info(f"--- Starting Step 6: Refining and Finalizing Article HTML for '{article_topic}' ---")
     logger.info(f"Desired tone: {desired_tone}. Length will be based on original section intents.")
 
+    # Bản nháp không thể cắt bớt (LLM trả về toàn bộ bài viết), chỉ bỏ comment HTML (placeholder nội bộ).
+    # Nếu vẫn vượt budget thì bỏ qua bước refine thay vì trả tiền cho một request quá lớn dễ lỗi/bị cắt.
+    prompt_draft_html = re.sub(r'<!--.*?-->', '', draft_html_content, flags=re.DOTALL)
+    draft_budget = _get_prompt_token_budget("refine_draft_html", config)
+    draft_tokens = count_tokens(prompt_draft_html)
+    if draft_budget and draft_tokens > draft_budget:
+        logger.warning(f"Draft HTML is ~{draft_tokens} tokens, over the refine budget of {draft_budget}. Skipping refinement and using the draft.")
+        return draft_html_content
+
     prompt = content_prompts.REFINE_AND_FINALIZE_ARTICLE_PROMPT.format(
         article_topic=article_topic,
         desired_tone=desired_tone,
-        draft_html_content=draft_html_content 
+        draft_html_content=prompt_draft_html
     )
 
     try:
         finalizing_model = config.get('DEFAULT_OPENAI_CHAT_MODEL_FOR_FINALIZING', config.get('DEFAULT_OPENAI_CHAT_MODEL_FOR_CONTENT', config.get('DEFAULT_OPENAI_CHAT_MODEL')))
+        # Bản hoàn thiện nên có độ dài tương đương bản nháp
+        draft_word_count = len(BeautifulSoup(draft_html_content, 'html.parser').get_text(" ").split())
         
         final_html_output = call_openai_chat(
             prompt_messages=[{"role": "user", "content": prompt}],
@@ -1363,7 +1707,14 @@ def refine_and_finalize_article_html_step(
             is_json_output=False,
             target_api="openrouter",
             openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-            openrouter_base_url=config.get('OPENROUTER_BASE_URL')
+            openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+            call_site="refine_article",
+            stream=config.get('LLM_STREAMING_ENABLED', False),
+            max_output_words=_get_stream_word_limit(draft_word_count, config),
+            # Trần token theo bản nháp (cả markup ảnh/video/FAQ), không dùng LLM_STREAM_MAX_OUTPUT_TOKENS cố định:
+            # bài dài hơn trần đó sẽ luôn bị cắt và bỏ đi sau khi đã trả tiền cho toàn bộ số token
+            max_output_tokens=int(draft_tokens * float(config.get('LLM_STREAM_OVERSHOOT_FACTOR', 1.6))),
+            stream_abort_action="discard" # Bài bị cắt mất phần cuối -> dùng lại bản nháp (bên dưới)
         )
 
         if final_html_output:
@@ -1438,7 +1789,9 @@ def _determine_category_id(article_meta, keyword_analysis_data, preparation_data
         is_json_output=True,
         target_api="openrouter",
         openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-        openrouter_base_url=config.get('OPENROUTER_BASE_URL')
+        openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+        call_site="recommend_category",
+        json_schema=response_schemas.RECOMMEND_CATEGORY_SCHEMA
     )
 
     if not category_recommendation or not isinstance(category_recommendation, dict):
@@ -1591,7 +1944,8 @@ def finalize_and_publish_article_step(
         api_key=config.get('OPENAI_API_KEY'), # OpenAI API key gốc
         target_api="openrouter",
         openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-        openrouter_base_url=config.get('OPENROUTER_BASE_URL')
+        openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+        call_site="dalle_prompt"
     )
 
     featured_image_wp_id = None
@@ -1611,25 +1965,34 @@ def finalize_and_publish_article_step(
             if featured_image_url_from_dalle:
                 logger.info(f"Featured image generated by DALL-E: {featured_image_url_from_dalle}")
                 try:
-                    response = requests.get(featured_image_url_from_dalle, stream=True, timeout=30)
-                    response.raise_for_status()
-                    image_binary = response.content
-                    
-                    resized_featured_image_binary = resize_image(
-                        image_binary,
-                        width=config.get('FEATURED_IMAGE_RESIZE_WIDTH', 800),
-                        output_format='JPEG',
-                        quality=85
-                    )
+                    image_file = download_image(
+                        featured_image_url_from_dalle,
+                        timeout=30,
+                        max_bytes=config.get('IMAGE_DOWNLOAD_MAX_BYTES', 15 * 1024 * 1024),
+                        deadline_sec=config.get('IMAGE_DOWNLOAD_DEADLINE_SEC', 30),
+                        spool_max_memory_bytes=config.get('IMAGE_DOWNLOAD_SPOOL_MEMORY_BYTES', 2 * 1024 * 1024)
+                    ).file
+                    featured_output_format = choose_output_format(config.get('IMAGE_OUTPUT_FORMATS'))
+                    try:
+                        resized_featured_image_binary = transcode_image(
+                            image_file.read(),
+                            width=config.get('FEATURED_IMAGE_RESIZE_WIDTH', 800),
+                            output_format=featured_output_format,
+                            quality=85,
+                            max_bytes=config.get('FEATURED_IMAGE_OUTPUT_MAX_BYTES'),
+                            min_quality=config.get('IMAGE_OUTPUT_MIN_QUALITY', 50)
+                        )
+                    finally:
+                        image_file.close()
                     if resized_featured_image_binary:
                         slug_for_filename = article_meta.get('slug', 'featured').replace('-', '_') # Sử dụng slug từ article_meta
-                        featured_filename = f"{slug_for_filename}_featured_image.jpg"
+                        featured_filename = f"{slug_for_filename}_featured_image.{get_output_extension(featured_output_format)}"
                         
                         wp_media_resp = upload_wp_media( # Đảm bảo hàm này được import và định nghĩa đúng
                             wp_base_url, wp_user, wp_pass,
                             resized_featured_image_binary,
                             featured_filename,
-                            "image/jpeg"
+                            get_output_mime_type(featured_output_format)
                         )
                         if wp_media_resp and wp_media_resp.get('id'):
                             featured_image_wp_id = wp_media_resp.get('id')
@@ -1756,7 +2119,9 @@ def finalize_and_publish_article_step(
             is_json_output=True,
             target_api="openrouter",
             openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-            openrouter_base_url=config.get('OPENROUTER_BASE_URL')
+            openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+            call_site="ilj_keywords",
+            json_schema=response_schemas.ILJ_KEYWORDS_SCHEMA
         )
 
         actual_ilj_keywords_list = None
@@ -1863,6 +2228,31 @@ def orchestrate_article_creation(keyword_to_process: str,
     run_context = RunContext(unique_run_id=current_run_id)
     # Trong các bước tiếp theo, chúng ta sẽ truyền run_context này vào các hàm thay vì redis_handler
 
+    set_active_usage_ledger(run_context.usage_ledger)
+    try:
+        return _run_article_creation_steps(
+            keyword_to_process=keyword_to_process,
+            sheet_row_data_from_orchestrator=sheet_row_data_from_orchestrator,
+            config=config,
+            gsheet_handler_instance=gsheet_handler_instance,
+            pinecone_handler_instance=pinecone_handler_instance,
+            db_handler_instance=db_handler_instance,
+            run_context=run_context
+        )
+    finally:
+        set_active_usage_ledger(None)
+        run_context.usage_ledger.write_summary()
+
+def _run_article_creation_steps(keyword_to_process: str,
+                                sheet_row_data_from_orchestrator: dict,
+                                config: dict,
+                                gsheet_handler_instance: GoogleSheetsHandler,
+                                pinecone_handler_instance: PineconeHandler,
+                                db_handler_instance: MySQLHandler,
+                                run_context: RunContext):
+    """Chạy lần lượt Bước 1-7 cho một keyword (xem orchestrate_article_creation)."""
+    current_run_id = run_context.unique_run_id
+
     # --- Bước 1: Phân tích Keyword và Chuẩn bị ---
     logger.info("--- Running Step 1: Analyze and Prepare Keyword ---")
     preparation_results = analyze_and_prepare_keyword(
@@ -3,7 +3,7 @@ import logging
 import random
 import json # Để parse JSON từ OpenAI nếu cần (mặc dù prompt yêu cầu JSON object)
 from utils.api_clients import call_openai_chat, perform_search # Sử dụng perform_search
-from prompts import video_prompts
+from prompts import video_prompts, response_schemas
 # from utils.config_loader import APP_CONFIG # Import config của bạn
 
 logger = logging.getLogger(__name__)
@@ -124,7 +124,8 @@ def process_single_section_video(section_data, article_title, parent_chapter_nam
         api_key=openai_api_key, # OpenAI API key gốc
         target_api="openrouter",
         openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-        openrouter_base_url=config.get('OPENROUTER_BASE_URL')
+        openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+        call_site="video_keyword"
     )
     if not video_keyword:
         logger.error(f"Failed to generate video keyword for section: {section_data.get('sectionName')}")
@@ -185,7 +186,9 @@ def process_single_section_video(section_data, article_title, parent_chapter_nam
         is_json_output=True, # Yêu cầu OpenAI trả về JSON
         target_api="openrouter",
         openrouter_api_key=config.get('OPENROUTER_API_KEY'),
-        openrouter_base_url=config.get('OPENROUTER_BASE_URL')
+        openrouter_base_url=config.get('OPENROUTER_BASE_URL'),
+        call_site="choose_video",
+        json_schema=response_schemas.CHOOSE_VIDEO_SCHEMA
     )
 
     if chosen_video_info and chosen_video_info.get('videoID'):